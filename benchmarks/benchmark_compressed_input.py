@@ -0,0 +1,89 @@
+"""
+ benchmark_compressed_input.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+
+ Measure parsing compressed logs decompressing them in process against
+ piping them from an external decompressor, as in "zcat log.gz | geolocate -s".
+
+ Run from repository root with:
+    python -m benchmarks.benchmark_compressed_input
+"""
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+
+import geolocate.classes.compression as compression
+import geolocate.classes.parser as parser
+import benchmarks.benchmark_file_input as benchmark_file_input
+import benchmarks.benchmarking_tools as tools
+
+# Lines with addresses, out of every 10 lines.
+ADDRESS_LINES = 1
+EXTERNAL_DECOMPRESSORS = {compression.GZIP: "zcat",
+                          compression.BZIP2: "bzcat",
+                          compression.XZ: "xzcat",
+                          compression.ZSTD: "zstdcat"}
+
+
+def _parse_in_process(path, compression_format):
+    input_parser = parser.GeolocateInputParser(0, tools.StubGeoIPDatabase(),
+                                               "")
+    output_writer = parser.OutputWriter(io.BytesIO(), line_buffered=False)
+    with compression.open_decompressed(path, compression_format) as stream:
+        for chunk in parser.BlockParser(input_parser, stream):
+            output_writer.write_bytes(chunk)
+
+
+def _parse_from_pipe(path, decompressor):
+    with subprocess.Popen([decompressor, path],
+                          stdout=subprocess.PIPE) as process:
+        input_parser = parser.GeolocateInputParser(
+            0, tools.StubGeoIPDatabase(), "")
+        input_parser._entered_text = parser.InputReader(process.stdout)
+        output_writer = parser.OutputWriter(io.BytesIO(), line_buffered=False)
+        for line in input_parser:
+            output_writer.write(line)
+
+
+def _print_throughput(name, seconds, size):
+    print("{0:<50} {1:>10.1f} MB/s".format(name, size / seconds / 1e6))
+
+
+def main():
+    data = benchmark_file_input._generate_data(ADDRESS_LINES)
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        for compression_format in compression.COMPRESSION_FORMATS:
+            decompressor = EXTERNAL_DECOMPRESSORS[compression_format]
+            if compression_format == compression.ZSTD and \
+                    compression.zstandard is None:
+                print("{0}: zstandard package not installed, "
+                      "skipped".format(compression_format))
+                continue
+            path = os.path.join(temporary_directory, "input.log")
+            with open(path, "wb") as output_file:
+                compressed_stream = compression.open_compressed(
+                    output_file, compression_format)
+                compressed_stream.write(data)
+                compressed_stream.close()
+            in_process = tools.best_time(
+                lambda: _parse_in_process(path, compression_format), repeat=3)
+            _print_throughput("{0}, in process".format(compression_format),
+                              in_process, len(data))
+            if shutil.which(decompressor) is None:
+                print("{0}: {1} not found, skipped".format(compression_format,
+                                                           decompressor))
+                continue
+            from_pipe = tools.best_time(
+                lambda: _parse_from_pipe(path, decompressor), repeat=3)
+            _print_throughput("{0}, piped from {1}".format(compression_format,
+                                                           decompressor),
+                              from_pipe, len(data))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+ benchmark_file_input.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+
+ Measure memory mapped file parsing against parsing the same file read as a
+ stream, for logs with different ratios of lines with addresses.
+
+ Run from repository root with:
+    python -m benchmarks.benchmark_file_input
+"""
+import io
+import os
+import tempfile
+
+import geolocate.classes.parser as parser
+import benchmarks.benchmark_ipv6 as benchmark_ipv6
+import benchmarks.benchmarking_tools as tools
+
+LINES = 200000
+NO_ADDRESS_LINE = "Oct 10 13:55:36 host kernel: eth0 link is up, 1000 Mbps " \
+                  "full duplex, flow control rx/tx\n"
+# Lines with addresses, out of every 10 lines.
+ADDRESS_LINES_RATIOS = (0, 1, 5, 10)
+
+
+def _generate_data(address_lines):
+    addresses = tools.generate_addresses(1000)
+    lines = [benchmark_ipv6.ACCESS_LOG_LINE.format(addresses[i % 1000])
+             if i % 10 < address_lines else NO_ADDRESS_LINE
+             for i in range(LINES)]
+    return parser.encode("".join(lines))
+
+
+def _parse_stream(path):
+    with open(path, "rb") as input_file:
+        input_parser = parser.GeolocateInputParser(
+            0, tools.StubGeoIPDatabase(), "")
+        input_parser._entered_text = parser.InputReader(input_file)
+        output_writer = parser.OutputWriter(io.BytesIO(), line_buffered=False)
+        for line in input_parser:
+            output_writer.write(line)
+
+
+def _parse_mapped_file(path):
+    input_parser = parser.GeolocateInputParser(0, tools.StubGeoIPDatabase(),
+                                               "")
+    output_writer = parser.OutputWriter(io.BytesIO(), line_buffered=False)
+    for chunk in parser.MappedFileParser(input_parser, path):
+        output_writer.write_bytes(chunk)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        path = os.path.join(temporary_directory, "input.log")
+        for address_lines in ADDRESS_LINES_RATIOS:
+            with open(path, "wb") as input_file:
+                input_file.write(_generate_data(address_lines))
+            stream = tools.best_time(lambda: _parse_stream(path))
+            mapped = tools.best_time(lambda: _parse_mapped_file(path))
+            tools.print_result("{0}0% lines with addresses, stream".format(
+                address_lines), stream, LINES)
+            tools.print_result("{0}0% lines with addresses, mapped "
+                               "file".format(address_lines), mapped, LINES)
+
+
+if __name__ == "__main__":
+    main()
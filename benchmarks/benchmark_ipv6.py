@@ -0,0 +1,76 @@
+"""
+ benchmark_ipv6.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+
+ Measure how much IPv6 support costs when parsing IPv4 only logs. Baseline
+ is a parser restricted to IPv4 regex, as it was before IPv6 support.
+
+ Run from repository root with:
+    python -m benchmarks.benchmark_ipv6
+"""
+import geolocate.classes.parser as parser
+import benchmarks.benchmarking_tools as tools
+
+LINES = 20000
+REPEAT = 10
+# Budget agreed for IPv6 support over IPv4 only logs.
+MAX_OVERHEAD = 0.20
+ACCESS_LOG_LINE = '{0} - - [10/Oct/2020:13:55:36 -0700] "GET ' \
+                  '/static/app.js?v=1.2.3.4.5 HTTP/1.1" 200 2326 ' \
+                  '"http://www.example.com/start.html" "Mozilla/5.0 ' \
+                  '(X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like ' \
+                  'Gecko) Chrome/85.0.4183.83 Safari/537.36"\n'
+
+
+class IPv4OnlyParser(parser.GeolocateInputParser):
+    """ Parser as it was before IPv6 support. """
+
+    def _include_locations_in_line(self, line):
+        if not parser._may_have_addresses(line):
+            return line
+        return parser._IPV4_REGEX.sub(self._replace_with_location_string,
+                                      line)
+
+
+def _generate_lines(ipv6=False):
+    addresses = tools.generate_addresses(1000)
+    if ipv6:
+        addresses = ["2001:db8::{0:x}".format(i) for i in range(500)] + \
+                    addresses[:500]
+    return [ACCESS_LOG_LINE.format(addresses[i % len(addresses)])
+            for i in range(LINES)]
+
+
+def _parse(parser_class, lines):
+    text = "".join(lines)
+    input_parser = parser_class(0, tools.StubGeoIPDatabase(), text)
+    for _ in input_parser:
+        pass
+
+
+def main():
+    ipv4_lines = _generate_lines()
+    ipv4_only = with_ipv6 = float("inf")
+    # Interleaved, so both cases suffer the same machine load.
+    for _ in range(REPEAT):
+        ipv4_only = min(ipv4_only, tools.best_time(
+            lambda: _parse(IPv4OnlyParser, ipv4_lines), repeat=1))
+        with_ipv6 = min(with_ipv6, tools.best_time(
+            lambda: _parse(parser.GeolocateInputParser, ipv4_lines),
+            repeat=1))
+    tools.print_result("IPv4 log, IPv4 only parser", ipv4_only, LINES)
+    tools.print_result("IPv4 log, IPv4 and IPv6 parser", with_ipv6, LINES)
+    overhead = with_ipv6 / ipv4_only - 1
+    print("IPv6 support overhead on IPv4 logs: {0:.1%} (budget {1:.0%})"
+          "".format(overhead, MAX_OVERHEAD))
+    mixed_lines = _generate_lines(ipv6=True)
+    mixed = tools.best_time(
+        lambda: _parse(parser.GeolocateInputParser, mixed_lines))
+    tools.print_result("half IPv6 log, IPv4 and IPv6 parser", mixed, LINES)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+ benchmark_locators.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+
+ Measure local database lookups building complete geoip2 models against
+ reading raw records and taking only fields needed for every detail level.
+ Database used is the one configured for geolocate, unless another one is
+ given as argument.
+
+ Run from repository root with:
+    python -m benchmarks.benchmark_locators [database_path]
+"""
+import random
+import sys
+
+import geolocate.classes.config as config
+import geolocate.classes.geowrapper as geowrapper
+import benchmarks.benchmarking_tools as tools
+
+ADDRESSES = 20000
+# Fixed seed, so every run looks for the same addresses.
+SEED = 31
+DETAIL_LEVELS = (geowrapper.DETAIL_CONTINENT, geowrapper.DETAIL_COUNTRY,
+                 geowrapper.DETAIL_CITY, geowrapper.DETAIL_COORDINATES)
+
+
+def _find_located_addresses(raw_reader):
+    """ Get random addresses present in database, so both paths do the same
+    work for all of them.
+    """
+    random_generator = random.Random(SEED)
+    addresses = []
+    for _ in range(ADDRESSES * 1000):
+        ip = ".".join(str(random_generator.randrange(1, 224))
+                      for _ in range(4))
+        if raw_reader.get(ip) is not None:
+            addresses.append(ip)
+            if len(addresses) == ADDRESSES:
+                break
+    return addresses
+
+
+def _locate_models(reader, addresses):
+    for ip in addresses:
+        reader.city(ip)
+
+
+def _locate_records(raw_reader, addresses, detail):
+    for ip in addresses:
+        record, prefix_length = raw_reader.get_with_prefix_len(ip)
+        geowrapper._get_location_record(
+            record, detail, geowrapper.TraitsRecord(ip, prefix_length))
+
+
+def main():
+    if len(sys.argv) > 1:
+        database_path = sys.argv[1]
+    else:
+        database_path = config.Configuration().local_database_path
+    reader = geowrapper._open_local_database(database_path)
+    raw_reader = reader._db_reader
+    addresses = _find_located_addresses(raw_reader)
+    if not addresses:
+        print("No address found in {0}".format(database_path))
+        return
+    models = tools.best_time(lambda: _locate_models(reader, addresses))
+    tools.print_result("geoip2 models", models, len(addresses), "lookup")
+    for detail in DETAIL_LEVELS:
+        records = tools.best_time(
+            lambda: _locate_records(raw_reader, addresses, detail))
+        tools.print_result("raw records, detail {0} (speedup {1:.2f}x)".format(
+            detail, models / records), records, len(addresses), "lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+ benchmark_parallel.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+
+ Measure how parallel parsing scales with the number of jobs. Locations come
+ from a stub database, so only parsing costs are measured, as it happens
+ with local database only lookups.
+
+ Run from repository root with:
+    python -m benchmarks.benchmark_parallel
+"""
+import io
+import os
+
+import geolocate.classes.config as config
+import geolocate.classes.parallel as parallel
+import geolocate.classes.parser as parser
+import benchmarks.benchmark_ipv6 as benchmark_ipv6
+import benchmarks.benchmarking_tools as tools
+
+LINES = 400000
+CHUNK_SIZE = 1024 * 1024
+
+
+def _parse_sequentially(data):
+    input_parser = parser.GeolocateInputParser(0, tools.StubGeoIPDatabase())
+    parser.encode(input_parser.include_locations(parser.decode(data)))
+
+
+def _parse_in_parallel(data, jobs):
+    parallel_parser = parallel.ParallelParser(
+        jobs, 0, config.Configuration(), io.BytesIO(data),
+        chunk_size=CHUNK_SIZE, database_loader=tools.load_stub_database)
+    for _ in parallel_parser:
+        pass
+
+
+def main():
+    addresses = tools.generate_addresses(50000)
+    data = parser.encode("".join(
+        benchmark_ipv6.ACCESS_LOG_LINE.format(addresses[i % len(addresses)])
+        for i in range(LINES)))
+    sequential = tools.best_time(lambda: _parse_sequentially(data), repeat=3)
+    tools.print_result("sequential", sequential, LINES)
+    jobs = 1
+    while jobs <= os.cpu_count():
+        seconds = tools.best_time(lambda: _parse_in_parallel(data, jobs),
+                                  repeat=3)
+        tools.print_result("{0} jobs (speedup {1:.2f}x)".format(
+            jobs, sequential / seconds), seconds, LINES)
+        jobs *= 2
+
+
+if __name__ == "__main__":
+    main()
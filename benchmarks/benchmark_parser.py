@@ -0,0 +1,71 @@
+"""
+ benchmark_parser.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+
+ Compare per line cost of old per address str.replace() rewriting against
+ single pass regex rewriting, using long lines with many addresses.
+
+ Run from repository root with:
+    python -m benchmarks.benchmark_parser
+"""
+import re
+
+import geolocate.classes.parser as parser
+import benchmarks.benchmarking_tools as tools
+
+LINES = 500
+ADDRESSES_PER_LINE = (1, 10, 50, 200)
+
+
+def _legacy_include_locations(input_parser, line):
+    """ Line rewriting as it was done before single pass engine: compile
+    filter, find addresses and replace them one by one.
+    """
+    regex_filter = re.compile(r"[0-9]+(?:\.[0-9]+){3}")
+    for ip in set(regex_filter.findall(line)):
+        location = input_parser._get_location_string(ip)
+        line = line.replace(ip, location)
+    return line
+
+
+def _generate_lines(addresses_per_line):
+    addresses = tools.generate_addresses(addresses_per_line * LINES)
+    lines = []
+    for i in range(LINES):
+        line_addresses = addresses[i * addresses_per_line:
+                                   (i + 1) * addresses_per_line]
+        fields = ["src={0} dst=10.0.0.1 bytes=1500 proto=tcp".format(ip)
+                  for ip in line_addresses]
+        lines.append(" ".join(fields))
+    return lines
+
+
+def _run(addresses_per_line):
+    lines = _generate_lines(addresses_per_line)
+    input_parser = parser.GeolocateInputParser(0, tools.StubGeoIPDatabase(),
+                                               cache_size=len(lines) * 100)
+    # Warm caches, so we only measure line rewriting.
+    for line in lines:
+        input_parser._include_locations_in_line(line)
+    legacy = tools.best_time(
+        lambda: [_legacy_include_locations(input_parser, line)
+                 for line in lines])
+    single_pass = tools.best_time(
+        lambda: [input_parser._include_locations_in_line(line)
+                 for line in lines])
+    tools.print_result("per address replace, {0} addresses/line".format(
+        addresses_per_line), legacy, len(lines))
+    tools.print_result("single pass, {0} addresses/line".format(
+        addresses_per_line), single_pass, len(lines))
+
+
+def main():
+    for addresses_per_line in ADDRESSES_PER_LINE:
+        _run(addresses_per_line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+ benchmark_startup.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+
+ Measure cold start latency of geolocate, as paid by every short lived cron
+ or CI job calling it. Every case is run in a new interpreter. Commands use
+ configuration and local database of current user.
+
+ Run from repository root with:
+    python -m benchmarks.benchmark_startup
+"""
+import subprocess
+import sys
+
+import benchmarks.benchmarking_tools as tools
+
+RUNS = 10
+CASES = [("python interpreter", ["-c", "pass"]),
+         ("import geolocate.glocate", ["-c", "import geolocate.glocate"]),
+         ("show user (configuration only)",
+          ["-m", "geolocate.glocate", "--show_user"]),
+         ("locate one address", ["-m", "geolocate.glocate", "80.58.67.90"])]
+
+
+def _run(arguments):
+    subprocess.run([sys.executable] + arguments, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def main():
+    for name, arguments in CASES:
+        seconds = tools.best_time(lambda: _run(arguments), repeat=RUNS)
+        print("{0:<50} {1:>10.2f} ms/run".format(name, seconds * 1e3))
+
+
+if __name__ == "__main__":
+    main()
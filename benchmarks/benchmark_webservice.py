@@ -0,0 +1,66 @@
+"""
+ benchmark_webservice.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+
+ Measure parsing throughput when webservice is the first locator, looking
+ for addresses one after another against doing it concurrently. Queries go
+ to a local fake webservice with a fixed round trip time, so neither
+ network access nor Maxmind credits are needed.
+
+ Run from repository root with:
+    python -m benchmarks.benchmark_webservice
+"""
+import os
+import tempfile
+
+import geolocate.classes.config as config
+import geolocate.classes.geowrapper as geowrapper
+import geolocate.classes.parser as parser
+import geolocate.tests.fake_servers as fake_servers
+import benchmarks.benchmarking_tools as tools
+
+ADDRESSES = 200
+# Seconds fake webservice takes to answer every query.
+ROUND_TRIP_TIME = 0.01
+CONCURRENCY_LEVELS = (1, 4, 8, 16)
+VERBOSITY = 1
+
+
+def _parse(text, concurrency):
+    """ Parse text line by line, as stream mode does, with a new database
+    and empty caches.
+    """
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        configuration = config.Configuration(
+            user_id="42", license_key="XXXXX",
+            webservice_concurrency=concurrency,
+            locators_preference=[geowrapper.GEOIP2_WEBSERVICE_TAG],
+            persistent_cache_path=os.path.join(temporary_directory,
+                                               "webservice.sqlite"))
+        geoip_database = geowrapper.load_geoip_database(configuration)
+        input_parser = parser.GeolocateInputParser(VERBOSITY, geoip_database,
+                                                   text)
+        for _ in input_parser:
+            pass
+
+
+def main():
+    addresses = tools.generate_addresses(ADDRESSES)
+    text = "".join("Connection from {0}\n".format(ip) for ip in addresses)
+    with fake_servers.FakeWebServiceServer(delay=ROUND_TRIP_TIME) as server, \
+            server.redirect_clients():
+        sequential = None
+        for concurrency in CONCURRENCY_LEVELS:
+            seconds = tools.best_time(lambda: _parse(text, concurrency),
+                                      repeat=3)
+            if sequential is None:
+                sequential = seconds
+            tools.print_result("concurrency {0} (speedup {1:.2f}x)".format(
+                concurrency, sequential / seconds), seconds, ADDRESSES)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+ benchmarking_tools.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import timeit
+
+# Benchmarks and tests share the same stub database.
+from geolocate.tests.testing_tools import StubGeoIPDatabase
+
+
+def generate_addresses(count, first_octet=80):
+    """
+    :param count: How many different addresses to generate.
+    :type count: int
+    :param first_octet: First octet of every generated address.
+    :type first_octet: int
+    :return: IPv4 addresses.
+    :rtype: list
+    """
+    return ["{0}.{1}.{2}.{3}".format(first_octet, (i >> 16) & 255,
+                                     (i >> 8) & 255, i & 255)
+            for i in range(count)]
+
+
+def best_time(function, repeat=5, number=1):
+    """ Run function several times and keep the fastest one, which is the
+    one less disturbed by other processes.
+
+    :param function: Callable to measure.
+    :type function: callable
+    :param repeat: How many measures to take.
+    :type repeat: int
+    :param number: Calls to function per measure.
+    :type number: int
+    :return: Seconds spent by fastest measure.
+    :rtype: float
+    """
+    return min(timeit.repeat(function, repeat=repeat, number=number))
+
+
+def print_result(name, seconds, units, unit_name="line"):
+    """
+    :param name: Measured case.
+    :type name: str
+    :param seconds: Time spent processing units.
+    :type seconds: float
+    :param units: Processed units.
+    :type units: int
+    :param unit_name: What a unit is.
+    :type unit_name: str
+    :return: None
+    """
+    per_unit = seconds / units * 1e6
+    print("{0:<50} {1:>10.2f} us/{2}".format(name, per_unit, unit_name))
+
+
+def load_stub_database(configuration):
+    """ Database loader for worker processes. It has to be a module level
+    function to be sent to them.
+
+    :param configuration: Geolocate configuration. Unused.
+    :type configuration: config.Configuration
+    :return: Stub database.
+    :rtype: StubGeoIPDatabase
+    """
+    return StubGeoIPDatabase()
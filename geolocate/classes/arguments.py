@@ -8,6 +8,7 @@
 import argparse
 import sys
 
+import geolocate.classes.compression as compression
 import geolocate.classes.config as config
 import geolocate.classes.parser as parser
 
@@ -23,7 +24,9 @@ MUST_PASS_IN_USER_ARGUMENTS = {"show_enabled_locators": False,
                                 "show_user": False,
                                 "show_password": False}
 # This arguments don't activate a function with their same name.
-NOT_CALLABLE_ARGUMENTS = {"verbosity", "text_to_parse", "stream_mode"}
+NOT_CALLABLE_ARGUMENTS = {"verbosity", "text_to_parse", "stream_mode",
+                          "show_statistics", "line_buffered", "jobs",
+                          "input_files", "output_compression"}
 
 
 def parse_arguments():
@@ -46,9 +49,35 @@ def parse_arguments():
                                       action="store_true", default=False,
                                       help="Program will analyze piped output "
                                            "from another program.")
+    data_input_arguments.add_argument("-f", "--file",
+                                      dest="input_files",
+                                      nargs="+", default=None,
+                                      help="Files to analyze. They may be "
+                                           "compressed with gzip, bzip2, xz "
+                                           "or zstd.",
+                                      metavar="PATH")
+    arg_parser.add_argument("-b", "--line_buffered", dest="line_buffered",
+                            action="store_true", default=False,
+                            help="Flush output after every line even if it "
+                                 "is not a terminal.")
+    arg_parser.add_argument("-j", "--jobs", dest="jobs",
+                            type=int, default=1,
+                            help="Parse streamed input in this many "
+                                 "processes. Output keeps input order.",
+                            metavar="N")
+    arg_parser.add_argument("-z", "--output_compression",
+                            dest="output_compression",
+                            choices=compression.COMPRESSION_FORMATS,
+                            default=None,
+                            help="Compress output. Compressed input files "
+                                 "are always detected and decompressed.")
     arg_parser.add_argument("-v", "--verbosity", dest="verbosity",
                             choices=verbosity_choices, type=int, default=0,
                             help="0-3 The higher the more geodata.")
+    arg_parser.add_argument("--stats", dest="show_statistics",
+                            action="store_true", default=False,
+                            help="Print lookup statistics to stderr when "
+                                 "parsing ends.")
     arg_parser.add_argument("-l", "--show_enabled",
                             dest="show_enabled_locators",
                             action="store_true", default=False,
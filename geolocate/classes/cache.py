@@ -0,0 +1,506 @@
+"""
+ Caches to avoid repeated geolocation queries.
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import bisect
+import collections
+import ipaddress
+import json
+import time
+
+import geolocate.classes.networks as networks
+
+# Returned by get() when a key is not cached. None can't be used for that
+# because it could be a legit cached value.
+MISSING = object()
+# Stored in cache for addresses no locator could find, so we don't query
+# locators again for them.
+NOT_FOUND = object()
+# Fraction of its size persistent cache is left at when it gets too big,
+# so it is not compacted again on every new entry.
+COMPACTION_LOW_WATER_MARK = 0.9
+
+
+class LocationCache(object):
+    """ Bounded cache with least recently used eviction policy.
+
+    Logs use to repeat the same addresses over and over again, so keeping
+    last located addresses at hand saves a lot of queries to locators.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: Maximum number of entries kept in cache.
+        :type size: int
+        """
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """ Get cached value for key and mark it as the most recently used.
+
+        :param key: Key to look for.
+        :type key: hashable
+        :return: Cached value or MISSING if key is not cached.
+        :rtype: object
+        """
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self._misses += 1
+            return MISSING
+        else:
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def add(self, key, value):
+        """ Store value in cache, evicting least recently used entry if cache
+        is full.
+
+        :param key: Key to store value with.
+        :type key: hashable
+        :param value: Value to store.
+        :type value: object
+        :return: None
+        """
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def invalidate(self, key=None):
+        """ Remove a key from cache, or every cached entry if no key is given.
+
+        :param key: Key to remove. If None whole cache is emptied.
+        :type key: hashable
+        :return: None
+        """
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def evictions(self):
+        return self._evictions
+
+
+class NetworkCache(object):
+    """ Bounded cache of values shared by every address of a network, with
+    least recently used eviction policy.
+
+    Geolocation databases give the same answer for every address of a
+    network block, so once an address is located any other one in its block
+    can be answered without querying locators. Networks are kept as sorted
+    integer ranges, so finding the one an address belongs to is a binary
+    search. Cached networks never overlap: adding a network removes any
+    cached one overlapping it.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: Maximum number of networks kept in cache.
+        :type size: int
+        """
+        self._size = size
+        # Sorted range starts for every IP version, to bisect them.
+        self._starts = {4: [], 6: []}
+        # (version, start) -> (end, value), in least recently used order.
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, ip):
+        """
+        :param ip: IP address.
+        :type ip: str
+        :return: True if a cached network has ip. Unlike get(), it doesn't
+        count as a use of that network.
+        :rtype: bool
+        """
+        try:
+            version, address = networks.address_to_integer(ip)
+        except (OSError, ValueError):
+            return False
+        starts = self._starts[version]
+        index = bisect.bisect_right(starts, address) - 1
+        return index >= 0 and \
+            address <= self._entries[(version, starts[index])][0]
+
+    def get(self, ip):
+        """ Get cached value for network ip belongs to, and mark that network
+        as the most recently used.
+
+        :param ip: IP address.
+        :type ip: str
+        :return: Cached value or MISSING if no cached network has ip.
+        :rtype: object
+        """
+        try:
+            version, address = networks.address_to_integer(ip)
+        except (OSError, ValueError):
+            self._misses += 1
+            return MISSING
+        starts = self._starts[version]
+        index = bisect.bisect_right(starts, address) - 1
+        if index >= 0:
+            key = (version, starts[index])
+            end, value = self._entries[key]
+            if address <= end:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return value
+        self._misses += 1
+        return MISSING
+
+    def add(self, network, value):
+        """ Store value for every address in network, evicting least
+        recently used network if cache is full.
+
+        :param network: Network in CIDR notation or as an ipaddress network.
+        :type network: str or ipaddress.IPv4Network or ipaddress.IPv6Network
+        :param value: Value to store.
+        :type value: object
+        :return: None
+        """
+        network = ipaddress.ip_network(network)
+        self._add_range(network.version, int(network.network_address),
+                        int(network.broadcast_address), value)
+
+    def add_prefix(self, ip, prefix_length, value):
+        """ Store value for every address in network of given prefix length
+        ip belongs to.
+
+        Cheaper than add() for callers which only know network prefix length.
+
+        :param ip: IP address.
+        :type ip: str
+        :param prefix_length: Length of network prefix.
+        :type prefix_length: int
+        :param value: Value to store.
+        :type value: object
+        :return: None
+        """
+        version, address = networks.address_to_integer(ip)
+        host_bits = networks.ADDRESS_BITS[version] - prefix_length
+        start = address >> host_bits << host_bits
+        self._add_range(version, start, start | ((1 << host_bits) - 1), value)
+
+    def _add_range(self, version, start, end, value):
+        """
+        :param version: IP version of range.
+        :type version: int
+        :param start: First address of range.
+        :type start: int
+        :param end: Last address of range.
+        :type end: int
+        :param value: Value to store.
+        :type value: object
+        :return: None
+        """
+        self._remove_overlapping(version, start, end)
+        bisect.insort(self._starts[version], start)
+        self._entries[(version, start)] = (end, value)
+        if len(self._entries) > self._size:
+            evicted_version, evicted_start = next(iter(self._entries))
+            self._remove(evicted_version, evicted_start)
+            self._evictions += 1
+
+    def _remove_overlapping(self, version, start, end):
+        """
+        :param version: IP version of range.
+        :type version: int
+        :param start: First address of range.
+        :type start: int
+        :param end: Last address of range.
+        :type end: int
+        :return: None
+        """
+        starts = self._starts[version]
+        index = bisect.bisect_right(starts, end) - 1
+        # Cached ranges don't overlap each other, so the ones overlapping
+        # this range are contiguous and end at index.
+        while index >= 0 and \
+                self._entries[(version, starts[index])][0] >= start:
+            self._remove(version, starts[index])
+            index -= 1
+
+    def _remove(self, version, start):
+        """
+        :param version: IP version of range to remove.
+        :type version: int
+        :param start: First address of range to remove.
+        :type start: int
+        :return: None
+        """
+        starts = self._starts[version]
+        del starts[bisect.bisect_left(starts, start)]
+        del self._entries[(version, start)]
+
+    def invalidate(self):
+        """ Remove every cached network.
+
+        :return: None
+        """
+        for starts in self._starts.values():
+            starts.clear()
+        self._entries.clear()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def evictions(self):
+        return self._evictions
+
+
+class PersistentNetworkCache(object):
+    """ Cache of values shared by every address of a network, kept in a
+    SQLite file so it outlives process.
+
+    Meant for answers too expensive to lose between runs, like paid
+    webservice queries. Values must be JSON serializable. Entries expire
+    after a time to live, and oldest ones are removed when there are more
+    than allowed. Several processes can share the same file, and several
+    caches can share it too as long as each one has its own table.
+
+    sqlite3 is slow to import, so it is only imported when this cache is
+    used.
+    """
+
+    def __init__(self, path, ttl, size, table="networks"):
+        """
+        :param path: Path to SQLite file. It is created if it doesn't exist.
+        :type path: str
+        :param ttl: Seconds entries are valid after being stored.
+        :type ttl: float
+        :param size: Maximum number of networks kept in cache.
+        :type size: int
+        :param table: Name of table entries are kept in. It is not escaped,
+        so it must be a plain identifier.
+        :type table: str
+        :raise: PersistentCacheError
+        """
+        import sqlite3
+        self._path = path
+        self._table = table
+        self._ttl = ttl
+        self._size = size
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        try:
+            self._connection = sqlite3.connect(path, timeout=10)
+            # Only takes effect on new files, but lets compact() give space
+            # back to filesystem without rewriting the whole file.
+            self._connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            # Readers in other processes are not blocked by writers.
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("PRAGMA synchronous = NORMAL")
+            with self._connection:
+                self._connection.execute(self._sql(
+                    "CREATE TABLE IF NOT EXISTS {table} ("
+                    "version INTEGER, start BLOB, end BLOB, stored REAL, "
+                    "value TEXT, PRIMARY KEY (version, start)) "
+                    "WITHOUT ROWID"))
+                self._connection.execute(self._sql(
+                    "CREATE INDEX IF NOT EXISTS {table}_stored "
+                    "ON {table} (stored)"))
+        except sqlite3.Error as e:
+            raise PersistentCacheError(path, e)
+        # Expired entries of previous runs are removed.
+        self.compact()
+
+    def __len__(self):
+        return self._entries
+
+    def _sql(self, statement):
+        """
+        :param statement: SQL statement with {table} placeholders.
+        :type statement: str
+        :return: Statement for table of this cache.
+        :rtype: str
+        """
+        return statement.format(table=self._table)
+
+    def get(self, ip):
+        """
+        :param ip: IP address.
+        :type ip: str
+        :return: Value cached for network ip belongs to, or MISSING if there
+        is none or it has expired.
+        :rtype: object
+        :raise: PersistentCacheError
+        """
+        import sqlite3
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            self._misses += 1
+            return MISSING
+        try:
+            row = self._connection.execute(self._sql(
+                "SELECT end, stored, value FROM {table} "
+                "WHERE version = ? AND start <= ? "
+                "ORDER BY start DESC LIMIT 1"),
+                (address.version, address.packed)).fetchone()
+        except sqlite3.Error as e:
+            raise PersistentCacheError(self._path, e)
+        if row is None or row[0] < address.packed or \
+                row[1] < time.time() - self._ttl:
+            self._misses += 1
+            return MISSING
+        self._hits += 1
+        return json.loads(row[2])
+
+    def add(self, network, value):
+        """ Store value for every address in network. Any cached network
+        overlapping it is removed. If cache gets too big it is compacted.
+
+        :param network: Network in CIDR notation or as an ipaddress network.
+        :type network: str or ipaddress.IPv4Network or ipaddress.IPv6Network
+        :param value: Value to store.
+        :type value: object
+        :return: None
+        :raise: PersistentCacheError
+        """
+        import sqlite3
+        network = ipaddress.ip_network(network)
+        version = network.version
+        start = network.network_address.packed
+        end = network.broadcast_address.packed
+        try:
+            with self._connection:
+                removed = self._connection.execute(self._sql(
+                    "DELETE FROM {table} "
+                    "WHERE version = ? AND start BETWEEN ? AND ?"),
+                    (version, start, end)).rowcount
+                # Cached networks don't overlap, so only the one before can
+                # overlap this one from its start.
+                previous = self._connection.execute(self._sql(
+                    "SELECT start, end FROM {table} "
+                    "WHERE version = ? AND start < ? "
+                    "ORDER BY start DESC LIMIT 1"), (version, start)).fetchone()
+                if previous is not None and previous[1] >= start:
+                    self._connection.execute(self._sql(
+                        "DELETE FROM {table} WHERE version = ? AND start = ?"),
+                        (version, previous[0]))
+                    removed += 1
+                self._connection.execute(self._sql(
+                    "INSERT INTO {table} VALUES (?, ?, ?, ?, ?)"),
+                    (version, start, end, time.time(), json.dumps(value)))
+        except sqlite3.Error as e:
+            raise PersistentCacheError(self._path, e)
+        self._entries += 1 - removed
+        if self._entries > self._size:
+            self.compact()
+
+    def compact(self):
+        """ Remove expired entries and, if there are more than allowed,
+        oldest ones until cache is down to COMPACTION_LOW_WATER_MARK of its
+        size. Then give freed space back to filesystem.
+
+        :return: None
+        :raise: PersistentCacheError
+        """
+        import sqlite3
+        try:
+            with self._connection:
+                self._connection.execute(self._sql(
+                    "DELETE FROM {table} WHERE stored < ?"),
+                    (time.time() - self._ttl,))
+                entries = self._connection.execute(self._sql(
+                    "SELECT COUNT(*) FROM {table}")).fetchone()[0]
+                if entries > self._size:
+                    low_water_mark = int(self._size *
+                                         COMPACTION_LOW_WATER_MARK)
+                    evicted = self._connection.execute(self._sql(
+                        "DELETE FROM {table} WHERE (version, start) IN ("
+                        "SELECT version, start FROM {table} "
+                        "ORDER BY stored LIMIT ?)"),
+                        (entries - low_water_mark,)).rowcount
+                    self._evictions += evicted
+                    entries -= evicted
+            self._connection.execute("PRAGMA incremental_vacuum")
+        except sqlite3.Error as e:
+            raise PersistentCacheError(self._path, e)
+        self._entries = entries
+
+    def close(self):
+        """
+        :return: None
+        """
+        self._connection.close()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def evictions(self):
+        return self._evictions
+
+
+class PersistentCacheError(Exception):
+    """ Persistent cache file can't be read or written."""
+
+    def __init__(self, path, error):
+        self.path = path
+        self.error = error
+        message = "Persistent cache {0} failed: {1}".format(path, error)
+        Exception.__init__(self, message)
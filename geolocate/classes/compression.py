@@ -0,0 +1,131 @@
+"""
+ Compressed input and output streams.
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import bz2
+import gzip
+import io
+import lzma
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional.
+    zstandard = None
+
+GZIP = "gzip"
+BZIP2 = "bz2"
+XZ = "xz"
+ZSTD = "zstd"
+COMPRESSION_FORMATS = (GZIP, BZIP2, XZ, ZSTD)
+# Files are recognized by their first bytes, not by their extension.
+_MAGIC_NUMBERS = {GZIP: b"\x1f\x8b",
+                  BZIP2: b"BZh",
+                  XZ: b"\xfd7zXZ\x00",
+                  ZSTD: b"\x28\xb5\x2f\xfd"}
+_MAGIC_NUMBER_MAX_LENGTH = max(len(magic_number)
+                               for magic_number in _MAGIC_NUMBERS.values())
+# Same default levels as command line tools.
+_COMPRESSION_LEVELS = {GZIP: 6, BZIP2: 9, XZ: 6, ZSTD: 3}
+
+
+def detect_compression(path):
+    """ Get compression format of a file from its magic number.
+
+    :param path: Path to file.
+    :type path: str
+    :return: Compression format, or None if file is not compressed.
+    :rtype: str
+    """
+    with open(path, "rb") as input_file:
+        header = input_file.read(_MAGIC_NUMBER_MAX_LENGTH)
+    for compression_format, magic_number in _MAGIC_NUMBERS.items():
+        if header.startswith(magic_number):
+            return compression_format
+    return None
+
+
+def open_decompressed(path, compression_format):
+    """ Open a compressed file to read it decompressed incrementally.
+
+    :param path: Path to compressed file.
+    :type path: str
+    :param compression_format: One of COMPRESSION_FORMATS, or None if file
+    is not compressed.
+    :type compression_format: str
+    :return: Binary stream with decompressed data.
+    :rtype: io.BufferedIOBase
+    :raises: CompressionNotSupported
+    """
+    if compression_format is None:
+        return open(path, "rb")
+    elif compression_format == GZIP:
+        return gzip.open(path, "rb")
+    elif compression_format == BZIP2:
+        return bz2.open(path, "rb")
+    elif compression_format == XZ:
+        return lzma.open(path, "rb")
+    elif compression_format == ZSTD:
+        _check_zstd_available()
+        # zstandard readers don't know how to read lines by themselves.
+        return io.BufferedReader(zstandard.open(path, "rb"))
+    else:
+        raise CompressionNotSupported(compression_format)
+
+
+def open_compressed(stream, compression_format):
+    """ Wrap a binary stream to compress everything written to it.
+
+    Closing returned stream finishes compressed data but leaves wrapped
+    stream open.
+
+    :param stream: Binary stream to write compressed data to.
+    :type stream: io.BufferedIOBase
+    :param compression_format: One of COMPRESSION_FORMATS.
+    :type compression_format: str
+    :return: Binary stream to write uncompressed data to.
+    :rtype: io.BufferedIOBase
+    :raises: CompressionNotSupported
+    """
+    level = _COMPRESSION_LEVELS.get(compression_format)
+    if compression_format == GZIP:
+        return gzip.GzipFile(fileobj=stream, mode="wb", compresslevel=level)
+    elif compression_format == BZIP2:
+        return bz2.BZ2File(stream, "wb", compresslevel=level)
+    elif compression_format == XZ:
+        return lzma.LZMAFile(stream, "wb", preset=level)
+    elif compression_format == ZSTD:
+        _check_zstd_available()
+        compressor = zstandard.ZstdCompressor(level=level)
+        return compressor.stream_writer(stream, closefd=False)
+    else:
+        raise CompressionNotSupported(compression_format)
+
+
+def _check_zstd_available():
+    """
+    :return: None
+    :raises: CompressionNotSupported if zstandard package is not installed.
+    """
+    if zstandard is None:
+        raise CompressionNotSupported(ZSTD, "zstandard package is not "
+                                            "installed")
+
+
+class CompressionNotSupported(Exception):
+    """ Compression format can't be read or written."""
+
+    def __init__(self, compression_format, reason="unknown format"):
+        self.compression_format = compression_format
+        message = "{0} compression not supported: {1}.".format(
+            compression_format, reason)
+        Exception.__init__(self, message)
+
+
+# Exceptions raised when a file can't be read, or when it is compressed but
+# its data is corrupted or truncated.
+READ_ERRORS = (OSError, EOFError, lzma.LZMAError, CompressionNotSupported)
+if zstandard is not None:
+    READ_ERRORS += (zstandard.ZstdError,)
@@ -11,8 +11,6 @@ import http.client as http
 import os
 import urllib.parse as urlparse
 
-import keyring
-
 
 CONFIG_ROOT = os.path.expanduser("~/.geolocate")
 CONFIG_FILE = "etc/geolocate.conf"
@@ -20,6 +18,14 @@ CONFIG_FILE_PATH = os.path.join(CONFIG_ROOT, CONFIG_FILE)
 GEOLOCATE_VAULT = "geolocate"
 DEFAULT_USER_ID = ""
 DEFAULT_LICENSE_KEY = ""
+# Webservice lookups running at once when many addresses are located
+# together. 1 looks for them one after another.
+DEFAULT_WEBSERVICE_CONCURRENCY = 8
+# Milliseconds a located address waits for webservice before being asked to
+# next locator. Answers arriving later are cached for next time, unless
+# disabled.
+DEFAULT_WEBSERVICE_DEADLINE = 2000
+DEFAULT_WEBSERVICE_CACHE_LATE_ANSWERS = True
 # TODO: For production I have to uncomment real url.
 # Only for tests I have to comment real download url. MaxMind has a rate limit
 # per day. If you exceed that limit you are forbidden for 24 hours to download
@@ -32,8 +38,35 @@ DEFAULT_DATABASE_DOWNLOAD_URL = "http://geolite.maxmind.com/download/geoip/datab
 DEFAULT_UPDATE_INTERVAL = 35
 DEFAULT_LOCAL_DATABASE_FOLDER = os.path.join(CONFIG_ROOT, "local_database/")
 DEFAULT_LOCAL_DATABASE_NAME = "GeoLite2-City.mmdb"
+# Optional database with only country data, placed by user in local database
+# folder. If there is one, it is used when city data is not needed, as its
+# records are smaller and faster to decode.
+DEFAULT_LOCAL_COUNTRY_DATABASE_NAME = "GeoLite2-Country.mmdb"
+# How local database file is opened. "auto" chooses depending on workload,
+# "mmap_ext" uses C extension over a memory map, "mmap" and "file" use pure
+# Python reader over a memory map or plain file reads and "memory" loads the
+# whole file in memory.
+LOCAL_DATABASE_MODES = ("auto", "mmap_ext", "mmap", "file", "memory")
+DEFAULT_LOCAL_DATABASE_MODE = "auto"
 # Remember add new locators here or locate won't use them.
 DEFAULT_LOCATORS_PREFERENCE = ["geoip2_webservice", "geoip2_local"]
+# If adaptive preference is enabled, locators whose 95th percentile of
+# latency, in milliseconds, goes over maximum or whose success rate, in
+# percentage, falls under minimum are asked after the others for a while.
+DEFAULT_ADAPTIVE_PREFERENCE = False
+DEFAULT_ADAPTIVE_MAX_LATENCY = 300
+DEFAULT_ADAPTIVE_MIN_SUCCESS_RATE = 90
+# Logs use to repeat the same few thousand addresses, so this should be enough
+# to answer most of them from memory.
+DEFAULT_CACHE_SIZE = 16384
+# Webservice answers are paid for, so they are kept on disk between runs.
+# Geolocation data changes slowly, so they are valid for a month.
+DEFAULT_PERSISTENT_CACHE_PATH = os.path.join(CONFIG_ROOT,
+                                             "cache/webservice.sqlite")
+DEFAULT_PERSISTENT_CACHE_TTL = 30
+DEFAULT_PERSISTENT_CACHE_SIZE = 100000
+# Appended to private and reserved addresses instead of locating them.
+DEFAULT_NON_ROUTABLE_TAG = "[private]"
 
 
 class Configuration(object):
@@ -53,18 +86,49 @@ class Configuration(object):
     """
     def __init__(self, user_id=DEFAULT_USER_ID,
                  license_key=DEFAULT_LICENSE_KEY,
+                 webservice_concurrency=DEFAULT_WEBSERVICE_CONCURRENCY,
+                 webservice_deadline=DEFAULT_WEBSERVICE_DEADLINE,
+                 webservice_cache_late_answers=
+                 DEFAULT_WEBSERVICE_CACHE_LATE_ANSWERS,
                  download_url=DEFAULT_DATABASE_DOWNLOAD_URL,
                  update_interval=DEFAULT_UPDATE_INTERVAL,
                  local_database_folder=DEFAULT_LOCAL_DATABASE_FOLDER,
                  local_database_name=DEFAULT_LOCAL_DATABASE_NAME,
-                 locators_preference=DEFAULT_LOCATORS_PREFERENCE):
+                 local_country_database_name=
+                 DEFAULT_LOCAL_COUNTRY_DATABASE_NAME,
+                 local_database_mode=DEFAULT_LOCAL_DATABASE_MODE,
+                 locators_preference=DEFAULT_LOCATORS_PREFERENCE,
+                 adaptive_preference=DEFAULT_ADAPTIVE_PREFERENCE,
+                 adaptive_max_latency=DEFAULT_ADAPTIVE_MAX_LATENCY,
+                 adaptive_min_success_rate=DEFAULT_ADAPTIVE_MIN_SUCCESS_RATE,
+                 cache_size=DEFAULT_CACHE_SIZE,
+                 persistent_cache_path=DEFAULT_PERSISTENT_CACHE_PATH,
+                 persistent_cache_ttl=DEFAULT_PERSISTENT_CACHE_TTL,
+                 persistent_cache_size=DEFAULT_PERSISTENT_CACHE_SIZE,
+                 non_routable_tag=DEFAULT_NON_ROUTABLE_TAG):
         self._webservice = {"user_id": user_id,
-                            "license_key": license_key}
+                            "license_key": license_key,
+                            "webservice_concurrency": webservice_concurrency,
+                            "webservice_deadline": webservice_deadline,
+                            "webservice_cache_late_answers":
+                                webservice_cache_late_answers}
         self._local_database = {"download_url": download_url,
                                 "update_interval": update_interval,
                                 "local_database_folder": local_database_folder,
-                                "local_database_name": local_database_name}
+                                "local_database_name": local_database_name,
+                                "local_country_database_name":
+                                    local_country_database_name,
+                                "local_database_mode": local_database_mode}
         self._locators_preference = locators_preference
+        self._adaptive_preference = {
+            "adaptive_preference": adaptive_preference,
+            "adaptive_max_latency": adaptive_max_latency,
+            "adaptive_min_success_rate": adaptive_min_success_rate}
+        self._cache = {"cache_size": cache_size,
+                       "persistent_cache_path": persistent_cache_path,
+                       "persistent_cache_ttl": persistent_cache_ttl,
+                       "persistent_cache_size": persistent_cache_size}
+        self._parser = {"non_routable_tag": non_routable_tag}
 
     @property
     def user_id(self):
@@ -84,6 +148,51 @@ class Configuration(object):
         _validate_value("license_key", license_key)
         self._webservice["license_key"] = license_key
 
+    @property
+    def webservice_concurrency(self):
+        """
+        :return: Maximum number of webservice lookups running at once.
+        :rtype: int
+        """
+        return self._webservice["webservice_concurrency"]
+
+    @webservice_concurrency.setter
+    def webservice_concurrency(self, concurrency):
+        concurrency_integer = _validate_integer("webservice_concurrency",
+                                                concurrency)
+        self._webservice["webservice_concurrency"] = concurrency_integer
+
+    @property
+    def webservice_deadline(self):
+        """
+        :return: Milliseconds to wait for webservice to locate an address
+        before asking next locator.
+        :rtype: int
+        """
+        return self._webservice["webservice_deadline"]
+
+    @webservice_deadline.setter
+    def webservice_deadline(self, deadline_in_milliseconds):
+        deadline_integer = _validate_integer("webservice_deadline",
+                                             deadline_in_milliseconds)
+        self._webservice["webservice_deadline"] = deadline_integer
+
+    @property
+    def webservice_cache_late_answers(self):
+        """
+        :return: True if webservice answers arriving after deadline are
+        cached for next time.
+        :rtype: bool
+        """
+        return self._webservice["webservice_cache_late_answers"]
+
+    @webservice_cache_late_answers.setter
+    def webservice_cache_late_answers(self, cache_late_answers):
+        cache_late_answers_boolean = _validate_boolean(
+            "webservice_cache_late_answers", cache_late_answers)
+        self._webservice["webservice_cache_late_answers"] = \
+            cache_late_answers_boolean
+
     @property
     def download_url(self):
         return self._local_database["download_url"]
@@ -123,12 +232,47 @@ class Configuration(object):
         # as a property in case I have an idea about a possible check.
         self._local_database["local_database_name"] = database_name
 
+    @property
+    def local_country_database_name(self):
+        """
+        :return: File name of optional country database.
+        :rtype: str
+        """
+        return self._local_database["local_country_database_name"]
+
+    @local_country_database_name.setter
+    def local_country_database_name(self, database_name):
+        self._local_database["local_country_database_name"] = database_name
+
+    @property
+    def local_database_mode(self):
+        """
+        :return: How local database file is opened. One of
+        LOCAL_DATABASE_MODES.
+        :rtype: str
+        """
+        return self._local_database["local_database_mode"]
+
+    @local_database_mode.setter
+    def local_database_mode(self, mode):
+        _validate_choice("local_database_mode", mode, LOCAL_DATABASE_MODES)
+        self._local_database["local_database_mode"] = mode
+
     @property
     def local_database_path(self):
         path = os.path.join(self.local_database_folder,
                             self.local_database_name)
         return path
 
+    @property
+    def local_country_database_path(self):
+        """
+        :return: Path to optional country database. It may not exist.
+        :rtype: str
+        """
+        return os.path.join(self.local_database_folder,
+                            self.local_country_database_name)
+
     @property
     def locators_preference(self):
         """
@@ -145,6 +289,116 @@ class Configuration(object):
         else:
             self._locators_preference = new_locator_list
 
+    @property
+    def adaptive_preference(self):
+        """
+        :return: True if locators preference order is adjusted to how
+        locators are behaving.
+        :rtype: bool
+        """
+        return self._adaptive_preference["adaptive_preference"]
+
+    @adaptive_preference.setter
+    def adaptive_preference(self, adaptive):
+        adaptive_boolean = _validate_boolean("adaptive_preference", adaptive)
+        self._adaptive_preference["adaptive_preference"] = adaptive_boolean
+
+    @property
+    def adaptive_max_latency(self):
+        """
+        :return: Milliseconds 95th percentile of a locator latency can take
+        before it is asked after the others.
+        :rtype: int
+        """
+        return self._adaptive_preference["adaptive_max_latency"]
+
+    @adaptive_max_latency.setter
+    def adaptive_max_latency(self, latency_in_milliseconds):
+        latency_integer = _validate_integer("adaptive_max_latency",
+                                            latency_in_milliseconds)
+        self._adaptive_preference["adaptive_max_latency"] = latency_integer
+
+    @property
+    def adaptive_min_success_rate(self):
+        """
+        :return: Percentage of lookups a locator must answer not to be asked
+        after the others.
+        :rtype: int
+        """
+        return self._adaptive_preference["adaptive_min_success_rate"]
+
+    @adaptive_min_success_rate.setter
+    def adaptive_min_success_rate(self, percentage):
+        percentage_integer = _validate_percentage("adaptive_min_success_rate",
+                                                  percentage)
+        self._adaptive_preference["adaptive_min_success_rate"] = \
+            percentage_integer
+
+    @property
+    def cache_size(self):
+        """
+        :return: Maximum number of located addresses kept in memory.
+        :rtype: int
+        """
+        return self._cache["cache_size"]
+
+    @cache_size.setter
+    def cache_size(self, cache_size):
+        size_integer = _validate_integer("cache_size", cache_size)
+        self._cache["cache_size"] = size_integer
+
+    @property
+    def persistent_cache_path(self):
+        """
+        :return: Path to file where webservice answers are kept between
+        runs.
+        :rtype: str
+        """
+        return self._cache["persistent_cache_path"]
+
+    @persistent_cache_path.setter
+    def persistent_cache_path(self, path):
+        self._cache["persistent_cache_path"] = path
+
+    @property
+    def persistent_cache_ttl(self):
+        """
+        :return: Days webservice answers are kept before asking again.
+        :rtype: int
+        """
+        return self._cache["persistent_cache_ttl"]
+
+    @persistent_cache_ttl.setter
+    def persistent_cache_ttl(self, ttl_in_days):
+        ttl_integer = _validate_integer("persistent_cache_ttl", ttl_in_days)
+        self._cache["persistent_cache_ttl"] = ttl_integer
+
+    @property
+    def persistent_cache_size(self):
+        """
+        :return: Maximum number of networks whose webservice answer is kept
+        between runs.
+        :rtype: int
+        """
+        return self._cache["persistent_cache_size"]
+
+    @persistent_cache_size.setter
+    def persistent_cache_size(self, cache_size):
+        size_integer = _validate_integer("persistent_cache_size", cache_size)
+        self._cache["persistent_cache_size"] = size_integer
+
+    @property
+    def non_routable_tag(self):
+        """
+        :return: Text appended to private and reserved addresses.
+        :rtype: str
+        """
+        return self._parser["non_routable_tag"]
+
+    @non_routable_tag.setter
+    def non_routable_tag(self, tag):
+        self._parser["non_routable_tag"] = tag
+
     # I make comparisons at tests so I need this functionality.
     # Great reference about custom classes equality at:
     #   https://stackoverflow.com/questions/390250/elegant-ways-to-support-equivalence-equality-in-python-classes
@@ -194,12 +448,18 @@ class Configuration(object):
         :rtype: dict
         """
         parsed_configuration = {
-            "webservice": {"user_id": self._webservice["user_id"]},
+            "webservice": {key: self._webservice[key]
+                           for key in self._webservice.keys()
+                           if key != "license_key"},
             "local_database": {key: self._local_database[key]
                                for key in self._local_database.keys()},
-            "locators_preference": {
-                "preference": ",".join(self._locators_preference)
-            }
+            "locators_preference": dict(
+                self._adaptive_preference,
+                preference=",".join(self._locators_preference)),
+            "cache": {key: self._cache[key]
+                      for key in self._cache.keys()},
+            "parser": {key: self._parser[key]
+                       for key in self._parser.keys()}
         }
         return parsed_configuration
 
@@ -285,6 +545,54 @@ def _validate_integer(parameter, value):
     return integer_value
 
 
+def _validate_percentage(parameter, value):
+    """
+    :param parameter: Attribute that is being validated.
+    :type parameter: str
+    :param value: Value integer o string.
+    :type value: int or str
+    :return: Value converted to an integer between 1 and 100.
+    :rtype: int
+    """
+    integer_value = _validate_integer(parameter, value)
+    if integer_value > 100:
+        raise ParameterNotValid(value, parameter, "Cannot be over 100.")
+    return integer_value
+
+
+def _validate_boolean(parameter, value):
+    """
+    :param parameter: Attribute that is being validated.
+    :type parameter: str
+    :param value: Value boolean or string, as written in config file.
+    :type value: bool or str
+    :return: Value converted to a boolean.
+    :rtype: bool
+    """
+    if isinstance(value, bool):
+        return value
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[str(value).lower()]
+    except KeyError:
+        raise ParameterNotValid(value, parameter, "Cannot convert to bool.")
+
+
+def _validate_choice(parameter, value, choices):
+    """
+    :param parameter: Attribute that is being validated.
+    :type parameter: str
+    :param value: Value to check.
+    :type value: str
+    :param choices: Allowed values.
+    :type choices: tuple
+    :return: None
+    """
+    if value not in choices:
+        raise ParameterNotValid(value, parameter,
+                                "Must be one of: {0}.".format(
+                                    ", ".join(choices)))
+
+
 def _text_has_spaces(text):
     """
     :param text:
@@ -327,14 +635,61 @@ def _read_config_file():
     except KeyError:  # Key may have not been set yet.
         license_Key = ""
     locators_preference = _string_to_list(configuration_parser["locators_preference"]["preference"])
+    local_database_mode = configuration_parser.get(
+        "local_database", "local_database_mode",
+        fallback=DEFAULT_LOCAL_DATABASE_MODE)
+    _validate_choice("local_database_mode", local_database_mode,
+                     LOCAL_DATABASE_MODES)
     configuration = Configuration(
         user_id=configuration_parser["webservice"]["user_id"],
         license_key=license_key,
+        webservice_concurrency=_validate_integer(
+            "webservice_concurrency", configuration_parser.getint(
+                "webservice", "webservice_concurrency",
+                fallback=DEFAULT_WEBSERVICE_CONCURRENCY)),
+        webservice_deadline=_validate_integer(
+            "webservice_deadline", configuration_parser.getint(
+                "webservice", "webservice_deadline",
+                fallback=DEFAULT_WEBSERVICE_DEADLINE)),
+        webservice_cache_late_answers=configuration_parser.getboolean(
+            "webservice", "webservice_cache_late_answers",
+            fallback=DEFAULT_WEBSERVICE_CACHE_LATE_ANSWERS),
         download_url=configuration_parser["local_database"]["download_url"],
         update_interval=int(configuration_parser["local_database"]["update_interval"]),
         local_database_folder=configuration_parser["local_database"]["local_database_folder"],
         local_database_name=configuration_parser["local_database"]["local_database_name"],
-        locators_preference=locators_preference
+        local_country_database_name=configuration_parser.get(
+            "local_database", "local_country_database_name",
+            fallback=DEFAULT_LOCAL_COUNTRY_DATABASE_NAME),
+        local_database_mode=local_database_mode,
+        locators_preference=locators_preference,
+        adaptive_preference=configuration_parser.getboolean(
+            "locators_preference", "adaptive_preference",
+            fallback=DEFAULT_ADAPTIVE_PREFERENCE),
+        adaptive_max_latency=_validate_integer(
+            "adaptive_max_latency", configuration_parser.getint(
+                "locators_preference", "adaptive_max_latency",
+                fallback=DEFAULT_ADAPTIVE_MAX_LATENCY)),
+        adaptive_min_success_rate=_validate_percentage(
+            "adaptive_min_success_rate", configuration_parser.getint(
+                "locators_preference", "adaptive_min_success_rate",
+                fallback=DEFAULT_ADAPTIVE_MIN_SUCCESS_RATE)),
+        cache_size=_validate_integer(
+            "cache_size", configuration_parser.getint(
+                "cache", "cache_size", fallback=DEFAULT_CACHE_SIZE)),
+        persistent_cache_path=configuration_parser.get(
+            "cache", "persistent_cache_path",
+            fallback=DEFAULT_PERSISTENT_CACHE_PATH),
+        persistent_cache_ttl=_validate_integer(
+            "persistent_cache_ttl", configuration_parser.getint(
+                "cache", "persistent_cache_ttl",
+                fallback=DEFAULT_PERSISTENT_CACHE_TTL)),
+        persistent_cache_size=_validate_integer(
+            "persistent_cache_size", configuration_parser.getint(
+                "cache", "persistent_cache_size",
+                fallback=DEFAULT_PERSISTENT_CACHE_SIZE)),
+        non_routable_tag=configuration_parser.get(
+            "parser", "non_routable_tag", fallback=DEFAULT_NON_ROUTABLE_TAG)
         )
     return configuration, license_key
 
@@ -422,6 +777,8 @@ def _save_password(username, password):
     :type password: str
     :return: None
     """
+    # keyring is slow to import and only needed for webservice credentials.
+    import keyring
     if not username.strip() == '':
         keyring.set_password(GEOLOCATE_VAULT, username, password)
 
@@ -433,6 +790,10 @@ def _load_password(username):
     :type username: str
     :return: None
     """
+    if username.strip() == '':
+        # Nothing saved for an unset user, so keyring is not even imported.
+        return DEFAULT_LICENSE_KEY
+    import keyring
     try:
         recovered_password = keyring.get_password(GEOLOCATE_VAULT, username)
     except RuntimeError as e:
@@ -450,6 +811,7 @@ def _delete_password(username):
     :type username: str
     :return: None
     """
+    import keyring
     keyring.delete_password(GEOLOCATE_VAULT, username)
 
 
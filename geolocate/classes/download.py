@@ -0,0 +1,371 @@
+"""
+ Conditional and resumable HTTP downloads.
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import datetime
+import http.client as http
+import json
+import os
+import re
+import shutil
+import urllib.error as error
+import urllib.parse as urlparse
+import urllib.request as request
+
+# Bytes read from the network and written to disk at once.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Seconds to wait for a server before giving up.
+TIMEOUT = 60
+USER_AGENT = "geolocate"
+# Checksum files are tiny. Anything bigger is not one.
+MAX_TEXT_SIZE = 64 * 1024
+_CONTENT_RANGE_REGEX = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+class Downloader(object):
+    """ Download a file only if it has changed since last time, resuming
+    interrupted transfers where they were left.
+
+    What is known about last download is kept in a JSON metadata file:
+    validators (ETag and Last-Modified) of last file used and of the one
+    being transferred, its size and when it was downloaded and checked.
+    Validators of a downloaded file are only used for conditional requests
+    after commit() is called, so a file that could not be used is
+    downloaded again next time.
+    """
+
+    def __init__(self, url, partial_path, metadata_path, timeout=TIMEOUT):
+        """
+        :param url: URL to download.
+        :type url: str
+        :param partial_path: Path to keep data of transfers not finished
+        yet. It must outlive process to resume transfers in later runs.
+        :type partial_path: str
+        :param metadata_path: Path to JSON metadata file.
+        :type metadata_path: str
+        :param timeout: Seconds to wait for server.
+        :type timeout: float
+        """
+        self._url = url
+        self._partial_path = partial_path
+        self._metadata_path = metadata_path
+        self._timeout = timeout
+        self._metadata = _load_metadata(metadata_path, url)
+        self._fetched = None
+
+    def reload_metadata(self):
+        """ Read metadata file again, as another process may have downloaded
+        or checked file since it was read.
+
+        :return: None
+        """
+        self._metadata = _load_metadata(self._metadata_path, self._url)
+
+    @property
+    def metadata(self):
+        """
+        :return: What is known about downloads from this URL.
+        :rtype: dict
+        """
+        return dict(self._metadata)
+
+    @property
+    def last_checked(self):
+        """
+        :return: When file from this URL was last known to be current,
+        either because it was downloaded and committed or because server
+        said it had not changed. None if it never was.
+        :rtype: datetime.datetime
+        """
+        checked = self._metadata.get("checked")
+        if checked is None:
+            return None
+        return datetime.datetime.fromisoformat(checked)
+
+    def fetch(self, folder, conditional=True):
+        """ Download file to folder unless it has not changed since last
+        committed download.
+
+        :param folder: Folder to place downloaded file in.
+        :type folder: str
+        :param conditional: If False, file is downloaded even if it has not
+        changed, e.g. because last downloaded file has been lost.
+        :type conditional: bool
+        :return: Path to downloaded file, or None if it has not changed.
+        :rtype: str
+        :raise: OSError if download fails. urllib.error.URLError and
+        urllib.error.HTTPError are OSError too.
+        :raise: DownloadIncomplete
+        """
+        offset = _get_file_size(self._partial_path)
+        partial_validator = self._get_partial_validator()
+        if partial_validator is None:
+            # Data of an unknown version can't be resumed.
+            offset = 0
+        headers = {"User-Agent": USER_AGENT}
+        if conditional:
+            headers.update(self._get_conditional_headers())
+        if offset:
+            headers["Range"] = "bytes={0}-".format(offset)
+            headers["If-Range"] = partial_validator
+        url_request = request.Request(self._url, headers=headers)
+        try:
+            response = request.urlopen(url_request, timeout=self._timeout)
+        except error.HTTPError as e:
+            if e.code == http.NOT_MODIFIED:
+                self._record_check()
+                return None
+            if e.code == http.REQUESTED_RANGE_NOT_SATISFIABLE and offset:
+                # Partial data is not valid any longer, start over.
+                _remove_file(self._partial_path)
+                return self.fetch(folder, conditional)
+            raise
+        with response:
+            return self._receive(response, folder, offset)
+
+    def _receive(self, response, folder, offset):
+        """ Write response body to partial file and move it to folder once
+        it is complete.
+
+        :param response: Server response.
+        :type response: http.client.HTTPResponse
+        :param folder: Folder to place downloaded file in.
+        :type folder: str
+        :param offset: Bytes already downloaded and asked for to be skipped.
+        :type offset: int
+        :return: Path to downloaded file.
+        :rtype: str
+        :raise: DownloadIncomplete
+        """
+        if response.status == http.PARTIAL_CONTENT:
+            try:
+                start, total_size = _parse_content_range(
+                    response.headers.get("Content-Range", ""))
+            except ValueError:
+                start, total_size = None, None
+            if start != offset:
+                raise DownloadIncomplete(self._url, offset, start)
+            mode = "ab"
+        else:
+            # Server sent whole file, because it can't resume or because
+            # file changed since partial data was downloaded.
+            offset = 0
+            total_size = _get_content_length(response)
+            mode = "wb"
+            self._metadata["partial"] = _get_validators(response)
+            self._save_metadata()
+        with open(self._partial_path, mode) as partial_file:
+            try:
+                shutil.copyfileobj(response, partial_file,
+                                   DOWNLOAD_CHUNK_SIZE)
+            except http.HTTPException:
+                # Connection closed before the end. Data received is kept
+                # to be resumed.
+                pass
+        size = _get_file_size(self._partial_path)
+        if total_size is not None and size != total_size:
+            raise DownloadIncomplete(self._url, total_size, size)
+        path = os.path.join(folder, _get_file_name(response, self._url))
+        shutil.move(self._partial_path, path)
+        self._fetched = dict(self._metadata.pop("partial", {}), size=size)
+        self._save_metadata()
+        return path
+
+    def commit(self):
+        """ Take last fetched file as the one to compare with in next
+        conditional requests. Call it once that file has been used.
+
+        :return: None
+        """
+        if self._fetched is None:
+            return
+        self._metadata.update(self._fetched)
+        self._fetched = None
+        self._record_check()
+        self._metadata["downloaded"] = self._metadata["checked"]
+        self._save_metadata()
+
+    def _get_conditional_headers(self):
+        """
+        :return: Headers asking server to send file only if it changed.
+        :rtype: dict
+        """
+        headers = {}
+        if self._metadata.get("etag"):
+            headers["If-None-Match"] = self._metadata["etag"]
+        if self._metadata.get("last_modified"):
+            headers["If-Modified-Since"] = self._metadata["last_modified"]
+        return headers
+
+    def _get_partial_validator(self):
+        """
+        :return: Validator of partially downloaded file, to ask server to
+        resume it only if file has not changed. None if there is none.
+        :rtype: str
+        """
+        partial = self._metadata.get("partial", {})
+        # Weak ETags can't be used in If-Range.
+        etag = partial.get("etag")
+        if etag and not etag.startswith("W/"):
+            return etag
+        return partial.get("last_modified")
+
+    def _record_check(self):
+        """
+        :return: None
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self._metadata["checked"] = now.isoformat(timespec="seconds")
+        self._save_metadata()
+
+    def _save_metadata(self):
+        """ Write metadata file atomically, so an interrupted write doesn't
+        leave it corrupted.
+
+        :return: None
+        """
+        temporary_path = "".join([self._metadata_path, ".tmp"])
+        with open(temporary_path, "w") as metadata_file:
+            json.dump(self._metadata, metadata_file, indent=4, sort_keys=True)
+        os.replace(temporary_path, self._metadata_path)
+
+
+def read_url(url, timeout=TIMEOUT, max_size=MAX_TEXT_SIZE):
+    """ Download a small text file, like a checksum one.
+
+    :param url: URL to download.
+    :type url: str
+    :param timeout: Seconds to wait for server.
+    :type timeout: float
+    :param max_size: Maximum size of file.
+    :type max_size: int
+    :return: File content.
+    :rtype: str
+    :raise: OSError if download fails.
+    :raise: ValueError if file is bigger than max_size or it is not text.
+    """
+    url_request = request.Request(url, headers={"User-Agent": USER_AGENT})
+    with request.urlopen(url_request, timeout=timeout) as response:
+        content = response.read(max_size + 1)
+    if len(content) > max_size:
+        raise ValueError("{0} is bigger than {1} bytes.".format(url,
+                                                                max_size))
+    return content.decode("utf-8")
+
+
+def _load_metadata(metadata_path, url):
+    """
+    :param metadata_path: Path to JSON metadata file.
+    :type metadata_path: str
+    :param url: URL metadata must be about.
+    :type url: str
+    :return: Metadata saved about downloads from url, or only url if there
+    is none or it is about another URL.
+    :rtype: dict
+    """
+    try:
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+    except (OSError, ValueError):
+        metadata = {}
+    if not isinstance(metadata, dict) or metadata.get("url") != url:
+        metadata = {"url": url}
+    return metadata
+
+
+def _get_validators(response):
+    """
+    :param response: Server response.
+    :type response: http.client.HTTPResponse
+    :return: ETag and Last-Modified headers of response.
+    :rtype: dict
+    """
+    return {"etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified")}
+
+
+def _get_content_length(response):
+    """
+    :param response: Server response.
+    :type response: http.client.HTTPResponse
+    :return: Body size, or None if server didn't tell it.
+    :rtype: int
+    """
+    try:
+        return int(response.headers.get("Content-Length"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_content_range(content_range):
+    """
+    :param content_range: Content-Range header of a partial response.
+    :type content_range: str
+    :return: First byte sent and whole file size, or None as size if server
+    didn't tell it.
+    :rtype: tuple
+    :raise: ValueError if header is not valid.
+    """
+    match = _CONTENT_RANGE_REGEX.fullmatch(content_range.strip())
+    if match is None:
+        raise ValueError("Not valid Content-Range: {0}".format(content_range))
+    start, _, total_size = match.groups()
+    total_size = None if total_size == "*" else int(total_size)
+    return int(start), total_size
+
+
+def _get_file_name(response, url):
+    """
+    :param response: Server response.
+    :type response: http.client.HTTPResponse
+    :param url: URL downloaded.
+    :type url: str
+    :return: File name given by server, or last part of URL path if server
+    gave none.
+    :rtype: str
+    """
+    file_name = response.headers.get_filename()
+    if not file_name:
+        file_name = urlparse.unquote(urlparse.urlparse(url).path)
+    # Never let server choose where file is written.
+    return os.path.basename(file_name) or "download"
+
+
+def _get_file_size(path):
+    """
+    :param path: Path to file.
+    :type path: str
+    :return: File size, or 0 if file does not exist.
+    :rtype: int
+    """
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _remove_file(path):
+    """
+    :param path: Path to file.
+    :type path: str
+    :return: None
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class DownloadIncomplete(OSError):
+    """ Server sent less data than expected or not the data asked for."""
+
+    def __init__(self, url, expected, received):
+        self.url = url
+        self.expected = expected
+        self.received = received
+        message = "Download of {0} is incomplete: expected {1} but got " \
+                  "{2}.".format(url, expected, received)
+        OSError.__init__(self, message)
@@ -6,43 +6,175 @@
  email: dante.signal31@gmail.com
 """
 import abc
+import collections
 import datetime
-import gzip
+import functools
+import hashlib
+import ipaddress
+import math
 import os
 import shutil
 # import subprocess
+import sys
 import tempfile
+import threading
+import time
+import zlib
 import geoip2.database as database
-import geoip2.webservice as webservice
+import geoip2.errors as errors
+import geoip2.models as models
 import maxminddb
-import wget
 
+try:
+    import maxminddb.extension
+except ImportError:  # Some platforms only have pure Python reader.
+    _C_EXTENSION_AVAILABLE = False
+else:
+    _C_EXTENSION_AVAILABLE = True
 
+import geolocate.classes.cache as cache
 import geolocate.classes.config as config
+import geolocate.classes.download as download
 import geolocate.classes.exceptions as exceptions
+import geolocate.classes.health as health
+import geolocate.classes.system as system
 
 DEFAULT_DATABASE_FILE_EXTENSION = "mmdb"
+# Downloaded database is read and decompressed in pieces of this size at
+# most, so memory used doesn't grow with database size.
+DECOMPRESSION_CHUNK_SIZE = 1024 * 1024
+# Published checksum of downloaded file is looked for at download URL with
+# this suffix appended. With Maxmind permalinks, suffix parameter is the
+# last one, so this gives the checksum permalink too.
+CHECKSUM_FILE_SUFFIX = ".sha256"
+# Suffixes appended to local database path to get where an unfinished
+# download and metadata about last download are kept.
+PARTIAL_DOWNLOAD_SUFFIX = ".download.part"
+DOWNLOAD_METADATA_SUFFIX = ".download.json"
+# Suffix appended to local database path to get the lock file every process
+# must hold to download a new database.
+UPDATE_LOCK_SUFFIX = ".lock"
+# Seconds a process without local database waits for another one to finish
+# downloading it.
+UPDATE_LOCK_TIMEOUT = 600
+# zlib window bits value to read gzip headers and trailers.
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
 GEOIP2_WEBSERVICE_TAG = "geoip2_webservice"
 GEOIP2_LOCAL_TAG = "geoip2_local"
+# Detail levels for locate(). Every level includes fields of lower ones. They
+# match parser verbosity levels.
+DETAIL_CONTINENT = 0
+DETAIL_COUNTRY = 1
+DETAIL_CITY = 2
+DETAIL_COORDINATES = 3
+# Webservice endpoints. Country one is cheaper, and enough up to
+# DETAIL_COUNTRY. Their answers are cached in different tables, as country
+# answers lack city data.
+WEBSERVICE_CITY = "city"
+WEBSERVICE_COUNTRY = "country"
+_PERSISTENT_CACHE_TABLES = {WEBSERVICE_CITY: "networks",
+                            WEBSERVICE_COUNTRY: "country_networks"}
+# maxminddb reader modes for every configured local database mode but "auto".
+_DATABASE_MODES = {"mmap_ext": maxminddb.MODE_MMAP_EXT,
+                   "mmap": maxminddb.MODE_MMAP,
+                   "file": maxminddb.MODE_FILE,
+                   "memory": maxminddb.MODE_MEMORY}
+# What is going to be parsed, as a hint to choose local database mode.
+# input_size is None when it is unknown, like for streams.
+Workload = collections.namedtuple("Workload", "input_size workers")
+UNKNOWN_WORKLOAD = Workload(None, 1)
+# Names are taken in the same language geoip2 models use by default.
+_LOCALE = "en"
+
+# Lightweight records returned by local database when a detail level is
+# requested. They have the same attributes than geoip2.models.City for the
+# fields they carry, so both can be used the same way.
+LocationRecord = collections.namedtuple("LocationRecord",
+                                        "continent country city location "
+                                        "traits")
+NameRecord = collections.namedtuple("NameRecord", "name")
+CoordinatesRecord = collections.namedtuple("CoordinatesRecord",
+                                           "latitude longitude")
+
+
+class TraitsRecord(collections.namedtuple("TraitsRecord",
+                                          "ip_address prefix_len")):
+    __slots__ = ()
+
+    @property
+    def network(self):
+        """ Built only when asked for, as geoip2 models do, because it is
+        more expensive than the whole database lookup.
+
+        :return: Network record belongs to.
+        :rtype: ipaddress.IPv4Network or ipaddress.IPv6Network
+        """
+        return ipaddress.ip_network((self.ip_address, self.prefix_len),
+                                    strict=False)
+
+
+# Kept by GeoIPDatabase.prefetch() for addresses webservice failed to
+# locate.
+_WEBSERVICE_FAILED = object()
+_UNKNOWN_NAME = NameRecord(None)
+_UNKNOWN_COORDINATES = CoordinatesRecord(None, None)
 
 
-def load_geoip_database(configuration=None):
-    return GeoIPDatabase(configuration)
+def load_geoip_database(configuration=None, workload=UNKNOWN_WORKLOAD):
+    return GeoIPDatabase(configuration, workload)
 
 
 class GeoIPDatabase(object):
     """ Location engines may have multiple query methods. This class
     encapsulates them all in _locators list.
+
+    Locators are created the first time they are needed, so commands that
+    don't locate anything don't pay for database checks, downloads or
+    webservice clients.
     """
-    def __init__(self, configuration):
+    def __init__(self, configuration, workload=UNKNOWN_WORKLOAD):
         """
         :param configuration: Geolocate configuration.
         :type configuration: config.Configuration
+        :param workload: What is going to be located, to open local database
+        the best way for it.
+        :type workload: Workload
         """
         self._configuration = configuration
+        self._workload = workload
+        # Factories of enabled locators, and locators already created.
+        self._locator_factories = {}
         self._locators = {}
         self._add_locators()
         self._locators_preference = configuration.locators_preference
+        self._cache = cache.LocationCache(configuration.cache_size)
+        # Records with different detail can't be mixed, so every detail
+        # level gets its own network cache.
+        self._network_caches = {}
+        # Webservice answers kept between runs, by endpoint. They are opened
+        # the first time webservice is going to be queried.
+        self._persistent_caches = {}
+        self._persistent_cache_enabled = True
+        # Webservice answers got by prefetch(), waiting to be located, by
+        # address and detail.
+        self._prefetched = {}
+        # Health of every locator asked, to skip failing ones.
+        self._circuit_breakers = {}
+        # Webservice lookups that missed their deadline, appended by
+        # executor threads once they finish, to be cached from this one.
+        self._late_lookups = collections.deque()
+        self._deadline_misses = 0
+        self._late_answers_cached = 0
+        # Locators preference adjusted to how locators behave, if enabled.
+        self._adaptive_order = None
+        if configuration.adaptive_preference:
+            self._adaptive_order = health.AdaptiveOrder(
+                configuration.adaptive_max_latency / 1000,
+                configuration.adaptive_min_success_rate / 100,
+                log=_print_ordering_decision)
+        # Local database generation cached locations come from.
+        self._local_database_generation = 0
+        self._local_database_reloads = 0
 
     def _add_locators(self):
         """ Add query methods for this location engine.
@@ -70,15 +202,41 @@ class GeoIPDatabase(object):
         :return: None
         """
         if self._web_service_access_configured():
-            webservice_locator = WebServiceGeoLocator(self._configuration)
-            self._locators[GEOIP2_WEBSERVICE_TAG] = webservice_locator
+            self._locator_factories[GEOIP2_WEBSERVICE_TAG] = \
+                functools.partial(WebServiceGeoLocator, self._configuration)
 
     def _add_local_database_locator(self):
         """
         :return: None
         """
-        local_db_locator = LocalDatabaseGeoLocator(self._configuration)
-        self._locators[GEOIP2_LOCAL_TAG] = local_db_locator
+        self._locator_factories[GEOIP2_LOCAL_TAG] = functools.partial(
+            LocalDatabaseGeoLocator, self._configuration, self._workload)
+
+    def _locator_enabled(self, locator_id):
+        """
+        :param locator_id: Locator tag.
+        :type locator_id: str
+        :return: True if that locator is enabled, False if not.
+        :rtype: bool
+        """
+        return locator_id in self._locators or \
+            locator_id in self._locator_factories
+
+    def _get_locator(self, locator_id):
+        """ Get locator, creating it if this is the first time it is needed.
+
+        :param locator_id: Locator tag.
+        :type locator_id: str
+        :return: Locator.
+        :rtype: GeoLocator
+        :raises: KeyError if locator is not enabled.
+        """
+        try:
+            return self._locators[locator_id]
+        except KeyError:
+            locator = self._locator_factories[locator_id]()
+            self._locators[locator_id] = locator
+            return locator
 
     @property
     def geoip2_webservice(self):
@@ -87,37 +245,532 @@ class GeoIPDatabase(object):
         :rtype: WebServiceGeoLocator
         :raises: GeoIP2WebServiceNotConfigured
         """
-        try:
-            return self._locators[GEOIP2_WEBSERVICE_TAG]
-        except KeyError:
+        if not self._locator_enabled(GEOIP2_WEBSERVICE_TAG):
             raise GeoIP2WebServiceNotConfigured()
+        return self._get_locator(GEOIP2_WEBSERVICE_TAG)
 
     @property
     def geoip2_local(self):
-        return self._locators[GEOIP2_LOCAL_TAG]
+        return self._get_locator(GEOIP2_LOCAL_TAG)
+
+    def open_local_database(self):
+        """ Create local database locator now, if it is in locators
+        preference, instead of waiting for first lookup.
+
+        Creating it checks database freshness and downloads a new one if
+        needed. Doing it here before starting worker processes lets that
+        happen only once, and then workers just open updated file.
+
+        :return: None
+        """
+        if GEOIP2_LOCAL_TAG in self._locators_preference:
+            self._get_locator(GEOIP2_LOCAL_TAG)
+
+    def locate(self, ip, detail=None):
+        """ Look for geodata in caches and query locators only if address
+        has not been located yet.
+
+        Addresses no locator could find are cached too, so they are not
+        queried again. Geodata is cached for the whole network it was found
+        for as well, so other addresses in that network are not queried
+        either. Beware that geodata got that way keeps the traits.ip_address
+        of the first address located in its network.
+
+        :param ip: IP address to look for.
+        :type ip: IP address string.
+        :param detail: One of DETAIL_* levels, to get a lightweight record
+        with only the fields up to that level if locator can make it. None
+        to get a complete geoip2 model.
+        :type detail: int
+        :return: Location data for that address.
+        :rtype: geoip2.models.City or LocationRecord
+        :raises: exceptions.IPNotFound
+        """
+        if self._late_lookups:
+            self._cache_late_answers()
+        key = (ip, detail)
+        geodata = self._cache.get(key)
+        if geodata is cache.MISSING:
+            network_cache = self._get_network_cache(detail)
+            geodata = network_cache.get(ip)
+            if geodata is cache.MISSING:
+                try:
+                    geodata = self._query_locators(ip, detail)
+                except exceptions.IPNotFound:
+                    self._cache.add(key, cache.NOT_FOUND)
+                    raise
+                self._add_to_network_cache(network_cache, ip, geodata)
+            self._cache.add(key, geodata)
+        elif geodata is cache.NOT_FOUND:
+            raise exceptions.IPNotFound(ip)
+        return geodata
 
-    def locate(self, ip):
+    def _get_network_cache(self, detail):
+        """
+        :param detail: Detail level of records to cache.
+        :type detail: int
+        :return: Network cache for that detail level.
+        :rtype: cache.NetworkCache
+        """
+        try:
+            return self._network_caches[detail]
+        except KeyError:
+            network_cache = cache.NetworkCache(self._configuration.cache_size)
+            self._network_caches[detail] = network_cache
+            return network_cache
+
+    @staticmethod
+    def _add_to_network_cache(network_cache, ip, geodata):
+        """ Cache geodata for the network it was found for.
+
+        :param network_cache: Cache to store geodata in.
+        :type network_cache: cache.NetworkCache
+        :param ip: IP address geodata was found for.
+        :type ip: str
+        :param geodata: Location data for that address.
+        :type geodata: geoip2.models.City or LocationRecord
+        :return: None
+        """
+        traits = getattr(geodata, "traits", None)
+        if isinstance(traits, TraitsRecord):
+            network_cache.add_prefix(traits.ip_address, traits.prefix_len,
+                                     geodata)
+            return
+        # Only geoip2 releases from 4.0 on tell the network of records.
+        network = getattr(traits, "network", None)
+        if network is None:
+            return
+        try:
+            network = ipaddress.ip_network(network)
+            if ipaddress.ip_address(ip) not in network:
+                return
+        except (TypeError, ValueError):
+            return
+        network_cache.add(network, geodata)
+
+    def _query_locators(self, ip, detail=None):
         """ Query enabled locators in preference order until getting any
         geodata.
 
         :param ip: IP address to look for.
         :type ip: IP address string.
+        :param detail: Detail level requested, or None for complete models.
+        :type detail: int
         :return: Location data for that address.
-        :rtype: geoip2.models.City
+        :rtype: geoip2.models.City or LocationRecord
+        :raises: exceptions.IPNotFound
         """
-        for locator_id in self._locators_preference:
-            # TODO: Try to disable webservice to see if this is really working.
+        for locator_id in self.locators_order:
+            if not self._locator_enabled(locator_id):
+                continue
+            if locator_id == GEOIP2_WEBSERVICE_TAG:
+                # Already got by prefetch() or paid for in a previous run.
+                geodata = self._prefetched.pop((ip, detail), cache.MISSING)
+                if geodata is cache.MISSING:
+                    geodata = self._get_from_persistent_cache(ip, detail)
+                if geodata is _WEBSERVICE_FAILED:
+                    continue
+                if geodata is not cache.MISSING:
+                    break
+            # Errors creating a locator are configuration or installation
+            # problems, so they are not taken as addresses not found. They
+            # are raised before asking breaker, so they can't leave it half
+            # open waiting for a probe that never ends.
+            locator = self._get_locator(locator_id)
+            circuit_breaker = self._get_circuit_breaker(locator_id)
+            if not circuit_breaker.allow_request():
+                # Locator has been failing, so it is not worth waiting for.
+                continue
+            start = time.monotonic()
             try:
-                locator = self._locators[locator_id]
-                geodata = locator.locate(ip)
-            except:
+                geodata = locator.locate(ip, detail)
+            except LookupDeadlineExceeded as e:
+                circuit_breaker.record_failure(health.FAILURE_TIMEOUT)
+                self._keep_late_lookup(ip, detail, e.lookup)
+                continue
+            except Exception as e:
+                kind = health.classify_failure(e)
+                circuit_breaker.record_failure(kind)
+                self._record_latency(locator_id, start,
+                                     kind == health.FAILURE_NOT_FOUND)
                 continue
             else:
+                circuit_breaker.record_success()
+                self._record_latency(locator_id, start, True)
+                if locator_id == GEOIP2_WEBSERVICE_TAG:
+                    self._add_to_persistent_cache(ip, detail, geodata)
                 break
         else:
             raise exceptions.IPNotFound(ip)
         return geodata
 
+    @property
+    def prefetching(self):
+        """
+        :return: True if locating many addresses at once with prefetch()
+        pays off, because first locator asked is webservice and it can be
+        queried concurrently.
+        :rtype: bool
+        """
+        if self._configuration.webservice_concurrency <= 1:
+            return False
+        for locator_id in self.locators_order:
+            if self._locator_enabled(locator_id):
+                return locator_id == GEOIP2_WEBSERVICE_TAG
+        return False
+
+    def prefetch(self, ips, detail=None):
+        """ Look at once for addresses about to be located, so webservice is
+        queried for them concurrently instead of one after another.
+
+        Answers are kept until those addresses are located with locate(),
+        so they are located in whatever order caller needs. Addresses
+        already cached are not looked for again.
+
+        :param ips: Valid IP addresses, in canonical form.
+        :type ips: iterable
+        :param detail: Detail level they are going to be located with.
+        :type detail: int
+        :return: None
+        """
+        if not self.prefetching:
+            return
+        circuit_breaker = self._get_circuit_breaker(GEOIP2_WEBSERVICE_TAG)
+        if circuit_breaker.state != health.CLOSED:
+            # Addresses are asked one by one until webservice recovers.
+            return
+        # Answers not located since last prefetch are not needed any longer.
+        self._prefetched.clear()
+        network_cache = self._get_network_cache(detail)
+        pending_ips = []
+        for ip in dict.fromkeys(ips):
+            if (ip, detail) in self._cache or ip in network_cache:
+                continue
+            geodata = self._get_from_persistent_cache(ip, detail)
+            if geodata is cache.MISSING:
+                pending_ips.append(ip)
+            else:
+                self._prefetched[(ip, detail)] = geodata
+        if not pending_ips:
+            return
+        locator = self._get_locator(GEOIP2_WEBSERVICE_TAG)
+        lookups = [(ip, locator.submit(ip, detail)) for ip in pending_ips]
+        # Every lookup gets its deadline, but only as many of them as
+        # threads run at once.
+        rounds = math.ceil(len(lookups) /
+                           self._configuration.webservice_concurrency)
+        locator.wait_all([lookup for _, lookup in lookups],
+                         locator.deadline * rounds)
+        for ip, lookup in lookups:
+            if not lookup.done():
+                circuit_breaker.record_failure(health.FAILURE_TIMEOUT)
+                self._keep_late_lookup(ip, detail, lookup)
+                self._prefetched[(ip, detail)] = _WEBSERVICE_FAILED
+                continue
+            try:
+                geodata = lookup.result()
+            except Exception as e:
+                circuit_breaker.record_failure(health.classify_failure(e))
+                # Next locators will be asked for it when it is located.
+                self._prefetched[(ip, detail)] = _WEBSERVICE_FAILED
+            else:
+                circuit_breaker.record_success()
+                # Cache is only written from this thread.
+                self._add_to_persistent_cache(ip, detail, geodata)
+                self._prefetched[(ip, detail)] = geodata
+
+    @property
+    def locators_order(self):
+        """
+        :return: Locator tags in the order they are asked now. It is
+        configured preference unless adaptive preference has demoted any.
+        :rtype: list
+        """
+        if self._adaptive_order is None:
+            return self._locators_preference
+        if GEOIP2_WEBSERVICE_TAG in self._locators:
+            # Webservice lookups are timed in executor threads.
+            for latency, success in \
+                    self._locators[GEOIP2_WEBSERVICE_TAG].pop_latencies():
+                self._adaptive_order.record(GEOIP2_WEBSERVICE_TAG, latency,
+                                            success)
+        return self._adaptive_order.order(self._locators_preference)
+
+    def _record_latency(self, locator_id, start, success):
+        """ Time a lookup for adaptive preference.
+
+        :param locator_id: Locator tag.
+        :type locator_id: str
+        :param start: time.monotonic() when lookup started.
+        :type start: float
+        :param success: False if locator failed.
+        :type success: bool
+        :return: None
+        """
+        if self._adaptive_order is None or \
+                locator_id == GEOIP2_WEBSERVICE_TAG:
+            return
+        self._adaptive_order.record(locator_id, time.monotonic() - start,
+                                    success)
+
+    @property
+    def ordering_decisions(self):
+        """
+        :return: Every health.Decision adaptive preference has taken, oldest
+        first.
+        :rtype: list
+        """
+        if self._adaptive_order is None:
+            return []
+        return self._adaptive_order.decisions
+
+    def _keep_late_lookup(self, ip, detail, lookup):
+        """ Take note of a webservice lookup that missed its deadline, to
+        cache its answer once it arrives.
+
+        :param ip: IP address looked up.
+        :type ip: str
+        :param detail: Detail level it was looked up with.
+        :type detail: int
+        :param lookup: Lookup still running.
+        :type lookup: concurrent.futures.Future
+        :return: None
+        """
+        self._deadline_misses += 1
+        if not self._configuration.webservice_cache_late_answers:
+            return
+        # Callback runs in executor thread. Persistent cache can only be
+        # used from the thread that opened it, so answer is only queued.
+        lookup.add_done_callback(
+            lambda finished_lookup: self._late_lookups.append(
+                (ip, detail, finished_lookup)))
+
+    def _cache_late_answers(self):
+        """ Keep for next time answers of webservice lookups that missed
+        their deadline and have finished since.
+
+        :return: None
+        """
+        while self._late_lookups:
+            ip, detail, lookup = self._late_lookups.popleft()
+            try:
+                geodata = lookup.result()
+            except Exception:
+                continue
+            self._add_to_persistent_cache(ip, detail, geodata)
+            self._late_answers_cached += 1
+
+    def _get_circuit_breaker(self, locator_id):
+        """
+        :param locator_id: Locator tag.
+        :type locator_id: str
+        :return: Health state of that locator.
+        :rtype: health.CircuitBreaker
+        """
+        try:
+            return self._circuit_breakers[locator_id]
+        except KeyError:
+            circuit_breaker = health.CircuitBreaker()
+            self._circuit_breakers[locator_id] = circuit_breaker
+            return circuit_breaker
+
+    @property
+    def health(self):
+        """
+        :return: Health state of every locator asked so far, by locator tag.
+        :rtype: dict
+        """
+        return dict(self._circuit_breakers)
+
+    def _get_persistent_cache(self, endpoint):
+        """ Get cache of webservice answers, opening it if this is the first
+        time it is needed.
+
+        :param endpoint: WEBSERVICE_CITY or WEBSERVICE_COUNTRY.
+        :type endpoint: str
+        :return: Persistent cache for answers of that endpoint, or None if it
+        can't be used.
+        :rtype: cache.PersistentNetworkCache
+        """
+        persistent_cache = self._persistent_caches.get(endpoint)
+        if persistent_cache is None and self._persistent_cache_enabled:
+            path = self._configuration.persistent_cache_path
+            ttl = datetime.timedelta(
+                days=self._configuration.persistent_cache_ttl)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                persistent_cache = cache.PersistentNetworkCache(
+                    path, ttl.total_seconds(),
+                    self._configuration.persistent_cache_size,
+                    _PERSISTENT_CACHE_TABLES[endpoint])
+            except (OSError, cache.PersistentCacheError) as e:
+                self._disable_persistent_cache(e)
+            else:
+                self._persistent_caches[endpoint] = persistent_cache
+        return persistent_cache
+
+    def _disable_persistent_cache(self, error):
+        """ Go on without persistent cache, as it is only a way to save
+        webservice queries.
+
+        :param error: Why cache can't be used.
+        :type error: Exception
+        :return: None
+        """
+        print("Webservice answers won't be cached: {0}".format(error),
+              file=sys.stderr)
+        self._persistent_caches = {}
+        self._persistent_cache_enabled = False
+
+    def _get_from_persistent_cache(self, ip, detail):
+        """
+        :param ip: IP address to look for.
+        :type ip: str
+        :param detail: Detail level requested, or None for complete models.
+        :type detail: int
+        :return: Webservice answer cached for network ip belongs to, or
+        cache.MISSING if there is none. Answers of city endpoint are used
+        for detail levels country endpoint is enough for too.
+        :rtype: geoip2.models.Country or geoip2.models.City
+        """
+        endpoints = [WEBSERVICE_CITY]
+        if _get_webservice_endpoint(detail) == WEBSERVICE_COUNTRY:
+            endpoints.insert(0, WEBSERVICE_COUNTRY)
+        for endpoint in endpoints:
+            persistent_cache = self._get_persistent_cache(endpoint)
+            if persistent_cache is None:
+                return cache.MISSING
+            try:
+                raw_model = persistent_cache.get(ip)
+            except cache.PersistentCacheError as e:
+                self._disable_persistent_cache(e)
+                return cache.MISSING
+            if raw_model is not cache.MISSING:
+                break
+        else:
+            return cache.MISSING
+        # Answer is the one for the address first asked for in its network.
+        raw_model.setdefault("traits", {})["ip_address"] = ip
+        return _build_model(raw_model, endpoint)
+
+    def _add_to_persistent_cache(self, ip, detail, geodata):
+        """ Keep webservice answer for the whole network it was given for,
+        or only for ip if webservice didn't tell it.
+
+        :param ip: IP address geodata was got for.
+        :type ip: str
+        :param detail: Detail level geodata was got for.
+        :type detail: int
+        :param geodata: Webservice answer.
+        :type geodata: geoip2.models.Country or geoip2.models.City
+        :return: None
+        """
+        persistent_cache = self._get_persistent_cache(
+            _get_webservice_endpoint(detail))
+        if persistent_cache is None:
+            return
+        try:
+            network = ipaddress.ip_network(geodata.traits.network)
+        except (AttributeError, TypeError, ValueError):
+            network = ipaddress.ip_network(ip)
+        try:
+            persistent_cache.add(network, _get_raw_model(geodata))
+        except cache.PersistentCacheError as e:
+            self._disable_persistent_cache(e)
+
+    def reload_if_changed(self):
+        """ Let local database start using its file again if it has been
+        replaced, and forget cached locations if local database data has
+        changed since they were cached, by this or by a background refresh.
+
+        :return: True if cached locations were forgotten, False if not.
+        :rtype: bool
+        """
+        # A locator not created yet has not located anything to forget.
+        local_locator = self._locators.get(GEOIP2_LOCAL_TAG)
+        if local_locator is None:
+            return False
+        local_locator.reload_if_changed()
+        if local_locator.generation == self._local_database_generation:
+            return False
+        self._local_database_generation = local_locator.generation
+        self._local_database_reloads += 1
+        self.invalidate_cache()
+        return True
+
+    def invalidate_cache(self):
+        """ Forget every cached location, so next queries go to locators
+        again. Useful when locators data has been refreshed.
+
+        :return: None
+        """
+        self._cache.invalidate()
+        for network_cache in self._network_caches.values():
+            network_cache.invalidate()
+
+    @property
+    def statistics(self):
+        """
+        :return: Counters about this database usage, keyed by name.
+        :rtype: collections.OrderedDict
+        """
+        statistics = collections.OrderedDict()
+        if GEOIP2_LOCAL_TAG in self._locators:
+            statistics["local_database_mode"] = \
+                self._locators[GEOIP2_LOCAL_TAG].database_mode
+            statistics["local_country_database"] = \
+                self._locators[GEOIP2_LOCAL_TAG].country_database_used
+            statistics["local_database_reloads"] = \
+                self._local_database_reloads
+        persistent_caches = self._persistent_caches.values()
+        if persistent_caches:
+            statistics["webservice_cache_entries"] = sum(
+                len(persistent_cache) for persistent_cache in persistent_caches)
+            statistics["webservice_queries_saved"] = sum(
+                persistent_cache.hits for persistent_cache in persistent_caches)
+            statistics["webservice_cache_evictions"] = sum(
+                persistent_cache.evictions
+                for persistent_cache in persistent_caches)
+        if GEOIP2_WEBSERVICE_TAG in self._locators:
+            statistics["webservice_coalesced_lookups"] = \
+                self._locators[GEOIP2_WEBSERVICE_TAG].coalesced_lookups
+            statistics["webservice_deadline_misses"] = self._deadline_misses
+            statistics["webservice_late_answers_cached"] = \
+                self._late_answers_cached
+        if self._adaptive_order is not None:
+            statistics["locators_order"] = ",".join(self.locators_order)
+            statistics["locators_demotions"] = sum(
+                decision.action == health.DEMOTED
+                for decision in self._adaptive_order.decisions)
+            for locator_id in self._circuit_breakers:
+                tracker = self._adaptive_order.get_tracker(locator_id)
+                if tracker.samples:
+                    statistics["{0}_latency_p95".format(locator_id)] = \
+                        tracker.p95
+                    statistics["{0}_success_rate".format(locator_id)] = \
+                        tracker.success_rate
+        for locator_id, circuit_breaker in self._circuit_breakers.items():
+            statistics["{0}_state".format(locator_id)] = circuit_breaker.state
+            statistics["{0}_trips".format(locator_id)] = circuit_breaker.trips
+            for kind, failures in circuit_breaker.failures.items():
+                statistics["{0}_{1}_failures".format(locator_id, kind)] = \
+                    failures
+        statistics["cache_size"] = self._cache.size
+        statistics["cache_entries"] = len(self._cache)
+        statistics["cache_hits"] = self._cache.hits
+        statistics["cache_misses"] = self._cache.misses
+        statistics["cache_evictions"] = self._cache.evictions
+        network_caches = self._network_caches.values()
+        statistics["network_cache_entries"] = sum(
+            len(network_cache) for network_cache in network_caches)
+        statistics["network_cache_hits"] = sum(
+            network_cache.hits for network_cache in network_caches)
+        statistics["network_cache_misses"] = sum(
+            network_cache.misses for network_cache in network_caches)
+        statistics["network_cache_evictions"] = sum(
+            network_cache.evictions for network_cache in network_caches)
+        return statistics
+
 
 class GeoLocator(metaclass=abc.ABCMeta):
     @abc.abstractmethod
@@ -125,11 +778,14 @@ class GeoLocator(metaclass=abc.ABCMeta):
         self._configuration = configuration
         self._db_connection = None
 
-    def locate(self, ip):
+    def locate(self, ip, detail=None):
         """ Get geolocation data from database.
 
         :param ip: IP address we are asking about.
         :type ip: str
+        :param detail: Detail level needed. This locator always returns
+        complete models.
+        :type detail: int
         :raises: geoip2.errors.AddressNotFoundError
         :return: Geolocation data.
         :rtype: geoip2.models.City
@@ -139,38 +795,473 @@ class GeoLocator(metaclass=abc.ABCMeta):
 
 
 class WebServiceGeoLocator(GeoLocator):
+    """ Locator asking GeoIP2 webservice.
+
+    Besides one by one lookups with locate(), lookups can be submitted to
+    run concurrently in a pool of threads. Every thread has its own client,
+    so its keep-alive connection is reused for every lookup it runs. A
+    lookup asked for an address already being looked up waits for that one
+    instead of querying webservice again.
+
+    Country endpoint is queried instead of city one when detail asked for
+    doesn't need city data, as its queries are cheaper.
+
+    No lookup is waited for longer than configured deadline. Lookups that
+    miss it keep running, so their answers can still be used later.
+    """
     def __init__(self, configuration):
         """
         :param configuration: Geolocate configuration.
         :type configuration: config.Configuration
         :return: None
         """
+        # Imported here because they are slow to import and most runs don't
+        # have webservice configured.
+        import concurrent.futures as futures
+        import geoip2.webservice as webservice
         super().__init__(configuration)
-        self._db_connection = webservice.Client(configuration.user_id,
-                                                configuration.license_key)
+        self._futures = futures
+        self._client_class = webservice.Client
+        self._db_connection = self._create_client()
+        self._deadline = configuration.webservice_deadline / 1000
+        # Threads are only started when lookups are submitted.
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=configuration.webservice_concurrency,
+            thread_name_prefix="geolocate-webservice")
+        self._thread_data = threading.local()
+        # Futures of submitted lookups not finished yet, by address and
+        # endpoint.
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._coalesced_lookups = 0
+        # Latency and success of latest queries, appended by executor
+        # threads.
+        self._latencies = collections.deque(
+            maxlen=health.DEFAULT_LATENCY_WINDOW)
+
+    def _create_client(self):
+        """
+        :return: New webservice client, with its own connection pool.
+        :rtype: geoip2.webservice.Client
+        """
+        return self._client_class(self._configuration.user_id,
+                                  self._configuration.license_key)
+
+    def locate(self, ip, detail=None):
+        """ Get geolocation data from webservice, or from lookup already
+        running for that address.
+
+        :param ip: IP address we are asking about.
+        :type ip: str
+        :param detail: Detail level needed, or None for complete models.
+        :type detail: int
+        :raises: geoip2.errors.GeoIP2Error
+        :raises: LookupDeadlineExceeded
+        :return: Geolocation data.
+        :rtype: geoip2.models.Country or geoip2.models.City
+        """
+        return self.wait(ip, self.submit(ip, detail), self._deadline)
+
+    def wait(self, ip, lookup, timeout):
+        """ Wait for a submitted lookup to finish.
+
+        :param ip: IP address looked up.
+        :type ip: str
+        :param lookup: Future returned by submit() for that address.
+        :type lookup: concurrent.futures.Future
+        :param timeout: Maximum seconds to wait.
+        :type timeout: float
+        :raises: geoip2.errors.GeoIP2Error
+        :raises: LookupDeadlineExceeded
+        :return: Geolocation data.
+        :rtype: geoip2.models.Country or geoip2.models.City
+        """
+        try:
+            return lookup.result(timeout)
+        except self._futures.TimeoutError:
+            raise LookupDeadlineExceeded(ip, self._deadline, lookup)
+
+    def wait_all(self, lookups, timeout):
+        """ Wait for many submitted lookups at once.
+
+        :param lookups: Futures returned by submit().
+        :type lookups: iterable
+        :param timeout: Maximum seconds to wait.
+        :type timeout: float
+        :return: None
+        """
+        self._futures.wait(lookups, timeout)
+
+    @property
+    def deadline(self):
+        """
+        :return: Seconds to wait for a lookup before giving up on it.
+        :rtype: float
+        """
+        return self._deadline
+
+    def submit(self, ip, detail=None):
+        """ Start looking for an address in background.
+
+        :param ip: IP address we are asking about.
+        :type ip: str
+        :param detail: Detail level needed, or None for complete models.
+        :type detail: int
+        :return: Future of lookup, whose result is geolocation data.
+        :rtype: concurrent.futures.Future
+        """
+        key = (ip, _get_webservice_endpoint(detail))
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._coalesced_lookups += 1
+                return future
+            future = self._executor.submit(self._locate_in_thread, *key)
+            self._in_flight[key] = future
+        future.add_done_callback(functools.partial(self._forget_lookup, key))
+        return future
+
+    def _locate_in_thread(self, ip, endpoint):
+        """ Look for an address with client of current thread.
+
+        :param ip: IP address we are asking about.
+        :type ip: str
+        :param endpoint: WEBSERVICE_CITY or WEBSERVICE_COUNTRY.
+        :type endpoint: str
+        :return: Geolocation data.
+        :rtype: geoip2.models.Country or geoip2.models.City
+        """
+        client = getattr(self._thread_data, "client", None)
+        if client is None:
+            # Clients share no state, so threads don't wait for each other.
+            client = self._thread_data.client = self._create_client()
+        start = time.monotonic()
+        try:
+            # Client methods are named after endpoints.
+            geodata = getattr(client, endpoint)(ip)
+        except Exception as e:
+            self._latencies.append(
+                (time.monotonic() - start,
+                 health.classify_failure(e) == health.FAILURE_NOT_FOUND))
+            raise
+        self._latencies.append((time.monotonic() - start, True))
+        return geodata
+
+    def pop_latencies(self):
+        """ Get latency of queries finished since last call.
+
+        Queries are timed in the thread that runs them, so time waiting for
+        a free thread is not counted, but the whole time of queries whose
+        callers stopped waiting at their deadline is.
+
+        :return: Seconds every query took and whether it was answered, even
+        if as address not found.
+        :rtype: list
+        """
+        latencies = []
+        while self._latencies:
+            latencies.append(self._latencies.popleft())
+        return latencies
+
+    def _forget_lookup(self, key, future):
+        """
+        :param key: IP address looked up and endpoint asked.
+        :type key: tuple
+        :param future: Finished lookup.
+        :type future: concurrent.futures.Future
+        :return: None
+        """
+        with self._in_flight_lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    @property
+    def coalesced_lookups(self):
+        """
+        :return: Lookups that waited for another one of the same address
+        instead of querying webservice.
+        :rtype: int
+        """
+        return self._coalesced_lookups
 
 
 class LocalDatabaseGeoLocator(GeoLocator):
-    def __init__(self, configuration):
+    def __init__(self, configuration, workload=UNKNOWN_WORKLOAD):
         """
         :param configuration: Geolocate configuration.
         :type configuration: config.Configuration
+        :param workload: What is going to be located, used to choose how to
+        open database if configured mode is "auto".
+        :type workload: Workload
         :return: none
         :raise: LocalDatabaseNotFound
         :raise: InvalidLocalDatabase
+        :raise: LocalDatabaseModeNotAvailable
+        :raise: UpdateLockTimeout
         """
         super().__init__(configuration)
-        self._update_db()
+        self._refresh_thread = None
+        # Serializes readers replacement between background refresh and
+        # reloads asked for by GeoIPDatabase.
+        self._open_lock = threading.Lock()
+        self._database_signature = None
+        # Reader of optional country database, if there is one.
+        self._raw_country_db_connection = None
+        self._generation = -1
         db_path = configuration.local_database_path
-        self._db_connection = _open_local_database(db_path)
+        self._downloader = download.Downloader(
+            configuration.download_url,
+            "".join([db_path, PARTIAL_DOWNLOAD_SUFFIX]),
+            "".join([db_path, DOWNLOAD_METADATA_SUFFIX]))
+        self._update_lock = system.FileLock(
+            "".join([db_path, UPDATE_LOCK_SUFFIX]))
+        if not os.path.exists(db_path):
+            self._download_missing_database()
+        self._database_mode = _select_database_mode(
+            configuration.local_database_mode, workload, db_path)
+        self._open_database()
+        self._update_db()
+
+    def _open_database(self):
+        """ Open database file and start using it for new lookups.
+
+        Lookups already running keep the reader they started with, so a
+        reader can be replaced while other threads are using it.
+
+        :return: None
+        :raise: LocalDatabaseNotFound
+        :raise: InvalidLocalDatabase
+        :raise: LocalDatabaseModeNotAvailable
+        """
+        db_path = self._configuration.local_database_path
+        with self._open_lock:
+            # Taken before opening, so a file replaced meanwhile is detected
+            # as changed in next check instead of being missed.
+            signature = self._get_database_signature()
+            db_connection = _open_local_database(db_path, self._database_mode)
+            raw_country_db_connection = self._open_country_database()
+            # geoip2 readers wrap a maxminddb one. Sharing it for raw
+            # records avoids having database twice in memory when loaded in
+            # memory.
+            self._raw_db_connection = db_connection._db_reader
+            self._db_connection = db_connection
+            self._raw_country_db_connection = raw_country_db_connection
+            self._database_signature = signature
+            self._generation += 1
+
+    def _open_country_database(self):
+        """ Open optional country database, if user has placed one.
+
+        It only makes lookups cheaper, so if it can't be opened city
+        database is used instead.
+
+        :return: Reader of country database, or None if there is none.
+        :rtype: maxminddb.Reader
+        """
+        country_db_path = self._configuration.local_country_database_path
+        if not os.path.exists(country_db_path):
+            return None
+        try:
+            country_db_connection = _open_local_database(country_db_path,
+                                                         self._database_mode)
+        except (LocalDatabaseNotFound, InvalidLocalDatabase) as e:
+            print("Country database won't be used: {0}".format(e),
+                  file=sys.stderr)
+            return None
+        return country_db_connection._db_reader
+
+    def _get_database_signature(self):
+        """
+        :return: Signatures of database file and of country database file.
+        Any of them is None if file doesn't exist.
+        :rtype: tuple
+        """
+        return (_get_file_signature(self._configuration.local_database_path),
+                _get_file_signature(
+                    self._configuration.local_country_database_path))
+
+    @property
+    def generation(self):
+        """
+        :return: Number of times database has been opened again since
+        first time. It changes whenever located data may have changed.
+        :rtype: int
+        """
+        return self._generation
+
+    def reload_if_changed(self):
+        """ Open database file again if it has been replaced or modified
+        since it was opened, i.e. by a refresh done by another process.
+
+        A file that can't be opened is reported and ignored until it
+        changes again, as it may still be being written. Current database is
+        used meanwhile.
+
+        :return: True if database was opened again, False if not.
+        :rtype: bool
+        """
+        if self.refreshing:
+            # Database will be opened again when refresh finishes.
+            return False
+        signature = self._get_database_signature()
+        if signature[0] is None or signature == self._database_signature:
+            return False
+        try:
+            self._open_database()
+        except (LocalDatabaseNotFound, InvalidLocalDatabase) as e:
+            print("Could not reload local database: {0}".format(e),
+                  file=sys.stderr)
+            self._database_signature = signature
+            return False
+        return True
+
+    @property
+    def country_database_used(self):
+        """
+        :return: True if a country database is used for lookups not needing
+        city data.
+        :rtype: bool
+        """
+        return self._raw_country_db_connection is not None
+
+    @property
+    def database_mode(self):
+        """
+        :return: Mode local database was opened with. If configured mode was
+        "auto" this is the one chosen.
+        :rtype: str
+        """
+        return self._database_mode
+
+    def locate(self, ip, detail=None):
+        """ Get geolocation data from database.
+
+        Building a geoip2 model decodes every localized name, subdivision and
+        trait of the record. When a detail level is given, raw record is
+        read instead and only the fields up to that level are taken. Up to
+        DETAIL_COUNTRY, record is read from country database if there is
+        one, as its records are smaller.
+
+        :param ip: IP address we are asking about.
+        :type ip: str
+        :param detail: One of DETAIL_* levels, or None to get a complete
+        geoip2 model.
+        :type detail: int
+        :raises: geoip2.errors.AddressNotFoundError
+        :return: Geolocation data.
+        :rtype: geoip2.models.City or LocationRecord
+        """
+        if detail is None:
+            return super().locate(ip)
+        raw_db_connection = self._raw_db_connection
+        if detail <= DETAIL_COUNTRY and \
+                self._raw_country_db_connection is not None:
+            raw_db_connection = self._raw_country_db_connection
+        record, prefix_length = raw_db_connection.get_with_prefix_len(ip)
+        if record is None:
+            raise errors.AddressNotFoundError(
+                "The address {0} is not in the database.".format(ip))
+        return _get_location_record(record, detail,
+                                    TraitsRecord(ip, prefix_length))
 
     def _update_db(self):
-        """ Download a fresh geolocation database if current is too old.
+        """ Download a fresh geolocation database in background if current
+        is too old. Current one is used until the fresh one is ready.
+
+        Refresh thread is not a daemon one, so program doesn't exit until
+        refresh is complete, but it can write its output meanwhile.
 
         :return: None
         """
-        if self._local_database_too_old():
-            self._download_fresh_database()
+        if self._local_database_too_old() and not self.refreshing:
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_database,
+                name="geolocate-database-refresh")
+            self._refresh_thread.start()
+
+    def _download_missing_database(self):
+        """ Download database when there is none yet.
+
+        There is nothing to use meanwhile, so it blocks. If another process
+        is already downloading it, this one waits for it to finish instead
+        of downloading it again.
+
+        :return: None
+        :raise: UpdateLockTimeout
+        """
+        if not self._acquire_update_lock(UPDATE_LOCK_TIMEOUT):
+            raise UpdateLockTimeout(self._update_lock.path, UPDATE_LOCK_TIMEOUT)
+        try:
+            if not os.path.exists(self._configuration.local_database_path):
+                self._download_fresh_database()
+        finally:
+            self._update_lock.release()
+
+    def _refresh_database(self):
+        """ Download a fresh database, replace current one with it and start
+        using it. Errors are reported but not raised, as lookups can go on
+        with current database.
+
+        Only one process refreshes database at a time. If another one is
+        already doing it, current database is used until next run.
+
+        :return: None
+        """
+        try:
+            if not self._acquire_update_lock(timeout=0):
+                return
+            try:
+                if not self._local_database_too_old():
+                    # Another process refreshed it before lock was acquired.
+                    if self._database_signature != \
+                            self._get_database_signature():
+                        self._open_database()
+                elif self._download_fresh_database():
+                    self._open_database()
+            finally:
+                self._update_lock.release()
+        except Exception as e:
+            print("Could not refresh local database: {0}".format(e),
+                  file=sys.stderr)
+
+    def _acquire_update_lock(self, timeout):
+        """ Get lock every process must hold to download a new database.
+
+        What is known about last download is read again once it is held, as
+        the process that held it before may have changed it.
+
+        :param timeout: Seconds to wait for lock, 0 to try only once.
+        :type timeout: float
+        :return: True if lock was acquired, False if timeout elapsed before.
+        :rtype: bool
+        """
+        os.makedirs(self._configuration.local_database_folder, exist_ok=True)
+        if not self._update_lock.acquire(timeout):
+            return False
+        self._downloader.reload_metadata()
+        return True
+
+    @property
+    def refreshing(self):
+        """
+        :return: True if a database refresh is running in background.
+        :rtype: bool
+        """
+        return self._refresh_thread is not None and \
+            self._refresh_thread.is_alive()
+
+    def wait_for_refresh(self, timeout=None):
+        """ Block until background database refresh, if any, finishes.
+
+        :param timeout: Maximum seconds to wait, or None to wait as long as
+        needed.
+        :type timeout: float
+        :return: True if no refresh is running any longer.
+        :rtype: bool
+        """
+        if self._refresh_thread is not None:
+            self._refresh_thread.join(timeout)
+        return not self.refreshing
 
     def _local_database_too_old(self):
         """
@@ -184,6 +1275,12 @@ class LocalDatabaseGeoLocator(GeoLocator):
         except LocalDatabaseNotFound:
             return True  # This should force a database download.
         else:
+            # Server may have said database had not changed after it was
+            # written.
+            last_checked = self._downloader.last_checked
+            if last_checked is not None:
+                last_modification = max(last_modification,
+                                        last_checked.astimezone().date())
             today_date = datetime.date.today()
             allowed_age = datetime.timedelta(days=update_interval)
             return _must_be_updated(today_date, last_modification, allowed_age)
@@ -192,72 +1289,105 @@ class LocalDatabaseGeoLocator(GeoLocator):
         """ Download compressed database, decompress it and place it instead
         old one.
 
-        :return: None
+        Messages go to stderr, not to be mixed with parsed output.
+
+        :return: True if a new database was placed, False if not.
+        :rtype: bool
         """
         with tempfile.TemporaryDirectory() as temporary_directory:
-            print("Downloading fresh geolocation database...")
-            self._download_file(temporary_directory)
+            print("Looking for a fresh geolocation database...",
+                  file=sys.stderr)
+            if not self._download_file(temporary_directory):
+                # Current database is still the latest one.
+                return False
+            expected_checksum = self._download_checksum()
             try:
-                _decompress_file(temporary_directory)
+                _decompress_file(temporary_directory, expected_checksum)
             except CompressedFileNotFound as e:
                 _print_compressed_file_not_found_error(e)
+                return False
             else:
                 self._write_new_database(temporary_directory)
+                self._downloader.commit()
+                return True
 
     def _download_file(self, temporal_directory):
-        """
+        """ Download database, unless it is the same as the local one.
+
+        Server is asked to send it only if it has changed since it was last
+        downloaded. A download interrupted before is resumed.
+
         :param temporal_directory: Folder path to place downloaded file in.
         :type temporal_directory: str
-        :return: None
-        """
-        wget.download(url=self._configuration.download_url,
-                      out=temporal_directory)
-
-    def _remove_old_database(self):
-        """
-        :return: None
+        :return: True if database was downloaded, False if it has not changed.
+        :rtype: bool
         """
         database_path = self._configuration.local_database_path
-        os.remove(database_path)
+        # Unfinished downloads are kept there to resume them in later runs.
+        os.makedirs(os.path.dirname(database_path), exist_ok=True)
+        # If local database is missing, it must be downloaded even if it has
+        # not changed.
+        downloaded_path = self._downloader.fetch(
+            temporal_directory, conditional=os.path.exists(database_path))
+        return downloaded_path is not None
+
+    def _download_checksum(self):
+        """ Get published SHA-256 checksum of downloaded database file.
+
+        :return: Checksum in hexadecimal, or None if no checksum is published
+        or it can't be read.
+        :rtype: str
+        """
+        checksum_url = "".join([self._configuration.download_url,
+                                CHECKSUM_FILE_SUFFIX])
+        try:
+            return _parse_checksum(download.read_url(checksum_url))
+        except (OSError, ValueError):
+            return None
 
     def _write_new_database(self, temporary_directory):
-        """
+        """ Replace current database with new one in a single step, so there
+        is always a complete database file at its path.
+
+        New database is copied next to current one and verified before
+        being renamed over it. Processes that already have current database
+        open keep reading it until they open the new one.
+
         :param temporary_directory: Folder path to place downloaded file in.
         :type temporal_directory: str
         :return: None
-        """
-        try:
-            self._remove_old_database()
-        except FileNotFoundError:
-            print("\nOld local database not found. May be this is the "
-                  "first time you run geolocate?.")
-        self._copy_new_database(temporary_directory)
-
-    def _copy_new_database(self, decompressed_file_path):
-        """
-        :param decompressed_file_path: Folder where new database is placed.
-        :type decompressed_file_path: str
-        :return: None
+        :raise: InvalidLocalDatabase
         """
         database_path = self._configuration.local_database_path
-        new_database_path = _get_new_database_path_name(decompressed_file_path)
+        new_database_path = _get_new_database_path_name(temporary_directory)
+        database_folder = os.path.dirname(database_path)
+        os.makedirs(database_folder, exist_ok=True)
+        # Renaming is only atomic inside the same filesystem.
+        file_descriptor, partial_database_path = tempfile.mkstemp(
+            prefix=os.path.basename(database_path), suffix=".part",
+            dir=database_folder)
+        os.close(file_descriptor)
         try:
-            shutil.copyfile(new_database_path, database_path)
-        except FileNotFoundError as e:  # Local database folder does exist yet?
-            if config.DEFAULT_LOCAL_DATABASE_FOLDER in e.filename:
-                os.makedirs(config.DEFAULT_LOCAL_DATABASE_FOLDER)
-                self._copy_new_database(decompressed_file_path)
-            else:
-                raise e
+            shutil.copyfile(new_database_path, partial_database_path)
+            _verify_database(partial_database_path)
+            os.replace(partial_database_path, database_path)
+        except BaseException:
+            os.remove(partial_database_path)
+            raise
 
 
-def _decompress_file(temporary_directory):
+def _decompress_file(temporary_directory, expected_checksum=None):
     """ Decompress tar.gz file found in temporary_directory.
 
     :param temporary_directory: Folder path to compressed file.
     :type temporary_directory: str
+    :param expected_checksum: SHA-256 checksum in hexadecimal compressed file
+    must have, or None to not check it.
+    :type expected_checksum: str
     :return: Path to decompressed folder.
     :rtype: str
+    :raise: ChecksumMismatch
+    :raise: EOFError if compressed file is truncated.
     """
     try:
         compressed_file_name_path = _find_compressed_file(temporary_directory)
@@ -265,13 +1395,73 @@ def _decompress_file(temporary_directory):
     except CompressedFileNotFound as e:
         _print_compressed_file_not_found_error(e)
     else:
-        with gzip.open(compressed_file_name_path, "rb") as input_file, \
-                open(uncompressed_file_name_path, "wb") as output_file:
-            uncompressed_content = input_file.read()
-            output_file.write(uncompressed_content)
+        checksum = _decompress_gzip_file(compressed_file_name_path,
+                                         uncompressed_file_name_path)
+        if expected_checksum is not None and \
+                checksum != expected_checksum.lower():
+            raise ChecksumMismatch(compressed_file_name_path,
+                                   expected_checksum, checksum)
         return compressed_file_name_path
 
 
+def _decompress_gzip_file(compressed_file_path, uncompressed_file_path):
+    """ Decompress a gzip file a chunk at a time, computing its checksum in
+    the same pass.
+
+    Neither compressed data read nor decompressed data written at once are
+    bigger than DECOMPRESSION_CHUNK_SIZE.
+
+    :param compressed_file_path: Path to gzip file.
+    :type compressed_file_path: str
+    :param uncompressed_file_path: Path to write decompressed data to.
+    :type uncompressed_file_path: str
+    :return: SHA-256 checksum of compressed file in hexadecimal.
+    :rtype: str
+    :raise: EOFError if compressed file is truncated.
+    """
+    checksum = hashlib.sha256()
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    with open(compressed_file_path, "rb") as input_file, \
+            open(uncompressed_file_path, "wb") as output_file:
+        for compressed_data in iter(functools.partial(
+                input_file.read, DECOMPRESSION_CHUNK_SIZE), b""):
+            checksum.update(compressed_data)
+            while compressed_data:
+                if decompressor.eof:
+                    # A gzip file may have several members one after another.
+                    decompressor = zlib.decompressobj(_GZIP_WBITS)
+                output_file.write(decompressor.decompress(
+                    compressed_data, DECOMPRESSION_CHUNK_SIZE))
+                if decompressor.eof:
+                    compressed_data = decompressor.unused_data
+                else:
+                    compressed_data = decompressor.unconsumed_tail
+        output_file.write(decompressor.flush())
+    if not decompressor.eof:
+        raise EOFError("Compressed file ended before the end-of-stream "
+                       "marker was reached")
+    return checksum.hexdigest()
+
+
+def _parse_checksum(text):
+    """ Get checksum from a checksum file content, as written by sha256sum.
+
+    :param text: Checksum file content.
+    :type text: str
+    :return: SHA-256 checksum in lowercase hexadecimal.
+    :rtype: str
+    :raise: ValueError if text has no valid checksum.
+    """
+    fields = text.split()
+    if not fields:
+        raise ValueError("Empty checksum file")
+    checksum = fields[0].lower()
+    if len(checksum) != hashlib.sha256().digest_size * 2 or \
+            checksum.strip("0123456789abcdef"):
+        raise ValueError("Not a SHA-256 checksum: {0}".format(fields[0]))
+    return checksum
+
+
 def _find_compressed_file(temporary_directory):
     """ Find .gz file name downloaded to temporary directory.
 
@@ -301,17 +1491,196 @@ def _get_uncompressed_file_name_path(compressed_file_name_path):
     return uncompressed_file_name_path
 
 
-def _open_local_database(local_database_path):
+def _select_database_mode(configured_mode, workload, local_database_path):
+    """ Choose how to open local database.
+
+    C extension is the fastest reader, and it shares memory mapped database
+    pages with any other process using the same file. Without it, pure Python
+    reader is faster with the whole database loaded in memory, but loading
+    it only pays off if input is big compared with database, and every
+    worker process would have its own copy.
+
+    :param configured_mode: One of config.LOCAL_DATABASE_MODES.
+    :type configured_mode: str
+    :param workload: What is going to be located.
+    :type workload: Workload
+    :param local_database_path: Path to local database file.
+    :type local_database_path: str
+    :return: One of config.LOCAL_DATABASE_MODES but "auto".
+    :rtype: str
+    """
+    if configured_mode != "auto":
+        return configured_mode
+    if _C_EXTENSION_AVAILABLE:
+        return "mmap_ext"
+    if workload.workers > 1 or workload.input_size is None:
+        return "mmap"
     try:
-        database_connection = database.Reader(local_database_path)
+        database_size = os.stat(local_database_path).st_size
+    except FileNotFoundError:
+        return "mmap"
+    if workload.input_size >= database_size:
+        return "memory"
+    else:
+        return "mmap"
+
+
+def _open_local_database(local_database_path, mode="mmap_ext"):
+    """
+    :param local_database_path: Path to local database file.
+    :type local_database_path: str
+    :param mode: One of config.LOCAL_DATABASE_MODES but "auto".
+    :type mode: str
+    :return: Reader for local database.
+    :rtype: geoip2.database.Reader
+    :raise: LocalDatabaseNotFound
+    :raise: InvalidLocalDatabase
+    :raise: LocalDatabaseModeNotAvailable
+    """
+    try:
+        database_connection = database.Reader(local_database_path,
+                                              mode=_DATABASE_MODES[mode])
     except FileNotFoundError:
         raise LocalDatabaseNotFound(local_database_path)
     except maxminddb.InvalidDatabaseError:
         raise InvalidLocalDatabase(local_database_path)
+    except ValueError:
+        # C extension mode asked for without C extension installed.
+        raise LocalDatabaseModeNotAvailable(mode)
     else:
         return database_connection
 
 
+def _get_file_signature(path):
+    """ Get what changes when a file is replaced or modified.
+
+    :param path: Path to file.
+    :type path: str
+    :return: File inode, modification time and size, or None if file does
+    not exist.
+    :rtype: tuple
+    """
+    try:
+        file_status = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return file_status.st_ino, file_status.st_mtime_ns, file_status.st_size
+
+
+def _verify_database(database_path):
+    """ Check a database file can be read before using it.
+
+    :param database_path: Path to database file.
+    :type database_path: str
+    :return: None
+    :raise: InvalidLocalDatabase
+    """
+    try:
+        with maxminddb.open_database(database_path,
+                                     maxminddb.MODE_FILE) as reader:
+            # Looking for an address goes through search tree and data
+            # section, not only metadata read when opening.
+            reader.get("8.8.8.8")
+    except (maxminddb.InvalidDatabaseError, ValueError):
+        raise InvalidLocalDatabase(database_path)
+
+
+def _print_ordering_decision(decision):
+    """
+    :param decision: Decision taken by adaptive preference.
+    :type decision: health.Decision
+    :return: None
+    """
+    print("Locator {0} {1}: {2}.".format(decision.locator_id,
+                                         decision.action, decision.reason),
+          file=sys.stderr)
+
+
+def _get_location_record(record, detail, traits):
+    """ Take from a raw database record only fields up to detail level.
+
+    :param record: Raw database record.
+    :type record: dict
+    :param detail: One of DETAIL_* levels.
+    :type detail: int
+    :param traits: Address and network record belongs to.
+    :type traits: TraitsRecord
+    :return: Lightweight record.
+    :rtype: LocationRecord
+    """
+    continent = _get_name(record, "continent")
+    country = _UNKNOWN_NAME
+    city = _UNKNOWN_NAME
+    location = _UNKNOWN_COORDINATES
+    if detail >= DETAIL_COUNTRY:
+        country = _get_name(record, "country")
+    if detail >= DETAIL_CITY:
+        city = _get_name(record, "city")
+    if detail >= DETAIL_COORDINATES:
+        coordinates = record.get("location", {})
+        location = CoordinatesRecord(coordinates.get("latitude"),
+                                     coordinates.get("longitude"))
+    return LocationRecord(continent, country, city, location, traits)
+
+
+def _get_name(record, field):
+    """
+    :param record: Raw database record.
+    :type record: dict
+    :param field: Record field with localized names.
+    :type field: str
+    :return: Name record with field's name.
+    :rtype: NameRecord
+    """
+    try:
+        return NameRecord(record[field]["names"][_LOCALE])
+    except KeyError:
+        return _UNKNOWN_NAME
+
+
+def _get_raw_model(model):
+    """
+    :param model: geoip2 model.
+    :type model: geoip2.models.City
+    :return: Data model was built from, JSON serializable.
+    :rtype: dict
+    """
+    # geoip2 releases before 5.0 keep that data in raw attribute.
+    to_dict = getattr(model, "to_dict", None)
+    if to_dict is None:
+        return model.raw
+    return to_dict()
+
+
+def _build_model(raw_model, endpoint=WEBSERVICE_CITY):
+    """
+    :param raw_model: Data returned by _get_raw_model().
+    :type raw_model: dict
+    :param endpoint: Webservice endpoint data came from.
+    :type endpoint: str
+    :return: geoip2 model built from that data.
+    :rtype: geoip2.models.Country or geoip2.models.City
+    """
+    model_class = models.Country if endpoint == WEBSERVICE_COUNTRY \
+        else models.City
+    try:
+        return model_class([_LOCALE], **raw_model)
+    except TypeError:  # geoip2 releases before 5.0.
+        return model_class(raw_model, locales=[_LOCALE])
+
+
+def _get_webservice_endpoint(detail):
+    """
+    :param detail: Detail level requested, or None for complete models.
+    :type detail: int
+    :return: Cheapest webservice endpoint giving that detail.
+    :rtype: str
+    """
+    if detail is not None and detail <= DETAIL_COUNTRY:
+        return WEBSERVICE_COUNTRY
+    return WEBSERVICE_CITY
+
+
 def _get_database_last_modification(database_path):
     """
     :param database_path: Path to database file to be evaluated.
@@ -367,10 +1736,10 @@ def _print_compressed_file_not_found_error(e):
     :type e: CompressedFileNotFound
     :return: none
     """
-    print("Problem decompressing updated database.")
+    print("Problem decompressing updated database.", file=sys.stderr)
     path = e.compressed_database_path
     message = "No .gz file found at {0}".format(path)
-    print(message)
+    print(message, file=sys.stderr)
 
 
 class GeoIP2WebServiceNotConfigured(Exception):
@@ -400,6 +1769,41 @@ class InvalidLocalDatabase(Exception):
         Exception.__init__(self, message)
 
 
+class LocalDatabaseModeNotAvailable(Exception):
+    """ Local database can't be opened with configured mode. """
+
+    def __init__(self, mode):
+        self.mode = mode
+        message = "Local database can't be opened in {0} mode. Is maxminddb " \
+                  "C extension installed?".format(mode)
+        Exception.__init__(self, message)
+
+
+class UpdateLockTimeout(Exception):
+    """ Another process has been downloading local database for too long."""
+
+    def __init__(self, lock_path, timeout):
+        self.lock_path = lock_path
+        self.timeout = timeout
+        message = "Another process has held {0} for more than {1} seconds " \
+                  "while downloading local database.".format(lock_path,
+                                                             timeout)
+        Exception.__init__(self, message)
+
+
+class LookupDeadlineExceeded(TimeoutError):
+    """ Webservice has not answered a lookup in time. Lookup is still
+    running, and its future is kept in lookup attribute."""
+
+    def __init__(self, ip, deadline, lookup):
+        self.ip = ip
+        self.deadline = deadline
+        self.lookup = lookup
+        message = "Webservice has not located {0} in {1} seconds.".format(
+            ip, deadline)
+        TimeoutError.__init__(self, message)
+
+
 class NotValidDatabaseFileFound(OSError):
     """ Raised when a new database pack is downloaded on local, but after
     decompression no valid database file is found in decompressed folder.
@@ -411,6 +1815,18 @@ class NotValidDatabaseFileFound(OSError):
         OSError.__init__(self, message)
 
 
+class ChecksumMismatch(Exception):
+    """ Downloaded file checksum is not the published one."""
+
+    def __init__(self, file_path, expected_checksum, checksum):
+        self.file_path = file_path
+        self.expected_checksum = expected_checksum
+        self.checksum = checksum
+        message = "{0} has SHA-256 {1} but {2} was expected.".format(
+            file_path, checksum, expected_checksum)
+        Exception.__init__(self, message)
+
+
 class CompressedFileNotFound(OSError):
     """ Raised when no .gz compressed file is found in temporary folder where
     downloaded data is placed.
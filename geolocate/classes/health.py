@@ -0,0 +1,428 @@
+"""
+ Locators health tracking.
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import collections
+import math
+import sys
+import time
+
+import geoip2.errors as errors
+
+import geolocate.classes.exceptions as exceptions
+
+# Kinds of locator failures. Addresses not found are not faults of locator,
+# they are answers.
+FAILURE_NOT_FOUND = "not_found"
+FAILURE_AUTHENTICATION = "authentication"
+FAILURE_TIMEOUT = "timeout"
+FAILURE_ERROR = "error"
+FAILURE_KINDS = (FAILURE_NOT_FOUND, FAILURE_AUTHENTICATION, FAILURE_TIMEOUT,
+                 FAILURE_ERROR)
+# Circuit breaker states.
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# Consecutive failures that make a locator be skipped.
+DEFAULT_FAILURE_THRESHOLD = 5
+# Seconds a locator is skipped before trying it again. Every failed try
+# doubles it, up to maximum.
+DEFAULT_BACKOFF = 30
+DEFAULT_MAX_BACKOFF = 15 * 60
+# Latest lookups of every locator its latency and success rate come from.
+DEFAULT_LATENCY_WINDOW = 100
+# Lookups needed before judging a locator, and between two judgements.
+MIN_LATENCY_SAMPLES = 20
+EVALUATION_INTERVAL = 10
+# Seconds a demoted locator waits before being tried in its place again.
+DEFAULT_REVIEW_INTERVAL = 60
+# Adaptive ordering decisions.
+DEMOTED = "demoted"
+RESTORED = "restored"
+# Latest adaptive ordering decisions kept. Older ones are forgotten, so a
+# long session with a flapping locator doesn't keep growing.
+MAX_DECISIONS = 100
+
+_NOT_FOUND_ERRORS = (errors.AddressNotFoundError, exceptions.IPNotFound,
+                     ValueError)
+# Some of them are not in old geoip2 releases.
+_AUTHENTICATION_ERRORS = tuple(
+    getattr(errors, name) for name in ("AuthenticationError",
+                                       "PermissionRequiredError",
+                                       "OutOfQueriesError")
+    if hasattr(errors, name))
+
+
+def classify_failure(error):
+    """
+    :param error: Exception raised by a locator.
+    :type error: Exception
+    :return: One of FAILURE_KINDS.
+    :rtype: str
+    """
+    if isinstance(error, _NOT_FOUND_ERRORS):
+        return FAILURE_NOT_FOUND
+    if isinstance(error, _AUTHENTICATION_ERRORS):
+        return FAILURE_AUTHENTICATION
+    if isinstance(error, TimeoutError):
+        return FAILURE_TIMEOUT
+    # Webservice client raises requests exceptions. If requests has not been
+    # imported, error can't be one of them.
+    requests_exceptions = sys.modules.get("requests.exceptions")
+    if requests_exceptions is not None and \
+            isinstance(error, requests_exceptions.Timeout):
+        return FAILURE_TIMEOUT
+    return FAILURE_ERROR
+
+
+class CircuitBreaker(object):
+    """ Health state of a locator, to stop asking a failing one.
+
+    Breaker starts closed, letting every request through. After
+    failure_threshold consecutive failures, or a single authentication one
+    as retrying can't fix credentials, it opens and requests are refused
+    until backoff elapses. Then it is half open: one request is let through
+    as a probe. If probe succeeds breaker closes, otherwise it opens again
+    for twice as long.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 clock=time.monotonic):
+        """
+        :param failure_threshold: Consecutive failures that open breaker.
+        :type failure_threshold: int
+        :param backoff: Seconds breaker stays open first time.
+        :type backoff: float
+        :param max_backoff: Maximum seconds breaker stays open.
+        :type max_backoff: float
+        :param clock: Function returning current time in seconds.
+        :type clock: callable
+        """
+        self._failure_threshold = failure_threshold
+        self._initial_backoff = backoff
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._clock = clock
+        self._state = CLOSED
+        self._retry_time = None
+        self._consecutive_failures = 0
+        self._trips = 0
+        self._failures = collections.Counter()
+
+    def allow_request(self):
+        """ Check if locator can be asked. If breaker is open and backoff
+        has elapsed, caller is let through as the probe.
+
+        :return: True if locator can be asked, False if it must be skipped.
+        :rtype: bool
+        """
+        if self._state == CLOSED:
+            return True
+        if self._state == OPEN and self._clock() >= self._retry_time:
+            self._state = HALF_OPEN
+            return True
+        return False
+
+    def record_success(self):
+        """
+        :return: None
+        """
+        self._consecutive_failures = 0
+        if self._state != CLOSED:
+            self._state = CLOSED
+            self._backoff = self._initial_backoff
+
+    def record_failure(self, kind):
+        """
+        :param kind: One of FAILURE_KINDS.
+        :type kind: str
+        :return: None
+        """
+        self._failures[kind] += 1
+        if kind == FAILURE_NOT_FOUND:
+            # Locator worked, address is just not there.
+            self.record_success()
+            return
+        self._consecutive_failures += 1
+        if self._state == HALF_OPEN:
+            self._backoff = min(self._backoff * 2, self._max_backoff)
+            self._open()
+        elif self._state == CLOSED and \
+                (kind == FAILURE_AUTHENTICATION or
+                 self._consecutive_failures >= self._failure_threshold):
+            self._open()
+
+    def _open(self):
+        """
+        :return: None
+        """
+        self._state = OPEN
+        self._trips += 1
+        self._retry_time = self._clock() + self._backoff
+
+    @property
+    def state(self):
+        """
+        :return: One of CLOSED, OPEN or HALF_OPEN.
+        :rtype: str
+        """
+        return self._state
+
+    @property
+    def trips(self):
+        """
+        :return: Times breaker has opened.
+        :rtype: int
+        """
+        return self._trips
+
+    @property
+    def consecutive_failures(self):
+        """
+        :return: Failures recorded since last success.
+        :rtype: int
+        """
+        return self._consecutive_failures
+
+    @property
+    def failures(self):
+        """
+        :return: Failures recorded, by kind.
+        :rtype: dict
+        """
+        return {kind: self._failures[kind] for kind in FAILURE_KINDS}
+
+
+class LatencyTracker(object):
+    """ Latency and success rate of the latest lookups of a locator."""
+
+    def __init__(self, window=DEFAULT_LATENCY_WINDOW):
+        """
+        :param window: Number of latest lookups kept.
+        :type window: int
+        """
+        self._samples = collections.deque(maxlen=window)
+        self._successes = 0
+        self._recorded = 0
+
+    def record(self, latency, success):
+        """
+        :param latency: Seconds lookup took.
+        :type latency: float
+        :param success: False if locator failed, True if it answered, even
+        if answer was address not found.
+        :type success: bool
+        :return: None
+        """
+        if len(self._samples) == self._samples.maxlen:
+            self._successes -= self._samples[0][1]
+        self._samples.append((latency, success))
+        self._successes += success
+        self._recorded += 1
+
+    def clear(self):
+        """
+        :return: None
+        """
+        self._samples.clear()
+        self._successes = 0
+        self._recorded = 0
+
+    def percentile(self, fraction):
+        """
+        :param fraction: Percentile wanted, between 0 and 1.
+        :type fraction: float
+        :return: Latency in seconds fraction of lookups kept took at most, or
+        None if there is none.
+        :rtype: float
+        """
+        if not self._samples:
+            return None
+        latencies = sorted(latency for latency, _ in self._samples)
+        index = max(math.ceil(fraction * len(latencies)) - 1, 0)
+        return latencies[index]
+
+    @property
+    def p95(self):
+        """
+        :return: 95th percentile of latency in seconds.
+        :rtype: float
+        """
+        return self.percentile(0.95)
+
+    @property
+    def success_rate(self):
+        """
+        :return: Fraction of lookups kept locator answered, or None if there
+        is none.
+        :rtype: float
+        """
+        if not self._samples:
+            return None
+        return self._successes / len(self._samples)
+
+    @property
+    def samples(self):
+        """
+        :return: Lookups kept.
+        :rtype: int
+        """
+        return len(self._samples)
+
+    @property
+    def recorded(self):
+        """
+        :return: Lookups recorded since tracker was created or cleared,
+        including those no longer kept.
+        :rtype: int
+        """
+        return self._recorded
+
+
+Decision = collections.namedtuple("Decision",
+                                  ["time", "locator_id", "action", "reason"])
+
+
+class AdaptiveOrder(object):
+    """ Locators preference order adjusted to how locators are behaving.
+
+    Locators keep user preference order, but those whose 95th percentile
+    of latency goes over max_latency, or whose success rate falls under
+    min_success_rate, are demoted after the ones behaving well. Demoted
+    locators are not asked while others answer, so they are not judged
+    again: once review_interval elapses they are restored to their place
+    and judged from new lookups.
+    """
+
+    def __init__(self, max_latency, min_success_rate,
+                 review_interval=DEFAULT_REVIEW_INTERVAL,
+                 window=DEFAULT_LATENCY_WINDOW, clock=time.monotonic,
+                 log=None, max_decisions=MAX_DECISIONS):
+        """
+        :param max_latency: Seconds 95th percentile of latency can take.
+        :type max_latency: float
+        :param min_success_rate: Minimum fraction of lookups answered.
+        :type min_success_rate: float
+        :param review_interval: Seconds a locator stays demoted.
+        :type review_interval: float
+        :param window: Number of latest lookups locators are judged from.
+        :type window: int
+        :param clock: Function returning current time in seconds.
+        :type clock: callable
+        :param log: Function called with every Decision taken, if any.
+        :type log: callable
+        :param max_decisions: Latest decisions kept.
+        :type max_decisions: int
+        """
+        self._max_latency = max_latency
+        self._min_success_rate = min_success_rate
+        self._review_interval = review_interval
+        self._window = window
+        self._clock = clock
+        self._log = log
+        self._trackers = {}
+        # Time every demoted locator is restored at, by locator tag.
+        self._demoted = {}
+        self._decisions = collections.deque(maxlen=max_decisions)
+
+    def record(self, locator_id, latency, success):
+        """ Take note of a lookup, demoting its locator if it is not
+        behaving well any longer.
+
+        :param locator_id: Locator tag.
+        :type locator_id: str
+        :param latency: Seconds lookup took.
+        :type latency: float
+        :param success: False if locator failed.
+        :type success: bool
+        :return: None
+        """
+        tracker = self.get_tracker(locator_id)
+        tracker.record(latency, success)
+        if locator_id in self._demoted or \
+                tracker.samples < MIN_LATENCY_SAMPLES or \
+                tracker.recorded % EVALUATION_INTERVAL:
+            return
+        p95 = tracker.p95
+        success_rate = tracker.success_rate
+        if p95 > self._max_latency:
+            reason = "95th percentile of latency {0:.3f} s is over " \
+                     "{1:.3f} s".format(p95, self._max_latency)
+        elif success_rate < self._min_success_rate:
+            reason = "success rate {0:.0%} is under {1:.0%}".format(
+                success_rate, self._min_success_rate)
+        else:
+            return
+        self._demoted[locator_id] = self._clock() + self._review_interval
+        self._decide(locator_id, DEMOTED, reason)
+
+    def order(self, preference):
+        """
+        :param preference: Locator tags in user preference order.
+        :type preference: list
+        :return: Locator tags in the order they should be asked.
+        :rtype: list
+        """
+        if not self._demoted:
+            return preference
+        now = self._clock()
+        for locator_id, restore_time in list(self._demoted.items()):
+            if now >= restore_time:
+                del self._demoted[locator_id]
+                # Old lookups would demote it again at once.
+                self.get_tracker(locator_id).clear()
+                self._decide(locator_id, RESTORED,
+                             "review interval elapsed")
+        return [locator_id for locator_id in preference
+                if locator_id not in self._demoted] + \
+               [locator_id for locator_id in preference
+                if locator_id in self._demoted]
+
+    def _decide(self, locator_id, action, reason):
+        """
+        :param locator_id: Locator tag.
+        :type locator_id: str
+        :param action: DEMOTED or RESTORED.
+        :type action: str
+        :param reason: Why.
+        :type reason: str
+        :return: None
+        """
+        decision = Decision(time.time(), locator_id, action, reason)
+        self._decisions.append(decision)
+        if self._log is not None:
+            self._log(decision)
+
+    def get_tracker(self, locator_id):
+        """
+        :param locator_id: Locator tag.
+        :type locator_id: str
+        :return: Latency tracker of that locator.
+        :rtype: LatencyTracker
+        """
+        try:
+            return self._trackers[locator_id]
+        except KeyError:
+            tracker = LatencyTracker(self._window)
+            self._trackers[locator_id] = tracker
+            return tracker
+
+    @property
+    def demoted(self):
+        """
+        :return: Locator tags demoted now.
+        :rtype: set
+        """
+        return set(self._demoted)
+
+    @property
+    def decisions(self):
+        """
+        :return: Latest decisions taken, up to max_decisions, oldest first.
+        :rtype: list
+        """
+        return list(self._decisions)
@@ -0,0 +1,132 @@
+"""
+ IP networks helpers.
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import bisect
+import ipaddress
+import socket
+
+# Address length for every IP version.
+ADDRESS_BITS = {4: 32, 6: 128}
+# Private, reserved and documentation ranges. Addresses in them are never in
+# geolocation databases, so there is no point in asking locators for them.
+NON_ROUTABLE_NETWORKS = (
+    # IPv4.
+    "0.0.0.0/8",  # "This" network.
+    "10.0.0.0/8",  # RFC1918 private.
+    "100.64.0.0/10",  # Carrier grade NAT.
+    "127.0.0.0/8",  # Loopback.
+    "169.254.0.0/16",  # Link local.
+    "172.16.0.0/12",  # RFC1918 private.
+    "192.0.0.0/24",  # IETF protocol assignments.
+    "192.0.2.0/24",  # Documentation (TEST-NET-1).
+    "192.168.0.0/16",  # RFC1918 private.
+    "198.18.0.0/15",  # Benchmarking.
+    "198.51.100.0/24",  # Documentation (TEST-NET-2).
+    "203.0.113.0/24",  # Documentation (TEST-NET-3).
+    "224.0.0.0/4",  # Multicast.
+    "240.0.0.0/4",  # Reserved and limited broadcast.
+    # IPv6.
+    "::/127",  # Unspecified and loopback.
+    "64:ff9b:1::/48",  # Local use IPv4/IPv6 translation.
+    "100::/64",  # Discard only.
+    "2001:db8::/32",  # Documentation.
+    "fc00::/7",  # Unique local.
+    "fe80::/10",  # Link local.
+    "ff00::/8",  # Multicast.
+)
+
+
+class NetworkTable(object):
+    """ Set of IP networks stored as sorted integer ranges, so checking if an
+    address belongs to any of them is a binary search.
+    """
+
+    def __init__(self, networks):
+        """
+        :param networks: Networks in CIDR notation.
+        :type networks: iterable
+        """
+        ranges = {4: [], 6: []}
+        for network in networks:
+            ip_network = ipaddress.ip_network(network)
+            ranges[ip_network.version].append(
+                (int(ip_network.network_address),
+                 int(ip_network.broadcast_address)))
+        self._starts = {}
+        self._ends = {}
+        for version, version_ranges in ranges.items():
+            merged_ranges = _merge_ranges(version_ranges)
+            self._starts[version] = [start for start, _ in merged_ranges]
+            self._ends[version] = [end for _, end in merged_ranges]
+
+    def __contains__(self, ip):
+        """
+        :param ip: IP address in canonical form.
+        :type ip: str
+        :return: True if address is in any of table networks, else False.
+        :rtype: bool
+        """
+        version, address = address_to_integer(ip)
+        starts = self._starts[version]
+        index = bisect.bisect_right(starts, address) - 1
+        return index >= 0 and address <= self._ends[version][index]
+
+
+def address_to_integer(ip):
+    """ Convert an IP address to its integer value.
+
+    socket conversion functions are several times faster than ipaddress
+    module ones.
+
+    :param ip: IP address.
+    :type ip: str
+    :return: IP version (4 or 6) and address integer value.
+    :rtype: tuple
+    :raises: OSError if ip is not a valid address.
+    """
+    if ":" in ip:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+    else:
+        return 4, int.from_bytes(socket.inet_aton(ip), "big")
+
+
+def _merge_ranges(ranges):
+    """ Join overlapping or adjacent ranges.
+
+    :param ranges: (start, end) integer tuples.
+    :type ranges: list
+    :return: Sorted non overlapping (start, end) integer tuples.
+    :rtype: list
+    """
+    merged_ranges = []
+    for start, end in sorted(ranges):
+        if merged_ranges and start <= merged_ranges[-1][1] + 1:
+            last_start, last_end = merged_ranges[-1]
+            merged_ranges[-1] = (last_start, max(last_end, end))
+        else:
+            merged_ranges.append((start, end))
+    return merged_ranges
+
+
+_NON_ROUTABLE_TABLE = NetworkTable(NON_ROUTABLE_NETWORKS)
+_IPV4_MAPPED_PREFIX = "::ffff:"
+
+
+def is_non_routable(ip):
+    """ Check if address is private, reserved or any other kind of address
+    not present in geolocation databases.
+
+    :param ip: IP address in canonical form.
+    :type ip: str
+    :return: True if address is not routable, else False.
+    :rtype: bool
+    """
+    if ip.startswith(_IPV4_MAPPED_PREFIX):
+        mapped_address = ipaddress.IPv6Address(ip).ipv4_mapped
+        if mapped_address is not None:
+            ip = str(mapped_address)
+    return ip in _NON_ROUTABLE_TABLE
@@ -0,0 +1,239 @@
+"""
+ Multi-process parsing for big inputs.
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import collections
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+
+import geolocate.classes.geowrapper as geowrapper
+import geolocate.classes.parser as parser
+
+# Big enough to make pickling chunks back and forth to workers negligible
+# compared with parsing them, small enough to keep memory used by in flight
+# chunks bounded.
+CHUNK_SIZE = 8 * 1024 * 1024
+# Chunks submitted to workers for every job, so workers always have a chunk
+# queued while main process writes results.
+CHUNKS_PER_JOB = 2
+
+# Put in input queue by reader thread after last chunk.
+_END_OF_INPUT = object()
+
+# Parser owned by every worker process. Set by _init_worker().
+_worker_parser = None
+
+
+class ParallelParser(object):
+    """ Split input in line aligned chunks and annotate them in a pool of
+    worker processes.
+
+    Every worker opens its own geolocation database, so local database
+    lookups don't have to cross process boundaries. Annotated chunks are
+    returned in the same order they were read.
+
+    In streaming mode input is read in a thread and chunks are sent to
+    workers as soon as their lines arrive, and annotated chunks are returned
+    as soon as there is no more input waiting. So lines piped from a slow
+    program are not held back until a whole chunk fills.
+    """
+
+    def __init__(self, jobs, verbosity, configuration, stream=None,
+                 chunk_size=CHUNK_SIZE,
+                 database_loader=geowrapper.load_geoip_database,
+                 database_check_interval=None, streaming=False):
+        """
+        :param jobs: Number of worker processes.
+        :type jobs: int
+        :param verbosity: Verbosity level for location strings.
+        :type verbosity: int
+        :param configuration: Geolocate configuration.
+        :type configuration: config.Configuration
+        :param stream: Stream to read input from. Defaults to stdin.
+        :type stream: io.IOBase
+        :param chunk_size: Approximate size in bytes of chunks sent to workers.
+        :type chunk_size: int
+        :param database_loader: Module level function to create geolocation
+        database in every worker from configuration.
+        :type database_loader: callable
+        :param database_check_interval: Seconds between checks for a
+        changed database in every worker, or None to never check.
+        :type database_check_interval: float
+        :param streaming: Parse lines as they arrive instead of waiting for
+        whole chunks.
+        :type streaming: bool
+        """
+        self._jobs = jobs
+        self._verbosity = verbosity
+        self._configuration = configuration
+        self._stream = parser.get_stdin() if stream is None else stream
+        self._chunk_size = chunk_size
+        self._database_loader = database_loader
+        self._database_check_interval = database_check_interval
+        self._streaming = streaming
+        self._workers = {}
+
+    def __iter__(self):
+        """
+        :return: Annotated chunks, encoded and in input order.
+        :rtype: generator
+        """
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self._jobs,
+                initializer=_init_worker,
+                initargs=(self._configuration, self._verbosity,
+                          self._database_loader,
+                          self._database_check_interval)) as executor:
+            if self._streaming:
+                yield from self._annotate_stream(executor)
+            else:
+                yield from self._annotate_chunks(
+                    executor,
+                    parser.read_chunks(self._stream, self._chunk_size))
+
+    def _annotate_chunks(self, executor, chunks):
+        """
+        :param executor: Pool of worker processes.
+        :type executor: concurrent.futures.ProcessPoolExecutor
+        :param chunks: Encoded chunks of whole lines.
+        :type chunks: iterable
+        :return: Annotated chunks, encoded and in input order.
+        :rtype: generator
+        """
+        pending_chunks = collections.deque()
+        for chunk in chunks:
+            if len(pending_chunks) >= self._jobs * CHUNKS_PER_JOB:
+                yield self._get_result(pending_chunks.popleft())
+            pending_chunks.append(executor.submit(_annotate_chunk, chunk))
+        while pending_chunks:
+            yield self._get_result(pending_chunks.popleft())
+
+    def _annotate_stream(self, executor):
+        """
+        :param executor: Pool of worker processes.
+        :type executor: concurrent.futures.ProcessPoolExecutor
+        :return: Annotated chunks, encoded and in input order.
+        :rtype: generator
+        """
+        # Workers are started before reader thread, so they are not forked
+        # while it is blocked reading stream.
+        executor.submit(os.getpid).result()
+        input_chunks = queue.Queue(maxsize=self._jobs * CHUNKS_PER_JOB)
+        # Daemon, so a reader blocked on an idle stream doesn't keep
+        # process alive if output fails.
+        reader = threading.Thread(target=self._read_stream,
+                                  args=(input_chunks,), daemon=True)
+        reader.start()
+        pending_chunks = collections.deque()
+        while True:
+            try:
+                chunk = input_chunks.get(block=not pending_chunks)
+            except queue.Empty:
+                # No more input yet, so waiting for it would hold back
+                # lines already read.
+                yield self._get_result(pending_chunks.popleft())
+                continue
+            if chunk is _END_OF_INPUT:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            if len(pending_chunks) >= self._jobs * CHUNKS_PER_JOB:
+                yield self._get_result(pending_chunks.popleft())
+            pending_chunks.append(executor.submit(_annotate_chunk, chunk))
+        while pending_chunks:
+            yield self._get_result(pending_chunks.popleft())
+
+    def _read_stream(self, input_chunks):
+        """ Put chunks of stream in a queue as their lines arrive, followed
+        by _END_OF_INPUT, or by the exception that stopped reading.
+
+        :param input_chunks: Queue to put chunks in.
+        :type input_chunks: queue.Queue
+        :return: None
+        """
+        try:
+            for chunk in parser.read_available_chunks(self._stream,
+                                                      self._chunk_size):
+                input_chunks.put(chunk)
+        except Exception as e:
+            input_chunks.put(e)
+        else:
+            input_chunks.put(_END_OF_INPUT)
+
+    def _get_result(self, future):
+        """ Wait for an annotated chunk and account its worker's work.
+
+        :param future: Submitted chunk.
+        :type future: concurrent.futures.Future
+        :return: Annotated chunk.
+        :rtype: bytes
+        """
+        worker_id, lines, seconds, annotated_chunk = future.result()
+        worker = self._workers.setdefault(worker_id, [0, 0.0])
+        worker[0] += lines
+        worker[1] += seconds
+        return annotated_chunk
+
+    @property
+    def statistics(self):
+        """
+        :return: Lines parsed by every worker and its throughput, keyed by
+        name.
+        :rtype: collections.OrderedDict
+        """
+        statistics = collections.OrderedDict()
+        statistics["jobs"] = self._jobs
+        for number, worker_id in enumerate(sorted(self._workers), start=1):
+            lines, seconds = self._workers[worker_id]
+            lines_per_second = round(lines / seconds) if seconds else 0
+            statistics["worker_{0}_lines".format(number)] = lines
+            statistics["worker_{0}_lines_per_second".format(number)] = \
+                lines_per_second
+        return statistics
+
+
+def _init_worker(configuration, verbosity, database_loader,
+                 database_check_interval=None):
+    """ Create parser for this worker process.
+
+    :param configuration: Geolocate configuration.
+    :type configuration: config.Configuration
+    :param verbosity: Verbosity level for location strings.
+    :type verbosity: int
+    :param database_loader: Function to create geolocation database.
+    :type database_loader: callable
+    :param database_check_interval: Seconds between checks for a changed
+    database, or None to never check.
+    :type database_check_interval: float
+    :return: None
+    """
+    global _worker_parser
+    geoip_database = database_loader(configuration)
+    _worker_parser = parser.GeolocateInputParser(
+        verbosity, geoip_database, text="",
+        cache_size=configuration.cache_size,
+        non_routable_tag=configuration.non_routable_tag,
+        database_check_interval=database_check_interval)
+
+
+def _annotate_chunk(chunk):
+    """ Append location to every IP address in chunk.
+
+    :param chunk: Whole lines of encoded text.
+    :type chunk: bytes
+    :return: Worker process id, lines in chunk, seconds spent parsing them
+    and annotated chunk.
+    :rtype: tuple
+    """
+    start = time.perf_counter()
+    text = _worker_parser.include_locations(parser.decode(chunk))
+    annotated_chunk = parser.encode(text)
+    seconds = time.perf_counter() - start
+    return os.getpid(), chunk.count(b"\n"), seconds, annotated_chunk
+
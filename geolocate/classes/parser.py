@@ -6,11 +6,83 @@
  email: dante.signal31@gmail.com
 """
 
+import collections
+import io
+import ipaddress
+import itertools
+import mmap
 import re
 import sys
-import collections
+import time
 
+import geolocate.classes.cache as cache
+import geolocate.classes.compression as compression
+import geolocate.classes.config as config
 import geolocate.classes.exceptions as exceptions
+import geolocate.classes.networks as networks
+
+# Big blocks mean less system calls and less line splitting calls.
+READ_BLOCK_SIZE = 1024 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+# Long running stream sessions look for a replaced database file at most
+# once every this many seconds. Checking is a stat() call, but there is no
+# need to do it for every line.
+DATABASE_CHECK_INTERVAL = 10
+# Lines whose addresses are located at once when database can locate many
+# addresses concurrently. Their output waits for the slowest lookup.
+PREFETCH_BATCH_SIZE = 256
+# Input bytes that are not valid UTF-8 travel as surrogate escapes and are
+# written back exactly as they were read.
+_ENCODING = "utf-8"
+_ENCODING_ERRORS = "surrogateescape"
+
+# Octets are validated at match time, so impossible addresses (999.10.20.300),
+# octets with leading zeros, longer dotted strings like version numbers
+# (1.2.3.4.5) or addresses glued to words (v1.2.3.4) are never sent to
+# locators.
+_IPV4_OCTET = r"(?:25[0-5]|2[0-4][0-9]|1[0-9]{2}|[1-9]?[0-9])"
+_IPV4_ADDRESS = r"{0}(?:\.{0}){{3}}".format(_IPV4_OCTET)
+_IPV4_BOUNDED = r"(?<![\w.]){0}(?!\w|\.[0-9])".format(_IPV4_ADDRESS)
+# Leading lookahead is redundant but lets regex engine skip quickly
+# non-digit positions before evaluating lookbehinds.
+_IPV4_FILTER = r"(?=[0-9]){0}".format(_IPV4_BOUNDED)
+# IPv6 addresses may be compressed (2001:db8::1), have an embedded IPv4
+# address (::ffff:1.2.3.4) or a zone id (fe80::1%eth0). A bare "::" is
+# left alone because it uses to be found in source code, not in logs.
+_IPV6_GROUP = r"[0-9A-Fa-f]{1,4}"
+_IPV6_ADDRESS = r"(?:(?:{0}:){{7}}{0}" \
+                r"|(?:{0}:){{6}}{1}" \
+                r"|(?:{0}(?::{0}){{0,6}})?::(?:(?:{0}:){{0,5}}{1}" \
+                r"|{0}(?::{0}){{0,6}})?)".format(_IPV6_GROUP, _IPV4_ADDRESS)
+_IPV6_BOUNDED = r"(?<![\w:.])(?!::(?![0-9A-Fa-f])){0}" \
+                r"(?:%[0-9A-Za-z_.~-]+)?(?![\w:]|\.[0-9])".format(
+                    _IPV6_ADDRESS)
+_IPV6_FILTER = r"(?=[0-9A-Fa-f:]){0}".format(_IPV6_BOUNDED)
+_IP_FILTER = r"(?=[0-9A-Fa-f:])(?:{0}|{1})".format(_IPV4_BOUNDED,
+                                                    _IPV6_BOUNDED)
+# Compiled once at import time. Compiling this for every line was noticeable
+# when parsing long logs.
+_IPV4_REGEX = re.compile(_IPV4_FILTER)
+_IPV6_REGEX = re.compile(_IPV6_FILTER)
+_IP_REGEX = re.compile(_IP_FILTER)
+# Mapped files are scanned for lines that may have addresses with patterns
+# starting with a literal, which regex engine looks for much faster than
+# full address patterns. Together they match every address: IPv4 ones,
+# compressed IPv6 ones and uncompressed IPv6 ones. Lines found are checked
+# with full patterns later.
+_CANDIDATE_BYTES_REGEXES = (
+    re.compile(rb"\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]"),
+    re.compile(rb"::"),
+    re.compile(rb":[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}:"
+               rb"[0-9A-Fa-f]{1,4}:[0-9A-Fa-f]{1,4}:"))
+# Any IPv4 address has at least this number of dots.
+_IPV4_MIN_DOTS = 3
+# IPv6 addresses are either compressed, so they have "::", or they have
+# this number of colons at least (six if they have an embedded IPv4 address,
+# but then they have dots enough to be checked by IPv4 regex).
+_IPV6_COMPRESSION = "::"
+_IPV6_MIN_COLONS = 7
+_IPV6_BYTES_COMPRESSION = _IPV6_COMPRESSION.encode("ascii")
 
 
 class GeolocateInputParser(object):
@@ -22,13 +94,48 @@ class GeolocateInputParser(object):
     VERBOSITY_LEVELS = range(len(_VERBOSITY_FIELDS))
     _IP_NOT_FOUND_MESSAGE = "[IP not found]"
 
-    def __init__(self, verbosity, geoip_database, text=None):
+    def __init__(self, verbosity, geoip_database, text=None,
+                 cache_size=config.DEFAULT_CACHE_SIZE,
+                 non_routable_tag=config.DEFAULT_NON_ROUTABLE_TAG,
+                 database_check_interval=None):
+        """
+        :param verbosity: One of VERBOSITY_LEVELS.
+        :type verbosity: int
+        :param geoip_database: Database to locate addresses with.
+        :type geoip_database: geowrapper.GeoIPDatabase
+        :param text: Text to parse. If None, stdin is read.
+        :type text: str
+        :param cache_size: Location strings to keep cached.
+        :type cache_size: int
+        :param non_routable_tag: Location string for non routable addresses.
+        :type non_routable_tag: str
+        :param database_check_interval: Seconds between checks for a
+        changed database, or None to never check. Database must have a
+        reload_if_changed() method to check it.
+        :type database_check_interval: float
+
+        If database has a prefetching property set, addresses of lines
+        already read are given to its prefetch() method before those lines
+        are parsed, to let it look for them concurrently.
+        """
         self._verbosity = verbosity
         self._geoip_database = geoip_database
+        self._non_routable_tag = non_routable_tag
+        self._non_routable_addresses = 0
+        # Formatting location data is as expensive as looking for it, so we
+        # keep finished location strings for recently seen addresses. They
+        # are interned, so addresses in the same place share one string.
+        self._location_strings = cache.LocationCache(cache_size)
+        self._database_check_interval = database_check_interval
+        self._next_database_check = self._get_next_database_check()
+        self._prefetching = getattr(geoip_database, "prefetching", False)
         if text is None:
             self._entered_text = InputReader()
         else:
             self._entered_text = _get_lines(text)
+        if self._prefetching:
+            self._entered_text = self._get_prefetched_lines(
+                self._entered_text)
 
     def __iter__(self):
         return self
@@ -42,20 +149,176 @@ class GeolocateInputParser(object):
         # so in that case is more efficient reading lines as they
         # arrive from the pipe.
         for line in self._entered_text:
-            try:
-                ip_list = _find_ips_in_text(line)
-                for ip in ip_list:
-                    location = self._locate(ip)
-                    line = _include_location_in_line(line, ip, location)
-                return line
-            except exceptions.IPNotFound as e:
-                location_string = _join_ip_to_location(e.failed_IP,
-                                                       self.__class__._IP_NOT_FOUND_MESSAGE)
-                line = _include_location_in_line(line, e.failed_IP,
-                                                 location_string)
-                return line
+            self._check_database()
+            return self._include_locations_in_line(line)
         raise StopIteration()
 
+    def include_locations(self, text):
+        """ Append location to every IP address in a block of text lines.
+
+        :param text: Lines with IP addresses embedded, line endings included.
+        :type text: str
+        :return: Text with ip addresses followed by location strings.
+        :rtype: str
+        """
+        self._check_database()
+        if self._prefetching:
+            self._prefetch_locations(text)
+        # Line by line, so only lines that may have IPv6 addresses pay for
+        # IPv6 regex.
+        lines = text.splitlines(keepends=True)
+        return "".join(map(self._include_locations_in_line, lines))
+
+    def _get_prefetched_lines(self, lines):
+        """ Let database locate at once addresses of lines already read
+        before they are parsed one by one.
+
+        :param lines: Lines to parse.
+        :type lines: iterable
+        :return: Same lines, in the same order.
+        :rtype: generator
+        """
+        for batch in _get_line_batches(lines):
+            # Some lines come without line ending.
+            self._prefetch_locations("\n".join(batch))
+            yield from batch
+
+    def _prefetch_locations(self, text):
+        """ Let database locate at once every address in text whose
+        location string is not cached yet.
+
+        :param text: Text with IP addresses embedded.
+        :type text: str
+        :return: None
+        """
+        addresses = [address for address in _find_ips_in_text(text)
+                     if (address, self._verbosity) not in
+                     self._location_strings and
+                     not networks.is_non_routable(address)]
+        if addresses:
+            self._geoip_database.prefetch(addresses, self._verbosity)
+
+    def _get_next_database_check(self):
+        """
+        :return: Monotonic clock time when database should be checked next,
+        or None if it is never checked.
+        :rtype: float
+        """
+        if self._database_check_interval is None:
+            return None
+        return time.monotonic() + self._database_check_interval
+
+    def _check_database(self):
+        """ Let database reload its data if it has changed, as long as check
+        interval has elapsed. Location strings cached until then are
+        forgotten if data changed, so they are all built from the same data.
+
+        :return: None
+        """
+        if self._next_database_check is None or \
+                time.monotonic() < self._next_database_check:
+            return
+        self._next_database_check = self._get_next_database_check()
+        if self._geoip_database.reload_if_changed():
+            self._location_strings.invalidate()
+
+    def _include_locations_in_line(self, line):
+        """ Append location to every IP address in line.
+
+        Line is rewritten in a single regex pass. Replacing addresses one by
+        one had to scan the whole line for each of them and messed up lines
+        where an address was a substring of another one (e.g. 1.2.3.4 in
+        11.2.3.45).
+
+        :param line: Line with IP addresses embedded.
+        :type line: str
+        :return: Line with ip addresses followed by location strings.
+        :rtype: str
+        """
+        address_regex = _get_address_regex(line)
+        if address_regex is None:
+            return line
+        return address_regex.sub(self._replace_with_location_string, line)
+
+    def _replace_with_location_string(self, match):
+        """
+        :param match: IP address found in line.
+        :type match: re.Match
+        :return: IP address with location string appended.
+        :rtype: str
+        """
+        return self._get_location_string(match.group())
+
+    def _get_location_string(self, ip):
+        """ Get IP address with its location string appended.
+
+        :param ip: String with IP address.
+        :type ip: str
+        :return: IP address with location string, or with a not found
+        message if address could not be located.
+        :rtype: str
+        """
+        location_string = self._get_cached_location_string(ip)
+        if location_string is None:
+            return ip
+        return _join_ip_to_location(ip, location_string)
+
+    def _get_cached_location_string(self, ip):
+        """ Get location string of an IP address, formatting it only if it
+        is not cached yet.
+
+        :param ip: String with IP address.
+        :type ip: str
+        :return: Location string, not found message if address could not be
+        located or None if it is not a valid address.
+        :rtype: str
+        """
+        key = (ip, self._verbosity)
+        location_string = self._location_strings.get(key)
+        if location_string is cache.MISSING:
+            location_string = self._find_location_string(ip)
+            self._location_strings.add(key, location_string)
+        return location_string
+
+    def _find_location_string(self, ip):
+        """ Build location string for an address not cached yet.
+
+        Private and reserved addresses are tagged without asking locators,
+        they would fail for them anyway.
+
+        :param ip: String with IP address.
+        :type ip: str
+        :return: Location string, not found message if address could not be
+        located or None if it is not a valid address.
+        :rtype: str
+        """
+        try:
+            address = _normalize_address(ip)
+        except ValueError:
+            # IPv6 regex can't check group count of compressed addresses,
+            # so some matches are not valid addresses. Leave them as is.
+            return None
+        if networks.is_non_routable(address):
+            self._non_routable_addresses += 1
+            return self._non_routable_tag
+        try:
+            return self._locate(ip)
+        except exceptions.IPNotFound:
+            return self.__class__._IP_NOT_FOUND_MESSAGE
+
+    @property
+    def statistics(self):
+        """
+        :return: Counters about location strings cache usage, keyed by name.
+        :rtype: collections.OrderedDict
+        """
+        statistics = collections.OrderedDict()
+        statistics["location_strings_entries"] = len(self._location_strings)
+        statistics["location_strings_hits"] = self._location_strings.hits
+        statistics["location_strings_misses"] = self._location_strings.misses
+        statistics["non_routable_addresses"] = self._non_routable_addresses
+        return statistics
+
     def _locate(self, ip):
         """Query database to get IP address location and format
         location depending of desired verbosity.
@@ -65,14 +328,19 @@ class GeolocateInputParser(object):
         :return: String with location.
         :rtype: str
         :raises: exceptions.IPNotFound.
+        :raises: ValueError if ip is not a valid address.
         """
+        address = _normalize_address(ip)
         try:
-            location_data = self._geoip_database.locate(ip)
+            # Verbosity levels are database detail levels too, so locators
+            # able to do it only get the fields we are going to show.
+            location_data = self._geoip_database.locate(address,
+                                                        self._verbosity)
         except exceptions.IPNotFound:
             raise
-        location_string = self._format_location_string(location_data)
-        returned_string = _join_ip_to_location(ip, location_string)
-        return returned_string
+        # Many addresses share the same location, so interning lets their
+        # cached entries share the same string object too.
+        return sys.intern(self._format_location_string(location_data))
 
     def _format_location_string(self, location_data):
         """Add location fields to returned string depending of desired
@@ -114,11 +382,17 @@ def _find_unknowns(location_data):
     """ Find any unknown attribute and convert it in a informational string.
 
     :param location_data: GeoIP record.
-    :type location_data: geoip2.models.City
+    :type location_data: geoip2.models.City or geoip2.models.Country
     :return: Informational strings.
     :rtype: dict
     """
     location_strings = _default_location_strings()
+    # Country models, got when city data is not needed, have neither city
+    # nor location.
+    city_name = getattr(getattr(location_data, "city", None), "name", None)
+    location = getattr(location_data, "location", None)
+    latitude = getattr(location, "latitude", None)
+    longitude = getattr(location, "longitude", None)
     if location_data.continent.name is None:
         location_strings["continent_name"] = "Unknown continent"
     else:
@@ -127,18 +401,18 @@ def _find_unknowns(location_data):
         location_strings["country_name"] = "Unknown country"
     else:
         location_strings["country_name"] = location_data.country.name
-    if location_data.city.name is None:
+    if city_name is None:
         location_strings["city_name"] = "Unknown city"
     else:
-        location_strings["city_name"] = location_data.city.name
-    if location_data.location.latitude is None:
+        location_strings["city_name"] = city_name
+    if latitude is None:
         location_strings["lat-long"]["latitude"] = "Unknown latitude"
     else:
-        location_strings["lat-long"]["latitude"] = str(location_data.location.latitude)
-    if location_data.location.longitude is None:
+        location_strings["lat-long"]["latitude"] = str(latitude)
+    if longitude is None:
         location_strings["lat-long"]["longitude"] = "Unknown longitude"
     else:
-        location_strings["lat-long"]["longitude"] = str(location_data.location.longitude)
+        location_strings["lat-long"]["longitude"] = str(longitude)
     return location_strings
 
 
@@ -153,6 +427,68 @@ def _default_location_strings():
     return location_strings
 
 
+def _may_have_addresses(text):
+    """ Cheap check to discard text where no IPv4 address can be, without
+    running regex over it.
+
+    :param text: Text to check.
+    :type text: str
+    :return: False if text can't have any address, True if it may have them.
+    :rtype: bool
+    """
+    return text.count(".") >= _IPV4_MIN_DOTS
+
+
+def _may_have_ipv6_addresses(text):
+    """ Cheap check to discard text where no IPv6 address can be, without
+    running regex over it.
+
+    Timestamps and MAC addresses have colons too, but not enough of them nor
+    "::", so usual IPv4 logs don't pay for IPv6 regex.
+
+    :param text: Text to check.
+    :type text: str
+    :return: False if text can't have any address, True if it may have them.
+    :rtype: bool
+    """
+    return _IPV6_COMPRESSION in text or text.count(":") >= _IPV6_MIN_COLONS
+
+
+def _get_address_regex(text):
+    """ Get cheapest regex able to find every address in text.
+
+    :param text: Text to parse.
+    :type text: str
+    :return: Compiled regex or None if text can't have any address.
+    :rtype: re.Pattern
+    """
+    if _may_have_ipv6_addresses(text):
+        return _IP_REGEX
+    elif _may_have_addresses(text):
+        return _IPV4_REGEX
+    else:
+        return None
+
+
+def _normalize_address(ip):
+    """ Get canonical form of an address, so equivalent spellings of the same
+    IPv6 address are located and cached only once.
+
+    IPv4 addresses are already canonical because regex doesn't accept
+    leading zeros.
+
+    :param ip: IP address as found in text.
+    :type ip: str
+    :return: Canonical IP address, without zone id.
+    :rtype: str
+    :raises: ValueError if ip is not a valid address.
+    """
+    if ":" not in ip:
+        return ip
+    address = ip.partition("%")[0]
+    return ipaddress.IPv6Address(address).compressed
+
+
 def _find_ips_in_text(text):
     """Return a set with all IP addresses found in text
 
@@ -162,9 +498,8 @@ def _find_ips_in_text(text):
     :rtype: set
     """
     ipv4_addresses = _find_ipv4_addresses(text)
-    # TODO: Implement a _find_ipv6_addresses() so in the end we can do:
-    #          found_addresses = ipv4_addresses.union(ipv6_addresses)
-    found_addresses = ipv4_addresses
+    ipv6_addresses = _find_ipv6_addresses(text)
+    found_addresses = ipv4_addresses.union(ipv6_addresses)
     return found_addresses
 
 
@@ -175,24 +510,28 @@ def _find_ipv4_addresses(text):
     :return: A set with all addresses found.
     :rtype: set
     """
-    ip_filter = "[0-9]+(?:\.[0-9]+){3}"
-    regex_filter = re.compile(ip_filter)
-    addresses = regex_filter.findall(text)
+    if not _may_have_addresses(text):
+        return set()
+    addresses = _IPV4_REGEX.findall(text)
     return set(addresses)
 
 
-def _include_location_in_line(line, ip, location):
+def _find_ipv6_addresses(text):
     """
-    :param line: Original line to place location string into.
-    :type line: str
-    :param ip: IP address to be replaced with location.
-    :type ip: str
-    :param location: IP address string with location data appended.
-    :type location: str
-    :return: Line with ip addresses followed by location strings.
-    :rtype: str
+    :param text: Text with IP addresses embedded.
+    :type text: str
+    :return: A set with all addresses found, in canonical form.
+    :rtype: set
     """
-    return line.replace(ip, location)
+    addresses = set()
+    if not _may_have_ipv6_addresses(text):
+        return addresses
+    for address in _IPV6_REGEX.findall(text):
+        try:
+            addresses.add(_normalize_address(address))
+        except ValueError:
+            continue
+    return addresses
 
 
 def _join_ip_to_location(ip, location):
@@ -207,6 +546,28 @@ def _join_ip_to_location(ip, location):
     return location_string
 
 
+def _get_line_batches(lines):
+    """ Group lines already read, without waiting for more input.
+
+    :param lines: Lines to group. If it has a batches() method, like
+    InputReader, lines are grouped as they were read.
+    :type lines: iterable
+    :return: Lists of PREFETCH_BATCH_SIZE lines at most.
+    :rtype: generator
+    """
+    batches = getattr(lines, "batches", None)
+    if batches is None:
+        iterator = iter(lines)
+        batches = iter(lambda: list(itertools.islice(iterator,
+                                                     PREFETCH_BATCH_SIZE)),
+                       [])
+    else:
+        batches = batches()
+    for batch in batches:
+        for start in range(0, len(batch), PREFETCH_BATCH_SIZE):
+            yield batch[start:start + PREFETCH_BATCH_SIZE]
+
+
 def _get_lines(text):
     """ Get a generator object with text lines.
 
@@ -220,16 +581,451 @@ def _get_lines(text):
 
 
 class InputReader(object):
-    """Iterator to read piped input from other programs."""
+    """Iterator to read piped input from other programs.
 
-    def __init__(self):
-        pass
+    Input is read from binary stdin in big blocks and split in lines here,
+    which is cheaper than asking text stdin for every line. Bytes that are
+    not valid UTF-8 are kept as surrogate escapes, so they get to output
+    untouched instead of aborting parsing.
+    """
+
+    def __init__(self, stream=None, block_size=READ_BLOCK_SIZE):
+        """
+        :param stream: Stream to read from. Stdin if None.
+        :type stream: io.IOBase
+        :param block_size: Bytes to ask for in each read.
+        :type block_size: int
+        """
+        if stream is None:
+            stream = get_stdin()
+        self._stream = stream
+        self._block_size = block_size
+        self._batches = self._read_batches()
+        self._lines = itertools.chain.from_iterable(self._batches)
 
     def __iter__(self):
         return self
 
-    @staticmethod
-    def __next__():
-        for line in sys.stdin:
-            return line
-        raise StopIteration()
\ No newline at end of file
+    def __next__(self):
+        return next(self._lines)
+
+    def batches(self):
+        """ Get lines grouped as they are read. Use either this or
+        iteration over lines, not both.
+
+        :return: Lists of lines read at once from stream, with their line
+        ending.
+        :rtype: generator
+        """
+        return self._batches
+
+    def _read_batches(self):
+        """
+        :return: Lists of lines read at once from stream, with their line
+        ending.
+        :rtype: generator
+        """
+        if isinstance(self._stream, io.TextIOBase):
+            # Stdin may have been replaced by a text only stream.
+            for line in self._stream:
+                yield [line]
+            return
+        # read1() returns as soon as there is any data available, so lines
+        # piped from a slow program are not held back until a block fills.
+        read = getattr(self._stream, "read1", self._stream.read)
+        for data in _read_line_blocks(read, self._block_size):
+            lines = decode(data).split("\n")
+            # Last element is empty if data ends with a line ending, else it
+            # is last line of stream.
+            last_line = lines.pop()
+            batch = [line + "\n" for line in lines]
+            if last_line:
+                batch.append(last_line)
+            yield batch
+
+
+def _read_line_blocks(read, block_size):
+    """ Read a binary stream in blocks of whole lines.
+
+    Only every new block is searched for a line ending. Lines longer than a
+    block are gathered in pieces that are joined once their line ending
+    arrives, so they are not copied and searched again for every new block.
+
+    :param read: Function to read up to a number of bytes from stream.
+    :type read: callable
+    :param block_size: Bytes to ask for in each read.
+    :type block_size: int
+    :return: Blocks ending with a line ending, but last one if stream does
+    not end with one. Decoding them never splits a multibyte character.
+    :rtype: generator
+    """
+    pieces = []
+    while True:
+        block = read(block_size)
+        if not block:
+            break
+        end = block.rfind(b"\n") + 1
+        if end == 0:
+            pieces.append(block)
+            continue
+        pieces.append(block[:end])
+        yield b"".join(pieces)
+        pieces = [block[end:]] if end < len(block) else []
+    if pieces:
+        yield b"".join(pieces)
+
+
+class MappedFileParser(object):
+    """Iterator to parse a file through a memory map.
+
+    Mapping is scanned with bytes regexes, so only lines that may have
+    addresses are copied and decoded to be parsed. Runs of lines without
+    addresses are returned as memoryview slices of the mapping, and those are
+    valid only until next iteration. This pays off with logs where many
+    lines have no address; when nearly every line has one, parsing is as
+    expensive as reading the file as a stream.
+    """
+
+    def __init__(self, input_parser, path):
+        """
+        :param input_parser: Parser to include locations in lines with
+        addresses.
+        :type input_parser: GeolocateInputParser
+        :param path: Path to file to parse.
+        :type path: str
+        """
+        self._input_parser = input_parser
+        self._path = path
+
+    def __iter__(self):
+        """
+        :return: Parsed file content, encoded and in file order.
+        :rtype: generator
+        """
+        with open(self._path, "rb") as input_file:
+            try:
+                mapping = mmap.mmap(input_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped, and there is nothing to
+                # parse in them anyway.
+                return
+            with mapping:
+                yield from self._parse_mapping(mapping)
+
+    def _parse_mapping(self, mapping):
+        """
+        :param mapping: Mapped file.
+        :type mapping: mmap.mmap
+        :return: Parsed mapping content, encoded and in mapping order.
+        :rtype: generator
+        """
+        size = len(mapping)
+        position = 0
+        with memoryview(mapping) as view:
+            for lines_start, lines_end in _find_candidate_lines(mapping):
+                if lines_start > position:
+                    # Mapping can't be closed while slices of it exist.
+                    with view[position:lines_start] as unchanged_lines:
+                        yield unchanged_lines
+                lines = decode(mapping[lines_start:lines_end])
+                yield encode(self._input_parser.include_locations(lines))
+                position = lines_end
+            if size > position:
+                with view[position:size] as unchanged_lines:
+                    yield unchanged_lines
+
+
+def _find_candidate_lines(mapping):
+    """ Find lines that may have addresses.
+
+    :param mapping: Mapped file.
+    :type mapping: mmap.mmap
+    :return: (start, end) offsets of runs of consecutive lines that may have
+    addresses.
+    :rtype: generator
+    """
+    size = len(mapping)
+    matches = [regex.search(mapping) for regex in _CANDIDATE_BYTES_REGEXES]
+    position = 0
+    while position < size:
+        candidate_start = _search_candidate(mapping, position, matches)
+        if candidate_start is None:
+            break
+        lines_start = mapping.rfind(b"\n", position, candidate_start) + 1
+        lines_start = max(lines_start, position)
+        lines_end = _get_line_end(mapping, candidate_start)
+        # Lines with addresses use to come together, so lines following a
+        # candidate are checked with a quicker test than searching again.
+        while lines_end < size:
+            line_end = _get_line_end(mapping, lines_end)
+            if not _may_have_addresses_in_bytes(mapping[lines_end:line_end]):
+                break
+            lines_end = line_end
+        yield lines_start, lines_end
+        position = lines_end
+
+
+def _search_candidate(mapping, position, matches):
+    """ Find next position where an address may start.
+
+    :param mapping: Mapped file.
+    :type mapping: mmap.mmap
+    :param position: Offset to search from.
+    :type position: int
+    :param matches: Last match of every candidate regex. Matches behind
+    position are updated in place.
+    :type matches: list
+    :return: Offset of first candidate found, or None if there is none.
+    :rtype: int
+    """
+    candidate_start = None
+    for index, match in enumerate(matches):
+        # Every regex is searched again only when its last match has been
+        # left behind.
+        if match is not None and match.start() < position:
+            regex = _CANDIDATE_BYTES_REGEXES[index]
+            match = matches[index] = regex.search(mapping, position)
+        if match is not None:
+            if candidate_start is None or match.start() < candidate_start:
+                candidate_start = match.start()
+    return candidate_start
+
+
+def _get_line_end(mapping, position):
+    """
+    :param mapping: Mapped file.
+    :type mapping: mmap.mmap
+    :param position: Offset inside line.
+    :type position: int
+    :return: Offset just after line ending, or mapping size for last line
+    without line ending.
+    :rtype: int
+    """
+    line_end = mapping.find(b"\n", position) + 1
+    return line_end if line_end > 0 else len(mapping)
+
+
+def _may_have_addresses_in_bytes(data):
+    """ Bytes counterpart of _may_have_addresses() and
+    _may_have_ipv6_addresses().
+
+    :param data: Encoded text to check.
+    :type data: bytes
+    :return: False if data can't have any address, True if it may have them.
+    :rtype: bool
+    """
+    return data.count(b".") >= _IPV4_MIN_DOTS or \
+        _IPV6_BYTES_COMPRESSION in data or \
+        data.count(b":") >= _IPV6_MIN_COLONS
+
+
+class BlockParser(object):
+    """Iterator to parse a stream in big blocks of whole lines.
+
+    Used for streams that can't be memory mapped, like decompressed files.
+    Every block is decoded and parsed in one go, so there are far fewer
+    calls per line than reading it line by line.
+    """
+
+    def __init__(self, input_parser, stream, block_size=READ_BLOCK_SIZE):
+        """
+        :param input_parser: Parser to include locations in lines with
+        addresses.
+        :type input_parser: GeolocateInputParser
+        :param stream: Binary stream to read.
+        :type stream: io.BufferedIOBase
+        :param block_size: Approximate size of every block.
+        :type block_size: int
+        """
+        self._input_parser = input_parser
+        self._stream = stream
+        self._block_size = block_size
+
+    def __iter__(self):
+        """
+        :return: Parsed stream content, encoded and in stream order.
+        :rtype: generator
+        """
+        for block in read_chunks(self._stream, self._block_size):
+            text = self._input_parser.include_locations(decode(block))
+            yield encode(text)
+
+
+class OutputWriter(object):
+    """ Buffered binary writer for parsed lines.
+
+    Output is only flushed for every line if it is a terminal or if that
+    is requested, otherwise it is written in big blocks.
+    """
+
+    def __init__(self, stream=None, line_buffered=None,
+                 buffer_size=WRITE_BUFFER_SIZE, compression_format=None):
+        """
+        :param stream: Stream to write to. Stdout if None.
+        :type stream: io.IOBase
+        :param line_buffered: Flush every line. If None it is only done if
+        stream is a terminal.
+        :type line_buffered: bool
+        :param buffer_size: Bytes to gather before writing.
+        :type buffer_size: int
+        :param compression_format: Compress output in one of
+        compression.COMPRESSION_FORMATS. None to write it uncompressed.
+        :type compression_format: str
+        :raises: compression.CompressionNotSupported
+        """
+        if stream is None:
+            stream = sys.stdout
+        if line_buffered is None:
+            line_buffered = stream.isatty()
+        self._line_buffered = line_buffered
+        self._text_stream = None
+        self._binary_stream = None
+        if isinstance(stream, io.TextIOBase):
+            # Anything already written through text layer must get out
+            # before our own bytes.
+            stream.flush()
+            try:
+                self._binary_stream = open(stream.fileno(), "wb",
+                                           buffering=buffer_size,
+                                           closefd=False)
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                # Stdout may have been replaced by a text only stream.
+                self._text_stream = stream
+        else:
+            self._binary_stream = stream
+        self._compressed_stream = None
+        if compression_format is not None:
+            if self._binary_stream is None:
+                raise compression.CompressionNotSupported(
+                    compression_format, "output is not a binary stream")
+            self._compressed_stream = self._binary_stream
+            # Everything goes through compressor from now on.
+            self._binary_stream = compression.open_compressed(
+                self._compressed_stream, compression_format)
+
+    def write(self, text):
+        """
+        :param text: Text to write.
+        :type text: str
+        :return: None
+        """
+        if self._binary_stream is not None:
+            self._binary_stream.write(encode(text))
+        else:
+            self._text_stream.write(text)
+        if self._line_buffered:
+            self.flush()
+
+    def write_bytes(self, data):
+        """ Write data that needs no encoding.
+
+        :param data: Data to write.
+        :type data: bytes-like object
+        :return: None
+        """
+        if self._binary_stream is not None:
+            self._binary_stream.write(data)
+        else:
+            self._text_stream.write(decode(data))
+        if self._line_buffered:
+            self.flush()
+
+    def flush(self):
+        """
+        :return: None
+        """
+        if self._binary_stream is not None:
+            self._binary_stream.flush()
+        else:
+            self._text_stream.flush()
+
+    def close(self):
+        """ Flush output and finish compressed data if output is compressed.
+
+        Stream given to write to is left open.
+
+        :return: None
+        """
+        if self._compressed_stream is not None:
+            self._binary_stream.close()
+            self._compressed_stream.flush()
+        else:
+            self.flush()
+
+
+def read_chunks(stream, chunk_size):
+    """ Read stream in blocks of whole lines.
+
+    :param stream: Stream to read.
+    :type stream: io.IOBase
+    :param chunk_size: Approximate size of every block. Blocks are extended
+    to next line end.
+    :type chunk_size: int
+    :return: Encoded blocks of lines.
+    :rtype: generator
+    """
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        chunk += stream.readline()
+        if isinstance(chunk, str):
+            chunk = encode(chunk)
+        yield chunk
+
+
+def read_available_chunks(stream, chunk_size):
+    """ Read stream in blocks of whole lines as soon as they arrive.
+
+    Unlike read_chunks(), blocks are not held back until chunk_size bytes
+    have been read, so lines piped from a slow program get parsed while it
+    is still running.
+
+    :param stream: Stream to read.
+    :type stream: io.IOBase
+    :param chunk_size: Maximum bytes to ask for in each read. Blocks are
+    extended to next line end.
+    :type chunk_size: int
+    :return: Encoded blocks of lines.
+    :rtype: generator
+    """
+    if isinstance(stream, io.TextIOBase):
+        # Stdin may have been replaced by a text only stream.
+        for line in stream:
+            yield encode(line)
+        return
+    read = getattr(stream, "read1", stream.read)
+    yield from _read_line_blocks(read, chunk_size)
+
+
+def get_stdin():
+    """
+    :return: Binary stdin, or text stdin if it has been replaced by a text
+    only stream.
+    :rtype: io.IOBase
+    """
+    return getattr(sys.stdin, "buffer", sys.stdin)
+
+
+def decode(data):
+    """ Convert bytes read from input to text.
+
+    :param data: Bytes to convert.
+    :type data: bytes
+    :return: Decoded text. Non UTF-8 bytes are kept as surrogate escapes.
+    :rtype: str
+    """
+    return str(data, _ENCODING, _ENCODING_ERRORS)
+
+
+def encode(text):
+    """ Convert text to bytes to write them to output.
+
+    :param text: Text to convert.
+    :type text: str
+    :return: Encoded text. Surrogate escapes are written back as the original
+    bytes they came from.
+    :rtype: bytes
+    """
+    return text.encode(_ENCODING, _ENCODING_ERRORS)
@@ -6,7 +6,10 @@
  email: dante.signal31@gmail.com
 """
 
+import fcntl
+import os
 import sys
+import time
 
 
 def verify_python_version(major_version, minor_revision):
@@ -27,4 +30,96 @@ def verify_python_version(major_version, minor_revision):
                   "you are trying to use Python {2}.{3} instead.\nAborting " \
                   "execution.".format(major_version, minor_revision,
                                       sys.version_info[0], sys.version_info[1])
-        sys.exit(message)
\ No newline at end of file
+        sys.exit(message)
+
+
+class FileLock(object):
+    """ Advisory lock on a file, shared by every process using the same lock
+    file path.
+
+    Operating system releases it if its process dies, so a crashed process
+    never leaves it locked.
+    """
+
+    # Seconds between tries while waiting for lock.
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, path):
+        """
+        :param path: Path to lock file. It is created if it doesn't exist.
+        Its folder must exist.
+        :type path: str
+        """
+        self._path = path
+        self._file_descriptor = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def locked(self):
+        """
+        :return: True if this object holds the lock.
+        :rtype: bool
+        """
+        return self._file_descriptor is not None
+
+    def acquire(self, timeout=None):
+        """
+        :param timeout: Seconds to wait for lock if another process holds it.
+        0 to try only once, None to wait as long as needed.
+        :type timeout: float
+        :return: True if lock was acquired, False if timeout elapsed before.
+        :rtype: bool
+        """
+        file_descriptor = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if timeout is None:
+                fcntl.flock(file_descriptor, fcntl.LOCK_EX)
+            elif not _try_lock(file_descriptor, timeout):
+                os.close(file_descriptor)
+                return False
+        except BaseException:
+            os.close(file_descriptor)
+            raise
+        self._file_descriptor = file_descriptor
+        return True
+
+    def release(self):
+        """
+        :return: None
+        """
+        if self._file_descriptor is not None:
+            fcntl.flock(self._file_descriptor, fcntl.LOCK_UN)
+            os.close(self._file_descriptor)
+            self._file_descriptor = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        return False
+
+
+def _try_lock(file_descriptor, timeout):
+    """ Try to lock a file until timeout elapses.
+
+    :param file_descriptor: Descriptor of file to lock.
+    :type file_descriptor: int
+    :param timeout: Seconds to keep trying.
+    :type timeout: float
+    :return: True if file was locked, False if not.
+    :rtype: bool
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(FileLock.POLL_INTERVAL)
@@ -15,20 +15,34 @@ and their API.
 """
 # TODO: Improve sphinxdoc structure.
 
+import functools
+import os
+import sys
+
 import geolocate.classes.system as system
 
 system.verify_python_version(3, 0)
 
 import geolocate.classes.arguments as arguments
+import geolocate.classes.compression as compression
 import geolocate.classes.geowrapper as geowrapper
+import geolocate.classes.parallel as parallel
 import geolocate.classes.parser as parser
 import geolocate.classes.config as config
 
 
-def print_lines_parsed(parser):
+def print_lines_parsed(parser, output_writer):
+    """ Write parsed lines to output.
+
+    :param parser: Parser to get lines from.
+    :type parser: parser.GeolocateInputParser
+    :param output_writer: Writer to send lines to.
+    :type output_writer: parser.OutputWriter
+    :return: None
+    """
     for line in parser:
         try:
-            print(line, end="")
+            output_writer.write(line)
         except UnicodeEncodeError as e:
             print(e)
             print("\nGeolocate has found an UnicodeEncodeError while trying "
@@ -37,19 +51,175 @@ def print_lines_parsed(parser):
                   "locale configuration.\nPlease read this thread:\n"
                   "\n"
                   "https://stackoverflow.com/questions/41408791/python-3-unicodeencodeerror-ascii-codec-cant-encode-characters\n")
+    output_writer.flush()
+
+
+def print_chunks_parsed(chunk_parser, output_writer):
+    """ Write already encoded parsed chunks to output.
+
+    :param chunk_parser: Parser to get chunks from.
+    :type chunk_parser: parallel.ParallelParser or parser.MappedFileParser
+    :param output_writer: Writer to send chunks to.
+    :type output_writer: parser.OutputWriter
+    :return: None
+    """
+    for chunk in chunk_parser:
+        output_writer.write_bytes(chunk)
+    output_writer.flush()
+
+
+def parse_files(_arguments, configuration, geoip_database):
+    """ Write given files parsed to output, one after another.
+
+    :param _arguments: Arguments object returned by ArgumentParser.parse_args()
+    :type _arguments: Namespace
+    :param configuration: Geolocate configuration.
+    :type configuration: config.Configuration
+    :param geoip_database: Database to locate addresses with.
+    :type geoip_database: geowrapper.GeoIPDatabase
+    :return: None
+    """
+    input_parser = parser.GeolocateInputParser(_arguments.verbosity,
+                                               geoip_database, "",
+                                               configuration.cache_size,
+                                               configuration.non_routable_tag)
+    output_writer = get_output_writer(_arguments)
+    statistics_sources = [geoip_database, input_parser]
+    for path in _arguments.input_files:
+        try:
+            compression_format = compression.detect_compression(path)
+            if compression_format is None and _arguments.jobs == 1:
+                file_parser = parser.MappedFileParser(input_parser, path)
+                print_chunks_parsed(file_parser, output_writer)
+                continue
+            # Compressed files can't be mapped, so they are decompressed
+            # incrementally and parsed as they are read.
+            with compression.open_decompressed(path,
+                                               compression_format) as input_file:
+                if _arguments.jobs > 1:
+                    file_parser = parallel.ParallelParser(
+                        _arguments.jobs, _arguments.verbosity, configuration,
+                        input_file,
+                        database_loader=get_database_loader(_arguments))
+                    statistics_sources.append(file_parser)
+                else:
+                    file_parser = parser.BlockParser(input_parser, input_file)
+                print_chunks_parsed(file_parser, output_writer)
+        except compression.READ_ERRORS as e:
+            print("Could not read {0}: {1}".format(path, e), file=sys.stderr)
+    output_writer.close()
+    if _arguments.show_statistics:
+        print_statistics(*statistics_sources)
+
+
+def get_workload(_arguments):
+    """
+    :param _arguments: Arguments object returned by ArgumentParser.parse_args()
+    :type _arguments: Namespace
+    :return: Hint about what is going to be located, to open local database
+    the best way for it.
+    :rtype: geowrapper.Workload
+    """
+    input_size = None
+    if _arguments.input_files:
+        input_size = 0
+        for path in _arguments.input_files:
+            try:
+                input_size += os.stat(path).st_size
+            except OSError:
+                # parse_files() tells user about unreadable files.
+                pass
+    return geowrapper.Workload(input_size, _arguments.jobs)
+
+
+def get_database_loader(_arguments):
+    """
+    :param _arguments: Arguments object returned by ArgumentParser.parse_args()
+    :type _arguments: Namespace
+    :return: Function for worker processes to load their geolocation
+    database from configuration.
+    :rtype: callable
+    """
+    return functools.partial(geowrapper.load_geoip_database,
+                             workload=get_workload(_arguments))
+
+
+def get_database_check_interval(_arguments):
+    """
+    :param _arguments: Arguments object returned by ArgumentParser.parse_args()
+    :type _arguments: Namespace
+    :return: Seconds between checks for a replaced database, or None if run
+    is not expected to last enough to need them.
+    :rtype: float
+    """
+    # Stream sessions may run for weeks while database is refreshed by
+    # other processes.
+    if _arguments.stream_mode:
+        return parser.DATABASE_CHECK_INTERVAL
+    return None
+
+
+def get_output_writer(_arguments):
+    """
+    :param _arguments: Arguments object returned by ArgumentParser.parse_args()
+    :type _arguments: Namespace
+    :return: Writer to stdout configured as user asked for.
+    :rtype: parser.OutputWriter
+    """
+    return parser.OutputWriter(
+        line_buffered=_arguments.line_buffered or None,
+        compression_format=_arguments.output_compression)
+
+
+def print_statistics(*sources):
+    """ Print counters to stderr, so they don't get mixed with parsed output.
+
+    :param sources: Objects with a statistics property, like
+    geowrapper.GeoIPDatabase or parser.GeolocateInputParser.
+    :type sources: list
+    :return: None
+    """
+    for source in sources:
+        for name, value in source.statistics.items():
+            print("{0}: {1}".format(name, value), file=sys.stderr)
 
 
 def main():
     _arguments = arguments.parse_arguments()
     arguments.process_optional_parameters(_arguments)
     configuration = config.load_configuration()
-    geoip_database = geowrapper.load_geoip_database(configuration)
-    if _arguments.text_to_parse or _arguments.stream_mode:
-        input_parser = parser.GeolocateInputParser(_arguments.verbosity,
-                                                   geoip_database,
-                                                   _arguments.text_to_parse)
-        print_lines_parsed(input_parser)
-    print()
+    geoip_database = geowrapper.load_geoip_database(configuration,
+                                                    get_workload(_arguments))
+    if _arguments.jobs > 1:
+        # Locators are created lazily, so without this every worker would
+        # check database freshness, and download it, by itself.
+        geoip_database.open_local_database()
+    if _arguments.input_files:
+        parse_files(_arguments, configuration, geoip_database)
+    elif _arguments.stream_mode and _arguments.jobs > 1:
+        parallel_parser = parallel.ParallelParser(
+            _arguments.jobs, _arguments.verbosity, configuration,
+            database_loader=get_database_loader(_arguments),
+            database_check_interval=get_database_check_interval(_arguments),
+            streaming=True)
+        output_writer = get_output_writer(_arguments)
+        print_chunks_parsed(parallel_parser, output_writer)
+        output_writer.close()
+        if _arguments.show_statistics:
+            print_statistics(parallel_parser)
+    elif _arguments.text_to_parse or _arguments.stream_mode:
+        input_parser = parser.GeolocateInputParser(
+            _arguments.verbosity, geoip_database, _arguments.text_to_parse,
+            configuration.cache_size, configuration.non_routable_tag,
+            get_database_check_interval(_arguments))
+        output_writer = get_output_writer(_arguments)
+        print_lines_parsed(input_parser, output_writer)
+        output_writer.close()
+        if _arguments.show_statistics:
+            print_statistics(geoip_database, input_parser)
+    if _arguments.output_compression is None:
+        # A trailing line ending would corrupt compressed output.
+        print()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,286 @@
+"""
+ fake_servers.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+
+ Local stand-ins for remote servers, so tests neither need network access
+ nor spend Maxmind daily download limit.
+"""
+import collections
+import http.server
+import ipaddress
+import json
+import re
+import threading
+import time
+import unittest.mock
+
+_RANGE_REGEX = re.compile(r"bytes=(\d+)-")
+_WEBSERVICE_PATH_REGEX = re.compile(r"/geoip/v2\.1/(city|country)/(.+)")
+_WEBSERVICE_CONTENT_TYPE = "application/vnd.maxmind.com-{0}+json; " \
+                           "charset=UTF-8; version=2.1"
+
+
+class FakeDownloadServer(object):
+    """ HTTP server with a single file to download, and optionally its
+    checksum file. It answers conditional and range requests as real
+    download servers do. Server runs while used as a context manager.
+    """
+
+    def __init__(self, content, file_name="GeoLite2-City.mmdb.gz",
+                 etag='"1"', last_modified="Mon, 01 Jan 2024 00:00:00 GMT",
+                 checksum_text=None):
+        """
+        :param content: File content.
+        :type content: bytes
+        :param file_name: File name in URL path.
+        :type file_name: str
+        :param etag: File ETag.
+        :type etag: str
+        :param last_modified: File Last-Modified date.
+        :type last_modified: str
+        :param checksum_text: Content of checksum file, served at file URL
+        with ".sha256" appended. None to not serve any.
+        :type checksum_text: str
+        """
+        self.path = "/{0}".format(file_name)
+        self.set_content(content, etag, last_modified)
+        self.checksum_text = checksum_text
+        # Headers of every request received.
+        self.requests = []
+        # If set, next full response is cut after this many bytes of body.
+        self.cut_after = None
+        # Seconds to wait before sending file, to make downloads overlap.
+        self.delay = 0
+        # Times file has been sent, wholly or partially.
+        self.downloads = 0
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                                       _DownloadHandler)
+        self._server.fake = self
+        # Requests are served in parallel threads.
+        self.lock = threading.Lock()
+        self._thread = None
+
+    def set_content(self, content, etag, last_modified):
+        """ Replace served file, as a new release would.
+
+        :param content: File content.
+        :type content: bytes
+        :param etag: File ETag.
+        :type etag: str
+        :param last_modified: File Last-Modified date.
+        :type last_modified: str
+        :return: None
+        """
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def url(self):
+        """
+        :return: URL to download served file.
+        :rtype: str
+        """
+        host, port = self._server.server_address[:2]
+        return "http://{0}:{1}{2}".format(host, port, self.path)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        return False
+
+
+class _DownloadHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        fake = self.server.fake
+        fake.requests.append(dict(self.headers))
+        if self.path == "".join([fake.path, ".sha256"]) and \
+                fake.checksum_text is not None:
+            self._send_body(200, fake.checksum_text.encode("utf-8"), {})
+        elif self.path != fake.path:
+            self._send_body(404, b"", {})
+        elif self._not_modified(fake):
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self._send_file(fake)
+
+    def _not_modified(self, fake):
+        if "If-None-Match" in self.headers:
+            return self.headers["If-None-Match"] == fake.etag
+        return self.headers.get("If-Modified-Since") == fake.last_modified
+
+    def _send_file(self, fake):
+        with fake.lock:
+            fake.downloads += 1
+        time.sleep(fake.delay)
+        headers = {"ETag": fake.etag, "Last-Modified": fake.last_modified,
+                   "Accept-Ranges": "bytes"}
+        start = self._get_range_start(fake)
+        if start is None:
+            body = fake.content
+            if fake.cut_after is not None:
+                self._send_body(200, body, headers, fake.cut_after)
+                fake.cut_after = None
+            else:
+                self._send_body(200, body, headers)
+        elif start >= len(fake.content):
+            self._send_body(416, b"", {})
+        else:
+            headers["Content-Range"] = "bytes {0}-{1}/{2}".format(
+                start, len(fake.content) - 1, len(fake.content))
+            self._send_body(206, fake.content[start:], headers)
+
+    def _get_range_start(self, fake):
+        match = _RANGE_REGEX.fullmatch(self.headers.get("Range", ""))
+        if match is None:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and \
+                if_range not in (fake.etag, fake.last_modified):
+            # File changed, so whole new file is sent.
+            return None
+        return int(match.group(1))
+
+    def _send_body(self, status, body, headers, cut_after=None):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if cut_after is None:
+            self.wfile.write(body)
+        else:
+            # Connection is closed before sending the whole body.
+            self.wfile.write(body[:cut_after])
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        # Keep test output clean.
+        pass
+
+
+class FakeWebServiceServer(object):
+    """ HTTP server answering GeoIP2 City and Country webservice queries.
+    Every address is located in Madrid, in a network of its own, but the
+    ones set as not found. Server runs while used as a context manager.
+    """
+
+    def __init__(self, delay=0, not_found=()):
+        """
+        :param delay: Seconds to wait before answering every query, as
+        network round trip to real webservice would take.
+        :type delay: float
+        :param not_found: Addresses answered as not found.
+        :type not_found: iterable
+        """
+        self.delay = delay
+        self.not_found = set(not_found)
+        # Addresses asked for, in arrival order.
+        self.queries = []
+        # Queries received by every endpoint.
+        self.endpoints = collections.Counter()
+        self.connections = 0
+        self.lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                                       _WebServiceHandler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def base_uri(self):
+        """
+        :return: URI webservice paths are appended to.
+        :rtype: str
+        """
+        host, port = self._server.server_address[:2]
+        return "http://{0}:{1}/geoip/v2.1".format(host, port)
+
+    def redirect_clients(self):
+        """
+        :return: Context manager making every geoip2 webservice client
+        created meanwhile query this server instead of Maxmind one.
+        :rtype: unittest.mock._patch
+        """
+        import geoip2.webservice as webservice
+        original_init = webservice.Client.__init__
+        base_uri = self.base_uri
+
+        def init(client, *args, **kwargs):
+            original_init(client, *args, **kwargs)
+            client._base_uri = base_uri
+
+        return unittest.mock.patch.object(webservice.Client, "__init__", init)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        return False
+
+
+class _WebServiceHandler(http.server.BaseHTTPRequestHandler):
+    # Clients keep their connections alive, as with real webservice.
+    protocol_version = "HTTP/1.1"
+    # Headers and body go in a single write. Otherwise delayed ACKs add
+    # tens of milliseconds to every answer on a kept alive connection.
+    wbufsize = -1
+
+    def setup(self):
+        super().setup()
+        with self.server.fake.lock:
+            self.server.fake.connections += 1
+
+    def do_GET(self):
+        fake = self.server.fake
+        match = _WEBSERVICE_PATH_REGEX.fullmatch(self.path)
+        if match is None:
+            self._send_json(404, {"code": "NOT_FOUND", "error": self.path})
+            return
+        endpoint, ip = match.groups()
+        with fake.lock:
+            fake.queries.append(ip)
+            fake.endpoints[endpoint] += 1
+        time.sleep(fake.delay)
+        if ip in fake.not_found:
+            self._send_json(404, {"code": "IP_ADDRESS_NOT_FOUND",
+                                  "error": "{0} not found.".format(ip)})
+            return
+        answer = {
+            "continent": {"code": "EU", "names": {"en": "Europe"}},
+            "country": {"iso_code": "ES", "names": {"en": "Spain"}},
+            "traits": {"ip_address": ip,
+                       "network": str(ipaddress.ip_network(ip))}}
+        if endpoint == "city":
+            answer.update({
+                "city": {"names": {"en": "Madrid"}},
+                "location": {"latitude": 40.4165, "longitude": -3.70256}})
+        self._send_json(200, answer, endpoint)
+
+    def _send_json(self, status, answer, endpoint="city"):
+        body = json.dumps(answer).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type",
+                         _WEBSERVICE_CONTENT_TYPE.format(endpoint))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep test output clean.
+        pass
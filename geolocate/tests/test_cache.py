@@ -0,0 +1,226 @@
+"""
+ test_cache.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import geolocate.classes.cache as cache
+
+DAY = 24 * 60 * 60
+
+
+class TestLocationCache(unittest.TestCase):
+
+    def test_get_missing(self):
+        location_cache = cache.LocationCache(2)
+        self.assertIs(location_cache.get("1.1.1.1"), cache.MISSING)
+        self.assertEqual(location_cache.misses, 1)
+        self.assertEqual(location_cache.hits, 0)
+
+    def test_add_and_get(self):
+        location_cache = cache.LocationCache(2)
+        location_cache.add("1.1.1.1", "Australia")
+        self.assertEqual(location_cache.get("1.1.1.1"), "Australia")
+        self.assertEqual(location_cache.hits, 1)
+        self.assertEqual(location_cache.misses, 0)
+
+    def test_least_recently_used_evicted(self):
+        location_cache = cache.LocationCache(2)
+        location_cache.add("1.1.1.1", "Australia")
+        location_cache.add("8.8.8.8", "United States")
+        # Using first entry makes second one the least recently used.
+        location_cache.get("1.1.1.1")
+        location_cache.add("80.58.67.90", "Spain")
+        self.assertEqual(len(location_cache), 2)
+        self.assertEqual(location_cache.evictions, 1)
+        self.assertNotIn("8.8.8.8", location_cache)
+        self.assertIn("1.1.1.1", location_cache)
+        self.assertIn("80.58.67.90", location_cache)
+
+    def test_invalidate(self):
+        location_cache = cache.LocationCache(2)
+        location_cache.add("1.1.1.1", "Australia")
+        location_cache.add("8.8.8.8", "United States")
+        location_cache.invalidate("1.1.1.1")
+        self.assertNotIn("1.1.1.1", location_cache)
+        self.assertIn("8.8.8.8", location_cache)
+        location_cache.invalidate()
+        self.assertEqual(len(location_cache), 0)
+
+
+class TestNetworkCache(unittest.TestCase):
+
+    def test_get_address_in_network(self):
+        network_cache = cache.NetworkCache(4)
+        network_cache.add("80.58.0.0/16", "Spain")
+        network_cache.add("2001:4860::/32", "United States")
+        self.assertEqual(network_cache.get("80.58.0.0"), "Spain")
+        self.assertEqual(network_cache.get("80.58.255.255"), "Spain")
+        self.assertEqual(network_cache.get("2001:4860::8888"),
+                         "United States")
+        self.assertEqual(network_cache.hits, 3)
+
+    def test_get_address_out_of_networks(self):
+        network_cache = cache.NetworkCache(4)
+        network_cache.add("80.58.0.0/16", "Spain")
+        for ip in ("80.57.255.255", "80.59.0.0", "1.1.1.1", "::1",
+                   "not an address"):
+            self.assertIs(network_cache.get(ip), cache.MISSING)
+        self.assertEqual(network_cache.misses, 5)
+
+    def test_add_prefix(self):
+        network_cache = cache.NetworkCache(4)
+        network_cache.add_prefix("80.58.67.90", 16, "Spain")
+        network_cache.add_prefix("2001:4860::8888", 32, "United States")
+        self.assertEqual(network_cache.get("80.58.0.0"), "Spain")
+        self.assertEqual(network_cache.get("80.58.255.255"), "Spain")
+        self.assertIs(network_cache.get("80.59.0.0"), cache.MISSING)
+        self.assertEqual(network_cache.get("2001:4860:ffff::"),
+                         "United States")
+
+    def test_contains(self):
+        network_cache = cache.NetworkCache(4)
+        network_cache.add("80.58.0.0/16", "Spain")
+        self.assertIn("80.58.67.90", network_cache)
+        self.assertNotIn("80.59.0.0", network_cache)
+        self.assertNotIn("not an address", network_cache)
+        # Checking doesn't count as using cache.
+        self.assertEqual(network_cache.hits, 0)
+        self.assertEqual(network_cache.misses, 0)
+
+    def test_overlapping_network_replaced(self):
+        network_cache = cache.NetworkCache(4)
+        network_cache.add("80.58.1.0/24", "Madrid")
+        network_cache.add("80.58.2.0/24", "Barcelona")
+        network_cache.add("80.58.0.0/16", "Spain")
+        self.assertEqual(len(network_cache), 1)
+        self.assertEqual(network_cache.get("80.58.1.1"), "Spain")
+
+    def test_least_recently_used_evicted(self):
+        network_cache = cache.NetworkCache(2)
+        network_cache.add("1.1.1.0/24", "Australia")
+        network_cache.add("8.8.8.0/24", "United States")
+        # Using first entry makes second one the least recently used.
+        network_cache.get("1.1.1.1")
+        network_cache.add("80.58.0.0/16", "Spain")
+        self.assertEqual(len(network_cache), 2)
+        self.assertEqual(network_cache.evictions, 1)
+        self.assertIs(network_cache.get("8.8.8.8"), cache.MISSING)
+        self.assertEqual(network_cache.get("1.1.1.1"), "Australia")
+        self.assertEqual(network_cache.get("80.58.67.90"), "Spain")
+
+    def test_invalidate(self):
+        network_cache = cache.NetworkCache(2)
+        network_cache.add("80.58.0.0/16", "Spain")
+        network_cache.invalidate()
+        self.assertEqual(len(network_cache), 0)
+        self.assertIs(network_cache.get("80.58.67.90"), cache.MISSING)
+
+
+class TestPersistentNetworkCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temporary_directory.name,
+                                 "cache.sqlite")
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def _create_cache(self, size=4, table="networks"):
+        persistent_cache = cache.PersistentNetworkCache(self.path, DAY, size,
+                                                        table)
+        self.addCleanup(persistent_cache.close)
+        return persistent_cache
+
+    def test_get_kept_between_runs(self):
+        persistent_cache = self._create_cache()
+        persistent_cache.add("80.58.0.0/16", {"country": "Spain"})
+        persistent_cache.add("2001:4860::/32", {"country": "United States"})
+        persistent_cache.close()
+        persistent_cache = self._create_cache()
+        self.assertEqual(len(persistent_cache), 2)
+        self.assertEqual(persistent_cache.get("80.58.0.0"),
+                         {"country": "Spain"})
+        self.assertEqual(persistent_cache.get("80.58.255.255"),
+                         {"country": "Spain"})
+        self.assertEqual(persistent_cache.get("2001:4860:ffff::"),
+                         {"country": "United States"})
+        self.assertIs(persistent_cache.get("80.59.0.0"), cache.MISSING)
+        self.assertIs(persistent_cache.get("80.57.255.255"), cache.MISSING)
+        self.assertIs(persistent_cache.get("not an address"), cache.MISSING)
+        self.assertEqual(persistent_cache.hits, 3)
+        self.assertEqual(persistent_cache.misses, 3)
+
+    def test_overlapping_network_replaced(self):
+        persistent_cache = self._create_cache()
+        persistent_cache.add("80.58.1.0/24", "Madrid")
+        persistent_cache.add("80.58.2.0/24", "Barcelona")
+        persistent_cache.add("80.58.0.0/16", "Spain")
+        self.assertEqual(len(persistent_cache), 1)
+        self.assertEqual(persistent_cache.get("80.58.1.1"), "Spain")
+        persistent_cache.add("80.58.3.0/24", "Valencia")
+        self.assertEqual(len(persistent_cache), 1)
+        self.assertIs(persistent_cache.get("80.58.1.1"), cache.MISSING)
+
+    def test_tables_share_file(self):
+        city_cache = self._create_cache()
+        country_cache = self._create_cache(table="country_networks")
+        city_cache.add("80.58.1.0/24", "Madrid")
+        country_cache.add("80.58.0.0/16", "Spain")
+        # Entries of one table never replace those of another.
+        self.assertEqual(city_cache.get("80.58.1.1"), "Madrid")
+        self.assertEqual(country_cache.get("80.58.1.1"), "Spain")
+        self.assertIs(city_cache.get("80.58.2.1"), cache.MISSING)
+        self.assertEqual(len(city_cache), 1)
+        self.assertEqual(len(country_cache), 1)
+
+    def test_expired(self):
+        persistent_cache = self._create_cache()
+        now = 1000 * DAY
+        with unittest.mock.patch("time.time", return_value=now):
+            persistent_cache.add("80.58.0.0/16", "Spain")
+        with unittest.mock.patch("time.time", return_value=now + DAY - 1):
+            self.assertEqual(persistent_cache.get("80.58.67.90"), "Spain")
+        with unittest.mock.patch("time.time", return_value=now + DAY + 1):
+            self.assertIs(persistent_cache.get("80.58.67.90"), cache.MISSING)
+            persistent_cache.compact()
+        self.assertEqual(len(persistent_cache), 0)
+
+    def test_oldest_evicted(self):
+        persistent_cache = self._create_cache(size=10)
+        now = time.time()
+        networks = ["10.0.{0}.0/24".format(number) for number in range(12)]
+        for number, network in enumerate(networks[:11]):
+            with unittest.mock.patch("time.time",
+                                     return_value=now + number):
+                persistent_cache.add(network, network)
+        # Evicted down to low water mark, not just under size.
+        self.assertEqual(len(persistent_cache), 9)
+        self.assertEqual(persistent_cache.evictions, 2)
+        self.assertIs(persistent_cache.get("10.0.0.1"), cache.MISSING)
+        self.assertIs(persistent_cache.get("10.0.1.1"), cache.MISSING)
+        self.assertEqual(persistent_cache.get("10.0.2.1"), "10.0.2.0/24")
+        # So next entry fits without compacting again.
+        with unittest.mock.patch.object(persistent_cache, "compact") as \
+                compact:
+            persistent_cache.add(networks[11], networks[11])
+        compact.assert_not_called()
+        self.assertEqual(len(persistent_cache), 10)
+
+    def test_not_valid_file(self):
+        with open(self.path, "w") as cache_file:
+            cache_file.write("This is not a SQLite database." * 100)
+        with self.assertRaises(cache.PersistentCacheError):
+            cache.PersistentNetworkCache(self.path, DAY, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
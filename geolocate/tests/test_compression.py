@@ -0,0 +1,82 @@
+"""
+ test_compression.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import io
+import os
+import tempfile
+import unittest
+
+import geolocate.classes.compression as compression
+
+TEST_DATA = b"line 1 80.58.67.90\nlatin1 \xf1 line\n" * 1000
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def _write_file(self, name, data):
+        path = os.path.join(self.temporary_directory.name, name)
+        with open(path, "wb") as output_file:
+            output_file.write(data)
+        return path
+
+    def _compress(self, data, compression_format):
+        output = io.BytesIO()
+        compressed_stream = compression.open_compressed(output,
+                                                        compression_format)
+        compressed_stream.write(data)
+        compressed_stream.close()
+        self.assertFalse(output.closed)
+        return output.getvalue()
+
+    def _check_round_trip(self, compression_format):
+        compressed_data = self._compress(TEST_DATA, compression_format)
+        # Extension is misleading on purpose, only magic numbers count.
+        path = self._write_file("input.log", compressed_data)
+        self.assertEqual(compression.detect_compression(path),
+                         compression_format)
+        with compression.open_decompressed(path,
+                                           compression_format) as input_file:
+            self.assertEqual(input_file.readline(), b"line 1 80.58.67.90\n")
+            self.assertEqual(input_file.read(), TEST_DATA[19:])
+
+    def test_gzip(self):
+        self._check_round_trip(compression.GZIP)
+
+    def test_bzip2(self):
+        self._check_round_trip(compression.BZIP2)
+
+    def test_xz(self):
+        self._check_round_trip(compression.XZ)
+
+    @unittest.skipIf(compression.zstandard is None,
+                     "zstandard package is not installed")
+    def test_zstd(self):
+        self._check_round_trip(compression.ZSTD)
+
+    def test_uncompressed(self):
+        path = self._write_file("input.log.gz", TEST_DATA)
+        self.assertIsNone(compression.detect_compression(path))
+        with compression.open_decompressed(path, None) as input_file:
+            self.assertEqual(input_file.read(), TEST_DATA)
+
+    def test_empty_file(self):
+        path = self._write_file("empty.log", b"")
+        self.assertIsNone(compression.detect_compression(path))
+
+    def test_unknown_format(self):
+        with self.assertRaises(compression.CompressionNotSupported):
+            compression.open_compressed(io.BytesIO(), "rar")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -61,6 +61,29 @@ class TestConfiguration(unittest.TestCase):
             correct_path = "local_database"
             self._test_correct_parameter("local_database_folder", correct_path)
 
+    def test_local_database_mode_validation(self):
+        self._test_wrong_parameter("local_database_mode", "mmap_fast")
+        for mode in config.LOCAL_DATABASE_MODES:
+            self._test_correct_parameter("local_database_mode", mode)
+
+    def test_integer_parameters_validation(self):
+        for parameter in ["persistent_cache_ttl", "persistent_cache_size",
+                          "webservice_concurrency", "webservice_deadline",
+                          "adaptive_max_latency", "adaptive_min_success_rate",
+                          "cache_size"]:
+            self._test_wrong_parameter(parameter, "0")
+            self._test_correct_parameter(parameter, "7")
+        self._test_wrong_parameter("adaptive_min_success_rate", "101")
+
+    def test_boolean_parameters_validation(self):
+        self._test_wrong_parameter("webservice_cache_late_answers", "maybe")
+        self._test_wrong_parameter("adaptive_preference", "maybe")
+        for value, expected in [("no", False), ("True", True), (False, False)]:
+            configuration = config.Configuration()
+            configuration.webservice_cache_late_answers = value
+            self.assertIs(configuration.webservice_cache_late_answers,
+                          expected)
+
     def _test_wrong_parameter(self, parameter, value):
         configuration = config.Configuration()
         with self.assertRaises(config.ParameterNotValid):
@@ -94,6 +117,36 @@ class TestConfiguration(unittest.TestCase):
             self.assertEqual(default_configuration, configuration_loaded,
                              msg="Default configuration not regenerated.")
 
+    def test_read_config_file_wrong_parameter(self):
+        self._test_wrong_config_file_parameter("cache", "cache_size", "0")
+        self._test_wrong_config_file_parameter(
+            "cache", "persistent_cache_ttl", "0")
+        self._test_wrong_config_file_parameter(
+            "cache", "persistent_cache_size", "-1")
+        self._test_wrong_config_file_parameter(
+            "webservice", "webservice_concurrency", "0")
+        self._test_wrong_config_file_parameter(
+            "webservice", "webservice_deadline", "0")
+        self._test_wrong_config_file_parameter(
+            "local_database", "local_database_mode", "mmap_fast")
+        self._test_wrong_config_file_parameter(
+            "locators_preference", "adaptive_max_latency", "0")
+        self._test_wrong_config_file_parameter(
+            "locators_preference", "adaptive_min_success_rate", "0")
+        self._test_wrong_config_file_parameter(
+            "locators_preference", "adaptive_min_success_rate", "101")
+
+    def _test_wrong_config_file_parameter(self, section, parameter, value):
+        with testing_tools.WorkingDirectoryChanged(WORKING_DIR), \
+                testing_tools.OriginalFileSaved(GEOLOCATE_CONFIG_FILE):
+            config._create_default_config_file()
+            configuration_parser = config._create_config_parser()
+            configuration_parser[section][parameter] = value
+            with open(GEOLOCATE_CONFIG_FILE, "w") as config_file:
+                configuration_parser.write(config_file)
+            with self.assertRaises(config.ParameterNotValid):
+                config._read_config_file()
+
     def test_read_config_file_config_not_found(self):
         with testing_tools.WorkingDirectoryChanged(WORKING_DIR), \
                 testing_tools.OriginalFileSaved(GEOLOCATE_CONFIG_FILE):
@@ -132,6 +185,29 @@ class TestConfiguration(unittest.TestCase):
                          config.DEFAULT_DATABASE_DOWNLOAD_URL)
         self.assertEqual(configuration.update_interval,
                          config.DEFAULT_UPDATE_INTERVAL)
+        self.assertEqual(configuration.local_database_mode,
+                         config.DEFAULT_LOCAL_DATABASE_MODE)
+        self.assertEqual(configuration.webservice_concurrency,
+                         config.DEFAULT_WEBSERVICE_CONCURRENCY)
+        self.assertEqual(configuration.webservice_deadline,
+                         config.DEFAULT_WEBSERVICE_DEADLINE)
+        self.assertEqual(configuration.webservice_cache_late_answers,
+                         config.DEFAULT_WEBSERVICE_CACHE_LATE_ANSWERS)
+        self.assertEqual(configuration.local_country_database_path,
+                         os.path.join(config.DEFAULT_LOCAL_DATABASE_FOLDER,
+                                      config.DEFAULT_LOCAL_COUNTRY_DATABASE_NAME))
+        self.assertEqual(configuration.adaptive_preference,
+                         config.DEFAULT_ADAPTIVE_PREFERENCE)
+        self.assertEqual(configuration.adaptive_max_latency,
+                         config.DEFAULT_ADAPTIVE_MAX_LATENCY)
+        self.assertEqual(configuration.adaptive_min_success_rate,
+                         config.DEFAULT_ADAPTIVE_MIN_SUCCESS_RATE)
+        self.assertEqual(configuration.persistent_cache_path,
+                         config.DEFAULT_PERSISTENT_CACHE_PATH)
+        self.assertEqual(configuration.persistent_cache_ttl,
+                         config.DEFAULT_PERSISTENT_CACHE_TTL)
+        self.assertEqual(configuration.persistent_cache_size,
+                         config.DEFAULT_PERSISTENT_CACHE_SIZE)
 
     def test_config_get_disabled_locators_preference(self):
         new_locator_list = ["geoip2_local", ]
@@ -0,0 +1,125 @@
+"""
+ test_download.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import os
+import tempfile
+import unittest
+
+import geolocate.classes.download as download
+import geolocate.tests.fake_servers as fake_servers
+
+TEST_CONTENT = bytes(range(256)) * 40
+NEW_TEST_CONTENT = TEST_CONTENT[::-1]
+
+
+class TestDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.download_folder = os.path.join(self.temporary_directory.name,
+                                            "downloaded")
+        os.mkdir(self.download_folder)
+        self.server = fake_servers.FakeDownloadServer(TEST_CONTENT)
+        self.server.__enter__()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        self.temporary_directory.cleanup()
+
+    def _create_downloader(self):
+        folder = self.temporary_directory.name
+        return download.Downloader(self.server.url,
+                                   os.path.join(folder, "file.part"),
+                                   os.path.join(folder, "file.json"))
+
+    def _assert_downloaded(self, path, content):
+        self.assertEqual(os.path.dirname(path), self.download_folder)
+        self.assertEqual(os.path.basename(path), "GeoLite2-City.mmdb.gz")
+        with open(path, "rb") as downloaded_file:
+            self.assertEqual(downloaded_file.read(), content)
+        os.remove(path)
+
+    def test_fetch(self):
+        downloader = self._create_downloader()
+        path = downloader.fetch(self.download_folder)
+        self._assert_downloaded(path, TEST_CONTENT)
+        self.assertNotIn("If-None-Match", self.server.requests[0])
+        self.assertIsNone(downloader.last_checked)
+        downloader.commit()
+        metadata = self._create_downloader().metadata
+        self.assertEqual(metadata["url"], self.server.url)
+        self.assertEqual(metadata["etag"], self.server.etag)
+        self.assertEqual(metadata["last_modified"], self.server.last_modified)
+        self.assertEqual(metadata["size"], len(TEST_CONTENT))
+        self.assertEqual(metadata["downloaded"], metadata["checked"])
+
+    def test_fetch_not_modified(self):
+        downloader = self._create_downloader()
+        downloader.fetch(self.download_folder)
+        downloader.commit()
+        # Metadata is kept between runs.
+        downloader = self._create_downloader()
+        self.assertIsNone(downloader.fetch(self.download_folder))
+        self.assertEqual(self.server.requests[1]["If-None-Match"],
+                         self.server.etag)
+        self.assertIsNotNone(downloader.last_checked)
+        self.server.set_content(NEW_TEST_CONTENT, '"2"',
+                                "Tue, 02 Jan 2024 00:00:00 GMT")
+        path = downloader.fetch(self.download_folder)
+        self._assert_downloaded(path, NEW_TEST_CONTENT)
+
+    def test_fetch_not_committed(self):
+        downloader = self._create_downloader()
+        downloader.fetch(self.download_folder)
+        # File was not used, so it must be downloaded again.
+        path = downloader.fetch(self.download_folder)
+        self._assert_downloaded(path, TEST_CONTENT)
+        self.assertNotIn("If-None-Match", self.server.requests[1])
+
+    def test_fetch_unconditional(self):
+        downloader = self._create_downloader()
+        downloader.fetch(self.download_folder)
+        downloader.commit()
+        path = downloader.fetch(self.download_folder, conditional=False)
+        self._assert_downloaded(path, TEST_CONTENT)
+
+    def test_fetch_resume(self):
+        downloader = self._create_downloader()
+        self.server.cut_after = 1000
+        with self.assertRaises(download.DownloadIncomplete):
+            downloader.fetch(self.download_folder)
+        self.assertEqual(os.listdir(self.download_folder), [])
+        # Unfinished download is resumed in a later run.
+        path = self._create_downloader().fetch(self.download_folder)
+        self._assert_downloaded(path, TEST_CONTENT)
+        self.assertEqual(self.server.requests[1]["Range"], "bytes=1000-")
+        self.assertEqual(self.server.requests[1]["If-Range"],
+                         self.server.etag)
+
+    def test_fetch_resume_changed(self):
+        downloader = self._create_downloader()
+        self.server.cut_after = 1000
+        with self.assertRaises(download.DownloadIncomplete):
+            downloader.fetch(self.download_folder)
+        self.server.set_content(NEW_TEST_CONTENT, '"2"',
+                                "Tue, 02 Jan 2024 00:00:00 GMT")
+        path = downloader.fetch(self.download_folder)
+        # Partial data was from old file, so it is discarded.
+        self._assert_downloaded(path, NEW_TEST_CONTENT)
+
+    def test_read_url(self):
+        self.server.checksum_text = "abcd  GeoLite2-City.mmdb.gz\n"
+        self.assertEqual(download.read_url(self.server.url + ".sha256"),
+                         self.server.checksum_text)
+        with self.assertRaises(ValueError):
+            download.read_url(self.server.url, max_size=100)
+        with self.assertRaises(OSError):
+            download.read_url(self.server.url + ".missing")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,29 +8,41 @@
 import os
 import shutil
 import tempfile
+import ipaddress
 import unittest
 import datetime
+import gzip
+import hashlib
+import io
+import multiprocessing
 import subprocess
+import sys
+import time
+import unittest.mock
 
 import geoip2.database as database
+import geoip2.models as models
 import geoip2.webservice as webservice
 
 import geolocate.classes.config as config
+import geolocate.classes.exceptions as exceptions
 import geolocate.classes.geowrapper as geoip
-import geolocate.tests.console_mocks as console_mocks
+import geolocate.tests.fake_servers as fake_servers
 import geolocate.tests.testing_tools as testing_tools
 
 
 TEST_IP = "128.101.101.101"
 TEST_IP_CITY = "Minneapolis"
 WORKING_DIR = "./geolocate/"
+# Processes started at once to check only one of them downloads database.
+CONCURRENT_PROCESSES = 8
 
 
 class TestGeoWrapper(unittest.TestCase):
     def test_geoip_database_add_locators_default_configuration(self):
         with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
             geoip_database = _create_default_geoip_database()
-            locators_length = len(geoip_database._locators)
+            locators_length = len(geoip_database._locator_factories)
             # With default configuration only local database locator should be
             # activated.
             self.assertEqual(locators_length, 1,
@@ -38,6 +50,30 @@ class TestGeoWrapper(unittest.TestCase):
             self.assertIsInstance(geoip_database.geoip2_local,
                                   geoip.LocalDatabaseGeoLocator)
 
+    def test_geoip_database_lazy_locators(self):
+        with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
+            geoip_database = _create_non_default_geoip_database()
+            self.assertEqual(len(geoip_database._locators), 0,
+                             msg="Locators created before being needed.")
+            geoip_database._locators_preference = [geoip.GEOIP2_LOCAL_TAG]
+            geodata = geoip_database.locate(TEST_IP)
+            self.assertEqual(geodata.city.name, TEST_IP_CITY)
+            self.assertEqual(list(geoip_database._locators),
+                             [geoip.GEOIP2_LOCAL_TAG])
+            self.assertIs(geoip_database.geoip2_local,
+                          geoip_database.geoip2_local)
+
+    def test_geoip_database_open_local_database(self):
+        with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
+            geoip_database = _create_non_default_geoip_database()
+            geoip_database._locators_preference = [geoip.GEOIP2_WEBSERVICE_TAG]
+            geoip_database.open_local_database()
+            self.assertEqual(len(geoip_database._locators), 0)
+            geoip_database._locators_preference = [geoip.GEOIP2_LOCAL_TAG]
+            geoip_database.open_local_database()
+            self.assertEqual(list(geoip_database._locators),
+                             [geoip.GEOIP2_LOCAL_TAG])
+
     def test_geoip_database_locate(self):
         with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
             new_locator_list = ["geoip2_local", "geoip2_webservice"]
@@ -50,6 +86,386 @@ class TestGeoWrapper(unittest.TestCase):
             geodata = geoip_database.locate(TEST_IP)
             self.assertEqual(geodata.city.name, TEST_IP_CITY)
 
+    def test_local_database_locate_detail(self):
+        with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
+            geoip_database = _create_default_geoip_database()
+            local_locator = geoip_database.geoip2_local
+            model = local_locator.locate(TEST_IP)
+            record = local_locator.locate(TEST_IP, geoip.DETAIL_COORDINATES)
+            for field in ("continent", "country", "city"):
+                self.assertEqual(getattr(record, field).name,
+                                 getattr(model, field).name)
+            self.assertEqual(record.location.latitude,
+                             model.location.latitude)
+            self.assertEqual(record.location.longitude,
+                             model.location.longitude)
+            self.assertIn(ipaddress.ip_address(TEST_IP),
+                          record.traits.network)
+
+    def test_get_location_record(self):
+        raw_record = {"continent": {"names": {"en": "Europe", "es": "Europa"}},
+                      "country": {"names": {"en": "Spain"}},
+                      "location": {"latitude": 40.4, "longitude": -3.7}}
+        traits = geoip.TraitsRecord("80.58.67.90", 16)
+        record = geoip._get_location_record(raw_record,
+                                            geoip.DETAIL_COUNTRY, traits)
+        self.assertEqual(record.continent.name, "Europe")
+        self.assertEqual(record.country.name, "Spain")
+        # Fields over requested detail are not taken.
+        self.assertIsNone(record.city.name)
+        self.assertIsNone(record.location.latitude)
+        self.assertEqual(record.traits.network,
+                         ipaddress.ip_network("80.58.0.0/16"))
+        record = geoip._get_location_record(raw_record,
+                                            geoip.DETAIL_COORDINATES, traits)
+        self.assertIsNone(record.city.name)
+        self.assertEqual(record.location.latitude, 40.4)
+
+    def test_geoip_database_locate_cached(self):
+        geoip_database, mocked_locator = _create_mocked_geoip_database()
+        mocked_locator.locate.return_value = TEST_IP_CITY
+        for _ in range(3):
+            self.assertEqual(geoip_database.locate(TEST_IP), TEST_IP_CITY)
+        mocked_locator.locate.assert_called_once_with(TEST_IP, None)
+        statistics = geoip_database.statistics
+        self.assertEqual(statistics["cache_hits"], 2)
+        self.assertEqual(statistics["cache_misses"], 1)
+        geoip_database.invalidate_cache()
+        geoip_database.locate(TEST_IP)
+        self.assertEqual(mocked_locator.locate.call_count, 2)
+
+    def test_geoip_database_locate_not_found_cached(self):
+        geoip_database, mocked_locator = _create_mocked_geoip_database()
+        mocked_locator.locate.side_effect = ValueError()
+        for _ in range(2):
+            with self.assertRaises(exceptions.IPNotFound):
+                geoip_database.locate(TEST_IP)
+        mocked_locator.locate.assert_called_once_with(TEST_IP, None)
+
+    def test_geoip_database_locate_network_cached(self):
+        geoip_database, mocked_locator = _create_mocked_geoip_database()
+        geodata = unittest.mock.Mock()
+        geodata.traits.network = ipaddress.ip_network("80.58.0.0/16")
+        mocked_locator.locate.return_value = geodata
+        self.assertIs(geoip_database.locate("80.58.67.90"), geodata)
+        self.assertIs(geoip_database.locate("80.58.250.1"), geodata)
+        mocked_locator.locate.assert_called_once_with("80.58.67.90", None)
+        self.assertEqual(geoip_database.statistics["network_cache_hits"], 1)
+        geoip_database.locate("80.59.0.1")
+        self.assertEqual(mocked_locator.locate.call_count, 2)
+
+    def test_geoip_database_locate_persistently_cached(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            cache_path = os.path.join(temporary_directory, "cache/ws.sqlite")
+            geoip_database, mocked_locator = \
+                _create_mocked_webservice_geoip_database(cache_path)
+            with database.Reader(config.Configuration().local_database_path) \
+                    as reader:
+                mocked_locator.locate.return_value = reader.city(TEST_IP)
+            geoip_database.locate(TEST_IP)
+            mocked_locator.locate.assert_called_once_with(TEST_IP, None)
+            self.assertEqual(
+                geoip_database.statistics["webservice_cache_entries"], 1)
+            # Answers paid for are not asked for again in later runs, for any
+            # address in the same network.
+            geoip_database, mocked_locator = \
+                _create_mocked_webservice_geoip_database(cache_path)
+            geodata = geoip_database.locate("128.101.1.1")
+            mocked_locator.locate.assert_not_called()
+            self.assertEqual(geodata.city.name, TEST_IP_CITY)
+            self.assertEqual(geodata.traits.ip_address,
+                             ipaddress.ip_address("128.101.1.1"))
+            self.assertEqual(
+                geoip_database.statistics["webservice_queries_saved"], 1)
+
+    def test_geoip_database_persistent_cache_not_valid(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            cache_path = os.path.join(temporary_directory, "ws.sqlite")
+            _create_invalid_file(cache_path)
+            geoip_database, mocked_locator = \
+                _create_mocked_webservice_geoip_database(cache_path)
+            mocked_locator.locate.return_value = TEST_IP_CITY
+            with unittest.mock.patch("sys.stderr",
+                                     new_callable=io.StringIO) as stderr:
+                self.assertEqual(geoip_database.locate(TEST_IP),
+                                 TEST_IP_CITY)
+            self.assertIn("won't be cached", stderr.getvalue())
+            self.assertNotIn("webservice_cache_entries",
+                             geoip_database.statistics)
+
+    def test_geoip_database_prefetch(self):
+        addresses = ["80.58.{0}.1".format(number) for number in range(8)]
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                fake_servers.FakeWebServiceServer(
+                    delay=0.2, not_found=[addresses[0]]) as server, \
+                server.redirect_clients():
+            geoip_database = _create_webservice_geoip_database(
+                temporary_directory, concurrency=8)
+            self.assertTrue(geoip_database.prefetching)
+            start = time.monotonic()
+            geoip_database.prefetch(addresses + addresses)
+            # Lookups ran at once, not one after another.
+            self.assertLess(time.monotonic() - start, 0.2 * len(addresses))
+            self.assertEqual(sorted(server.queries), sorted(addresses))
+            # Prefetched answers are used in whatever order they are asked.
+            for address in reversed(addresses[1:]):
+                geodata = geoip_database.locate(address)
+                self.assertEqual(geodata.traits.ip_address,
+                                 ipaddress.ip_address(address))
+            # Address webservice could not find is asked to next locator.
+            geodata = geoip_database.locate(addresses[0])
+            self.assertEqual(geodata.city.name, "Madrid")
+            self.assertEqual(len(server.queries), len(addresses))
+
+    def test_geoip_database_prefetch_not_first_locator(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            geoip_database = _create_webservice_geoip_database(
+                temporary_directory, concurrency=8)
+            geoip_database._locators_preference = [
+                geoip.GEOIP2_LOCAL_TAG, geoip.GEOIP2_WEBSERVICE_TAG]
+            self.assertFalse(geoip_database.prefetching)
+            geoip_database = _create_webservice_geoip_database(
+                temporary_directory, concurrency=1)
+            self.assertFalse(geoip_database.prefetching)
+
+    def test_geoip_database_webservice_deadline(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                fake_servers.FakeWebServiceServer(delay=0.5) as server, \
+                server.redirect_clients():
+            geoip_database = _create_webservice_geoip_database(
+                temporary_directory, concurrency=1, deadline=100)
+            start = time.monotonic()
+            geodata = geoip_database.locate(TEST_IP)
+            # Next locator answered instead of waiting for webservice.
+            self.assertLess(time.monotonic() - start, 0.4)
+            self.assertEqual(geodata.city.name, TEST_IP_CITY)
+            # Late answer is cached once it arrives.
+            # Lookup still running is got by asking for it again.
+            geoip_database.geoip2_webservice.submit(TEST_IP).result()
+            geoip_database.locate("80.58.67.1")
+            statistics = geoip_database.statistics
+            self.assertEqual(statistics["webservice_deadline_misses"], 2)
+            self.assertEqual(statistics["webservice_late_answers_cached"], 1)
+            self.assertEqual(statistics["geoip2_webservice_timeout_failures"],
+                             2)
+            geoip_database = _create_webservice_geoip_database(
+                temporary_directory, concurrency=1, deadline=100)
+            self.assertEqual(geoip_database.locate(TEST_IP).city.name,
+                             "Madrid")
+            self.assertEqual(server.queries, [TEST_IP, "80.58.67.1"])
+
+    def test_geoip_database_webservice_deadline_late_answers_not_cached(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                fake_servers.FakeWebServiceServer(delay=0.5) as server, \
+                server.redirect_clients():
+            geoip_database = _create_webservice_geoip_database(
+                temporary_directory, concurrency=1, deadline=100,
+                cache_late_answers=False)
+            geoip_database.locate(TEST_IP)
+            # Lookup still running is got by asking for it again.
+            geoip_database.geoip2_webservice.submit(TEST_IP).result()
+            geoip_database.locate("80.58.67.1")
+            statistics = geoip_database.statistics
+            self.assertEqual(statistics["webservice_deadline_misses"], 2)
+            self.assertEqual(statistics["webservice_late_answers_cached"], 0)
+
+    def test_geoip_database_prefetch_deadline(self):
+        addresses = [TEST_IP, "80.58.67.1", "80.58.67.2"]
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                fake_servers.FakeWebServiceServer(delay=0.5) as server, \
+                server.redirect_clients():
+            geoip_database = _create_webservice_geoip_database(
+                temporary_directory, concurrency=8, deadline=100)
+            start = time.monotonic()
+            geoip_database.prefetch(addresses)
+            self.assertLess(time.monotonic() - start, 0.4)
+            # Lookups that missed deadline are not waited for again.
+            start = time.monotonic()
+            self.assertEqual(geoip_database.locate(TEST_IP).city.name,
+                             TEST_IP_CITY)
+            self.assertLess(time.monotonic() - start, 0.1)
+            self.assertEqual(
+                geoip_database.statistics["webservice_deadline_misses"], 3)
+
+    def test_geoip_database_webservice_country_endpoint(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                fake_servers.FakeWebServiceServer() as server, \
+                server.redirect_clients():
+            geoip_database = _create_webservice_geoip_database(
+                temporary_directory, concurrency=1)
+            geodata = geoip_database.locate("80.58.67.1", geoip.DETAIL_COUNTRY)
+            self.assertNotIsInstance(geodata, models.City)
+            self.assertEqual(geodata.country.name, "Spain")
+            geodata = geoip_database.locate("80.58.67.2", geoip.DETAIL_CITY)
+            self.assertEqual(geodata.city.name, "Madrid")
+            self.assertEqual(server.endpoints, {"country": 1, "city": 1})
+            # Cached city answers are enough for country lookups, but not
+            # the other way round.
+            geoip_database = _create_webservice_geoip_database(
+                temporary_directory, concurrency=1)
+            for ip in ["80.58.67.1", "80.58.67.2"]:
+                geoip_database.locate(ip, geoip.DETAIL_CONTINENT)
+            self.assertEqual(server.endpoints, {"country": 1, "city": 1})
+            geodata = geoip_database.locate("80.58.67.1",
+                                            geoip.DETAIL_COORDINATES)
+            self.assertEqual(geodata.city.name, "Madrid")
+            self.assertEqual(server.endpoints, {"country": 1, "city": 2})
+
+    def test_web_service_geo_locator_coalesced_lookups(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                fake_servers.FakeWebServiceServer(delay=0.2) as server, \
+                server.redirect_clients():
+            geoip_database = _create_webservice_geoip_database(
+                temporary_directory, concurrency=8)
+            locator = geoip_database.geoip2_webservice
+            lookups = [locator.submit(TEST_IP) for _ in range(3)]
+            geodata = locator.locate(TEST_IP)
+            self.assertEqual(server.queries, [TEST_IP])
+            for lookup in lookups:
+                self.assertIs(lookup.result(), geodata)
+            self.assertEqual(locator.coalesced_lookups, 3)
+            self.assertEqual(geoip_database.statistics[
+                                 "webservice_coalesced_lookups"], 3)
+            # Finished lookups are not reused.
+            locator.locate(TEST_IP)
+            self.assertEqual(server.queries, [TEST_IP, TEST_IP])
+
+    def test_geoip_database_failing_locator_skipped(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            geoip_database, webservice_locator = \
+                _create_mocked_webservice_geoip_database(
+                    os.path.join(temporary_directory, "ws.sqlite"))
+            local_locator = unittest.mock.MagicMock()
+            local_locator.locate.return_value = TEST_IP_CITY
+            geoip_database._locators[geoip.GEOIP2_LOCAL_TAG] = local_locator
+            webservice_locator.locate.side_effect = TimeoutError()
+            threshold = geoip.health.DEFAULT_FAILURE_THRESHOLD
+            for number in range(threshold * 2):
+                self.assertEqual(geoip_database.locate(
+                    "80.58.67.{0}".format(number)), TEST_IP_CITY)
+            # Once failing locator is skipped, addresses go straight to the
+            # next one.
+            self.assertEqual(webservice_locator.locate.call_count, threshold)
+            self.assertEqual(local_locator.locate.call_count, threshold * 2)
+            statistics = geoip_database.statistics
+            self.assertEqual(statistics["geoip2_webservice_state"],
+                             geoip.health.OPEN)
+            self.assertEqual(statistics["geoip2_webservice_trips"], 1)
+            self.assertEqual(statistics["geoip2_webservice_timeout_failures"],
+                             threshold)
+            self.assertEqual(statistics["geoip2_local_state"],
+                             geoip.health.CLOSED)
+
+    def test_geoip_database_adaptive_preference(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                unittest.mock.patch("sys.stderr",
+                                    new_callable=io.StringIO) as stderr:
+            geoip_database, webservice_locator = \
+                _create_mocked_webservice_geoip_database(
+                    os.path.join(temporary_directory, "ws.sqlite"),
+                    adaptive_preference=True, adaptive_max_latency=300)
+            local_locator = unittest.mock.MagicMock()
+            local_locator.locate.return_value = TEST_IP_CITY
+            geoip_database._locators[geoip.GEOIP2_LOCAL_TAG] = local_locator
+            webservice_locator.locate.return_value = "Madrid"
+            webservice_locator.pop_latencies.return_value = []
+            # Mocked answers can't be stored.
+            geoip_database._persistent_cache_enabled = False
+            self.assertEqual(geoip_database.locate("80.58.67.1"), "Madrid")
+            # Webservice gets slow.
+            webservice_locator.pop_latencies.return_value = \
+                [(0.5, True)] * geoip.health.MIN_LATENCY_SAMPLES
+            self.assertEqual(geoip_database.locate("80.58.67.2"),
+                             TEST_IP_CITY)
+            self.assertEqual(webservice_locator.locate.call_count, 1)
+            self.assertEqual(geoip_database.locators_order,
+                             [geoip.GEOIP2_LOCAL_TAG,
+                              geoip.GEOIP2_WEBSERVICE_TAG])
+            decision, = geoip_database.ordering_decisions
+            self.assertEqual(decision.locator_id, geoip.GEOIP2_WEBSERVICE_TAG)
+            self.assertEqual(decision.action, geoip.health.DEMOTED)
+            self.assertIn("Locator geoip2_webservice demoted",
+                          stderr.getvalue())
+            statistics = geoip_database.statistics
+            self.assertEqual(statistics["locators_order"],
+                             "geoip2_local,geoip2_webservice")
+            self.assertEqual(statistics["locators_demotions"], 1)
+            self.assertEqual(statistics["geoip2_webservice_latency_p95"], 0.5)
+
+    def test_geoip_database_adaptive_preference_disabled(self):
+        geoip_database, _ = _create_mocked_geoip_database()
+        self.assertIs(geoip_database.locators_order,
+                      geoip_database._locators_preference)
+        self.assertEqual(geoip_database.ordering_decisions, [])
+        self.assertNotIn("locators_order", geoip_database.statistics)
+
+    def test_geoip_database_not_found_not_a_fault(self):
+        geoip_database, mocked_locator = _create_mocked_geoip_database()
+        mocked_locator.locate.side_effect = \
+            geoip.errors.AddressNotFoundError("Not found")
+        threshold = geoip.health.DEFAULT_FAILURE_THRESHOLD
+        for number in range(threshold + 1):
+            with self.assertRaises(exceptions.IPNotFound):
+                geoip_database.locate("80.58.67.{0}".format(number))
+        self.assertEqual(mocked_locator.locate.call_count, threshold + 1)
+        circuit_breaker = geoip_database.health[geoip.GEOIP2_LOCAL_TAG]
+        self.assertEqual(circuit_breaker.state, geoip.health.CLOSED)
+
+    def test_geoip_database_locator_creation_error_keeps_breaker(self):
+        geoip_database, mocked_locator = _create_mocked_geoip_database()
+        mocked_locator.locate.return_value = TEST_IP_CITY
+        del geoip_database._locators[geoip.GEOIP2_LOCAL_TAG]
+        geoip_database._locator_factories[geoip.GEOIP2_LOCAL_TAG] = \
+            unittest.mock.MagicMock(side_effect=OSError("Broken install"))
+        circuit_breaker = geoip_database._get_circuit_breaker(
+            geoip.GEOIP2_LOCAL_TAG)
+        circuit_breaker.record_failure(geoip.health.FAILURE_AUTHENTICATION)
+        # Backoff elapsed, so next lookup would be the probe.
+        circuit_breaker._retry_time = 0
+        with self.assertRaises(OSError):
+            geoip_database.locate(TEST_IP)
+        self.assertEqual(circuit_breaker.state, geoip.health.OPEN)
+        geoip_database._locator_factories[geoip.GEOIP2_LOCAL_TAG] = \
+            unittest.mock.MagicMock(return_value=mocked_locator)
+        self.assertEqual(geoip_database.locate(TEST_IP), TEST_IP_CITY)
+        self.assertEqual(circuit_breaker.state, geoip.health.CLOSED)
+
+    def test_local_database_geo_locator_country_database(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            configuration = _create_temporary_database_configuration(
+                temporary_directory)
+            local_database = geoip.LocalDatabaseGeoLocator(configuration)
+            self.assertFalse(local_database.country_database_used)
+            # City database has country data too, so it can stand for a
+            # country one.
+            shutil.copyfile(configuration.local_database_path,
+                            configuration.local_country_database_path)
+            self.assertTrue(local_database.reload_if_changed())
+            self.assertTrue(local_database.country_database_used)
+            country_db_connection = unittest.mock.Mock(
+                wraps=local_database._raw_country_db_connection)
+            local_database._raw_country_db_connection = country_db_connection
+            geodata = local_database.locate(TEST_IP, geoip.DETAIL_COUNTRY)
+            self.assertEqual(geodata.country.name, "United States")
+            country_db_connection.get_with_prefix_len.assert_called_once_with(
+                TEST_IP)
+            geodata = local_database.locate(TEST_IP, geoip.DETAIL_CITY)
+            self.assertEqual(geodata.city.name, TEST_IP_CITY)
+            country_db_connection.get_with_prefix_len.assert_called_once()
+
+    def test_local_database_geo_locator_country_database_not_valid(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            configuration = _create_temporary_database_configuration(
+                temporary_directory)
+            _create_invalid_file(configuration.local_country_database_path)
+            with unittest.mock.patch("sys.stderr",
+                                     new_callable=io.StringIO) as stderr:
+                local_database = geoip.LocalDatabaseGeoLocator(configuration)
+            self.assertIn("Country database won't be used", stderr.getvalue())
+            self.assertFalse(local_database.country_database_used)
+            geodata = local_database.locate(TEST_IP, geoip.DETAIL_COUNTRY)
+            self.assertEqual(geodata.country.name, "United States")
+
     def test_local_database_geo_locator_creation(self):
         with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
             geoip_database = _create_default_geoip_database()
@@ -57,31 +473,215 @@ class TestGeoWrapper(unittest.TestCase):
             self.assertIsInstance(connection,
                                   database.Reader)
 
-    def test_local_database_update(self):
+    def test_local_database_geo_locator_mode(self):
         with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
-            configuration = config.Configuration()
-            with testing_tools.OriginalFileSaved(
-                    configuration.local_database_path):
-                local_database = _create_too_old_database_locator(configuration)
-                local_database._update_db()
-                self.assertFalse(local_database._local_database_too_old(),
-                    msg="Database not updated.")
+            configuration = config.Configuration(local_database_mode="memory")
+            geoip_database = geoip.GeoIPDatabase(configuration)
+            self.assertEqual(geoip_database.geoip2_local.database_mode,
+                             "memory")
+            self.assertEqual(geoip_database.statistics["local_database_mode"],
+                             "memory")
+            geodata = geoip_database.locate(TEST_IP)
+            self.assertEqual(geodata.city.name, TEST_IP_CITY)
 
-    def test_local_database_too_old(self):
+    def test_select_database_mode(self):
         with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
-            configuration = config.Configuration()
+            database_path = config.Configuration().local_database_path
+            database_size = os.stat(database_path).st_size
+            big_input = geoip.Workload(database_size, 1)
+            small_input = geoip.Workload(database_size - 1, 1)
+            big_input_in_parallel = geoip.Workload(database_size, 2)
+            self.assertEqual(geoip._select_database_mode(
+                "file", big_input, database_path), "file")
+            with unittest.mock.patch.object(geoip, "_C_EXTENSION_AVAILABLE",
+                                            True):
+                self.assertEqual(geoip._select_database_mode(
+                    "auto", big_input, database_path), "mmap_ext")
+            with unittest.mock.patch.object(geoip, "_C_EXTENSION_AVAILABLE",
+                                            False):
+                self.assertEqual(geoip._select_database_mode(
+                    "auto", big_input, database_path), "memory")
+                self.assertEqual(geoip._select_database_mode(
+                    "auto", small_input, database_path), "mmap")
+                self.assertEqual(geoip._select_database_mode(
+                    "auto", big_input_in_parallel, database_path), "mmap")
+                self.assertEqual(geoip._select_database_mode(
+                    "auto", geoip.UNKNOWN_WORKLOAD, database_path), "mmap")
+
+    def test_local_database_update(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                _create_database_server() as server:
+            configuration = _create_temporary_database_configuration(
+                temporary_directory, server.url)
+            local_database = _create_too_old_database_locator(configuration)
+            local_database._update_db()
+            local_database.wait_for_refresh()
+            self.assertFalse(local_database._local_database_too_old(),
+                msg="Database not updated.")
+            # Server is asked to send it again only if it changed. When it
+            # has not, database age counts from that check.
+            with unittest.mock.patch("sys.stderr"):
+                self.assertFalse(local_database._download_fresh_database())
+            self.assertEqual(server.requests[-1]["If-None-Match"],
+                             server.etag)
+            _make_database_file_too_old(configuration)
+            self.assertFalse(local_database._local_database_too_old())
+
+    def test_local_database_too_old(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                _create_database_server() as server:
+            configuration = _create_temporary_database_configuration(
+                temporary_directory, server.url)
             database_path = configuration.local_database_path
-            with testing_tools.OriginalFileSaved(database_path):
-                _make_database_file_too_old(configuration)
-                too_old_date = geoip._get_database_last_modification(
-                    database_path)
-                # LocalDatabaseGeolocator __init__ refreshes database.
-                _ = geoip.LocalDatabaseGeoLocator(configuration)
-                new_date = geoip._get_database_last_modification(database_path)
-                delta = (new_date - too_old_date).days
-                # If database has been updated, its new date should be newer than
-                # old one (delta>0).
-                self.assertGreater(delta, 0, msg="Old database not detected.")
+            _make_database_file_too_old(configuration)
+            too_old_date = geoip._get_database_last_modification(
+                database_path)
+            # LocalDatabaseGeolocator __init__ refreshes database.
+            local_database = geoip.LocalDatabaseGeoLocator(configuration)
+            local_database.wait_for_refresh()
+            new_date = geoip._get_database_last_modification(database_path)
+            delta = (new_date - too_old_date).days
+            # If database has been updated, its new date should be newer than
+            # old one (delta>0).
+            self.assertGreater(delta, 0, msg="Old database not detected.")
+
+    def test_local_database_refresh_checksum_mismatch(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                _create_database_server() as server:
+            server.checksum_text = "0" * 64
+            configuration = _create_temporary_database_configuration(
+                temporary_directory, server.url)
+            _make_database_file_too_old(configuration)
+            with unittest.mock.patch("sys.stderr",
+                                     new_callable=io.StringIO) as stderr:
+                local_database = geoip.LocalDatabaseGeoLocator(configuration)
+                local_database.wait_for_refresh()
+            self.assertIn("SHA-256", stderr.getvalue())
+            # Database that could not be used is not taken as current.
+            self.assertTrue(local_database._local_database_too_old())
+            self.assertEqual(local_database.generation, 0)
+
+    def test_local_database_background_refresh(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                _create_database_server() as server:
+            configuration = _create_temporary_database_configuration(
+                temporary_directory, server.url)
+            _make_database_file_too_old(configuration)
+            local_database = geoip.LocalDatabaseGeoLocator(configuration)
+            old_connection = local_database._db_connection
+            self.assertTrue(local_database.wait_for_refresh(timeout=30))
+            self.assertFalse(local_database._local_database_too_old())
+            self.assertIsNot(local_database._db_connection, old_connection)
+            # Lookups started with replaced reader can still finish.
+            self.assertEqual(old_connection.city(TEST_IP).city.name,
+                             TEST_IP_CITY)
+            geodata = local_database.locate(TEST_IP)
+            self.assertEqual(geodata.city.name, TEST_IP_CITY)
+            download_metadata_name = "".join([
+                configuration.local_database_name,
+                geoip.DOWNLOAD_METADATA_SUFFIX])
+            lock_name = "".join([configuration.local_database_name,
+                                 geoip.UPDATE_LOCK_SUFFIX])
+            self.assertEqual(sorted(os.listdir(temporary_directory)),
+                             [configuration.local_database_name,
+                              download_metadata_name, lock_name])
+
+    def test_local_database_refresh_many_processes(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                _create_database_server() as server:
+            server.delay = 0.5
+            configuration = _create_temporary_database_configuration(
+                temporary_directory, server.url)
+            _make_database_file_too_old(configuration)
+            exit_codes = _locate_in_many_processes(configuration)
+            self.assertEqual(exit_codes, [0] * CONCURRENT_PROCESSES)
+            self.assertEqual(server.downloads, 1)
+            local_database = geoip.LocalDatabaseGeoLocator(configuration)
+            self.assertFalse(local_database._local_database_too_old())
+
+    def test_local_database_download_missing_many_processes(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                _create_database_server() as server:
+            server.delay = 0.5
+            configuration = _create_temporary_database_configuration(
+                temporary_directory, server.url)
+            os.remove(configuration.local_database_path)
+            # Every process waits for the one downloading database.
+            exit_codes = _locate_in_many_processes(configuration)
+            self.assertEqual(exit_codes, [0] * CONCURRENT_PROCESSES)
+            self.assertEqual(server.downloads, 1)
+
+    def test_local_database_update_lock_timeout(self):
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            configuration = _create_temporary_database_configuration(
+                temporary_directory)
+            os.remove(configuration.local_database_path)
+            lock = geoip.system.FileLock("".join([
+                configuration.local_database_path, geoip.UPDATE_LOCK_SUFFIX]))
+            with lock, \
+                    unittest.mock.patch.object(geoip, "UPDATE_LOCK_TIMEOUT",
+                                               0.2):
+                with self.assertRaises(geoip.UpdateLockTimeout):
+                    geoip.LocalDatabaseGeoLocator(configuration)
+
+    def test_geoip_database_reload_if_changed(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                tempfile.TemporaryDirectory() as new_database_directory:
+            configuration = _create_temporary_database_configuration(
+                temporary_directory)
+            geoip_database = geoip.GeoIPDatabase(configuration)
+            geoip_database.locate(TEST_IP)
+            self.assertFalse(geoip_database.reload_if_changed())
+            # Replaced as a refresh by another process would do.
+            _copy_database_file(config.Configuration(),
+                                new_database_directory)
+            os.replace(_get_database_name_path(configuration,
+                                               new_database_directory),
+                       configuration.local_database_path)
+            self.assertTrue(geoip_database.reload_if_changed())
+            self.assertFalse(geoip_database.reload_if_changed())
+            statistics = geoip_database.statistics
+            self.assertEqual(statistics["local_database_reloads"], 1)
+            self.assertEqual(statistics["cache_entries"], 0)
+            geodata = geoip_database.locate(TEST_IP)
+            self.assertEqual(geodata.city.name, TEST_IP_CITY)
+
+    def test_local_database_reload_invalid(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                tempfile.TemporaryDirectory() as new_database_directory:
+            configuration = _create_temporary_database_configuration(
+                temporary_directory)
+            local_database = geoip.LocalDatabaseGeoLocator(configuration)
+            # Current database file may be memory mapped, so it is replaced
+            # instead of being overwritten.
+            invalid_database_path = _get_database_name_path(
+                configuration, new_database_directory)
+            _create_invalid_file(invalid_database_path)
+            os.replace(invalid_database_path,
+                       configuration.local_database_path)
+            with unittest.mock.patch("sys.stderr",
+                                     new_callable=io.StringIO) as stderr:
+                self.assertFalse(local_database.reload_if_changed())
+                self.assertFalse(local_database.reload_if_changed())
+            self.assertEqual(stderr.getvalue().count("Could not reload"), 1)
+            self.assertEqual(local_database.generation, 0)
+            geodata = local_database.locate(TEST_IP)
+            self.assertEqual(geodata.city.name, TEST_IP_CITY)
+
+    def test_local_database_refresh_invalid(self):
+        with tempfile.TemporaryDirectory() as temporary_directory, \
+                tempfile.TemporaryDirectory() as download_directory:
+            configuration = _create_temporary_database_configuration(
+                temporary_directory)
+            local_database = geoip.LocalDatabaseGeoLocator(configuration)
+            _create_invalid_file(_get_database_name_path(configuration,
+                                                         download_directory))
+            with self.assertRaises(geoip.InvalidLocalDatabase):
+                local_database._write_new_database(download_directory)
+            # Current database is left untouched.
+            self.assertEqual(os.listdir(temporary_directory),
+                             [configuration.local_database_name])
+            geoip._verify_database(configuration.local_database_path)
 
     def test_local_database_locate(self):
         with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
@@ -92,7 +692,7 @@ class TestGeoWrapper(unittest.TestCase):
     def test_geoip_database_add_locators_non_default_configuration(self):
         with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
             geoip_database = _create_non_default_geoip_database()
-            locators_length = len(geoip_database._locators)
+            locators_length = len(geoip_database._locator_factories)
             # With non default configuration webservice and local database locators
             # should be activated.
             self.assertEqual(locators_length, 2,
@@ -116,9 +716,11 @@ class TestGeoWrapper(unittest.TestCase):
                 _ = geoip_database.geoip2_webservice
 
     def test_local_database_geo_locator_download_file(self):
-        with testing_tools.WorkingDirectoryChanged(WORKING_DIR), \
-             tempfile.TemporaryDirectory() as temporary_directory:
-            configuration = config.Configuration()
+        with tempfile.TemporaryDirectory() as database_directory, \
+                tempfile.TemporaryDirectory() as temporary_directory, \
+                _create_database_server() as server:
+            configuration = _create_temporary_database_configuration(
+                database_directory, server.url)
             self._assert_folder_empty(temporary_directory)
             geoip_local_database = geoip.LocalDatabaseGeoLocator(configuration)
             geoip_local_database._download_file(temporary_directory)
@@ -177,6 +779,46 @@ class TestGeoWrapper(unittest.TestCase):
                                                              temporary_directory)
             self.assertTrue(os.path.exists(decompressed_file_path))
 
+    def test_decompress_file_in_chunks(self):
+        configuration = config.Configuration()
+        original_data = os.urandom(5000) * 20
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            compressed_path = _get_dummy_database_path_name(
+                configuration, temporary_directory)
+            # Two gzip members, as concatenated .gz files have.
+            with open(compressed_path, "wb") as compressed_file:
+                compressed_file.write(gzip.compress(original_data[:30000]))
+                compressed_file.write(gzip.compress(original_data[30000:]))
+            with open(compressed_path, "rb") as compressed_file:
+                checksum = hashlib.sha256(compressed_file.read()).hexdigest()
+            with unittest.mock.patch.object(geoip, "DECOMPRESSION_CHUNK_SIZE",
+                                            1024):
+                geoip._decompress_file(temporary_directory, checksum.upper())
+            decompressed_path = _get_database_name_path(configuration,
+                                                        temporary_directory)
+            with open(decompressed_path, "rb") as decompressed_file:
+                self.assertEqual(decompressed_file.read(), original_data)
+            with self.assertRaises(geoip.ChecksumMismatch):
+                geoip._decompress_file(temporary_directory, "0" * 64)
+
+    def test_decompress_file_truncated(self):
+        configuration = config.Configuration()
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            compressed_path = _get_dummy_database_path_name(
+                configuration, temporary_directory)
+            with open(compressed_path, "wb") as compressed_file:
+                compressed_file.write(gzip.compress(os.urandom(5000))[:-100])
+            with self.assertRaises(EOFError):
+                geoip._decompress_file(temporary_directory)
+
+    def test_parse_checksum(self):
+        checksum = "A" * 64
+        self.assertEqual(geoip._parse_checksum(
+            "{0}  GeoLite2-City.tar.gz\n".format(checksum)), checksum.lower())
+        for wrong_text in ["", "1234  GeoLite2-City.tar.gz", "g" * 64]:
+            with self.assertRaises(ValueError):
+                geoip._parse_checksum(wrong_text)
+
     # I've didn't get this to pass although debug shows mocked function is
     # actually executed. I guess I'm not dealing right with mock library.
     # Nevertheless I leave the test here, someone may fix it.
@@ -202,10 +844,10 @@ class TestGeoWrapper(unittest.TestCase):
     def test_print_compressed_file_not_found_error(self):
         error_message = "Problem decompressing updated database."
         with tempfile.TemporaryDirectory() as temporary_directory, \
-                console_mocks.MockedConsoleOutput() as console:
+                unittest.mock.patch("sys.stderr",
+                                    new_callable=io.StringIO) as stderr:
             geoip._decompress_file(temporary_directory)
-            console_output = console.output()
-            self.assertTrue(error_message in console_output)
+            self.assertTrue(error_message in stderr.getvalue())
 
     def test_get_uncompressed_file_name_path(self):
         compressed_filename_path = "/home/dante/downloads/GeoLite2-City.mmdb.gz"
@@ -217,10 +859,12 @@ class TestGeoWrapper(unittest.TestCase):
         with testing_tools.WorkingDirectoryChanged(WORKING_DIR):
             geoip_database = _create_default_geoip_database()
             configuration = geoip_database._configuration
+            # Locators are created lazily, so get it while database exists.
+            local_locator = geoip_database.geoip2_local
             with testing_tools.OriginalFileSaved(
                     configuration.local_database_path):
                 _remove_file(configuration.local_database_path)
-                is_too_old = geoip_database.geoip2_local._local_database_too_old()
+                is_too_old = local_locator._local_database_too_old()
                 self.assertTrue(is_too_old)
 
     def _assert_folder_empty(self, folder_path):
@@ -247,6 +891,86 @@ def _create_non_default_geoip_database():
     return geoip_database
 
 
+def _create_mocked_geoip_database():
+    configuration = config.Configuration()
+    configuration.locators_preference = [geoip.GEOIP2_LOCAL_TAG]
+    with unittest.mock.patch.object(geoip.GeoIPDatabase, "_add_locators"):
+        geoip_database = geoip.load_geoip_database(configuration)
+    mocked_locator = unittest.mock.MagicMock()
+    geoip_database._locators[geoip.GEOIP2_LOCAL_TAG] = mocked_locator
+    return geoip_database, mocked_locator
+
+
+def _create_mocked_webservice_geoip_database(persistent_cache_path,
+                                             **configuration_parameters):
+    configuration = config.Configuration(
+        user_id="user2014", license_key="XXXXX",
+        persistent_cache_path=persistent_cache_path,
+        **configuration_parameters)
+    with unittest.mock.patch.object(geoip.GeoIPDatabase, "_add_locators"):
+        geoip_database = geoip.load_geoip_database(configuration)
+    mocked_locator = unittest.mock.MagicMock()
+    geoip_database._locators[geoip.GEOIP2_WEBSERVICE_TAG] = mocked_locator
+    return geoip_database, mocked_locator
+
+
+def _create_webservice_geoip_database(temporary_directory, concurrency,
+                                      deadline=config.DEFAULT_WEBSERVICE_DEADLINE,
+                                      cache_late_answers=True):
+    configuration = config.Configuration(
+        user_id="42", license_key="XXXXX",
+        webservice_concurrency=concurrency,
+        webservice_deadline=deadline,
+        webservice_cache_late_answers=cache_late_answers,
+        persistent_cache_path=os.path.join(temporary_directory,
+                                           "webservice.sqlite"))
+    return geoip.load_geoip_database(configuration)
+
+
+def _create_temporary_database_configuration(temporary_directory,
+                                             download_url=None):
+    if download_url is None:
+        download_url = config.DEFAULT_DATABASE_DOWNLOAD_URL
+    configuration = config.Configuration(
+        local_database_folder=temporary_directory, download_url=download_url)
+    _copy_database_file(config.Configuration(), temporary_directory)
+    return configuration
+
+
+def _create_database_server():
+    # Serves a compressed copy of test database with its checksum, as
+    # Maxmind does, without spending its download limit.
+    with open(config.Configuration().local_database_path, "rb") as input_file:
+        compressed_database = gzip.compress(input_file.read())
+    checksum = hashlib.sha256(compressed_database).hexdigest()
+    return fake_servers.FakeDownloadServer(
+        compressed_database, checksum_text="{0}  GeoLite2-City.mmdb.gz\n".format(
+            checksum))
+
+
+def _locate_in_many_processes(configuration):
+    barrier = multiprocessing.Barrier(CONCURRENT_PROCESSES)
+    processes = [multiprocessing.Process(target=_locate_in_process,
+                                         args=(configuration, barrier))
+                 for _ in range(CONCURRENT_PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [process.exitcode for process in processes]
+
+
+def _locate_in_process(configuration, barrier):
+    # Processes get their arguments pickled, so it must be a module level
+    # function.
+    barrier.wait()
+    with unittest.mock.patch("sys.stderr"):
+        local_database = geoip.LocalDatabaseGeoLocator(configuration)
+        local_database.wait_for_refresh()
+    geodata = local_database.locate(TEST_IP)
+    sys.exit(0 if geodata.city.name == TEST_IP_CITY else 1)
+
+
 def _create_too_old_database_locator(configuration):
     _make_database_file_too_old(configuration)
     local_database = geoip.LocalDatabaseGeoLocator(configuration)
@@ -0,0 +1,212 @@
+"""
+ test_health.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import socket
+import unittest
+
+import geoip2.errors as errors
+import requests.exceptions
+
+import geolocate.classes.exceptions as exceptions
+import geolocate.classes.health as health
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.circuit_breaker = health.CircuitBreaker(
+            failure_threshold=3, backoff=10, max_backoff=25, clock=self.clock)
+
+    def _fail(self, times, kind=health.FAILURE_TIMEOUT):
+        for _ in range(times):
+            self.circuit_breaker.record_failure(kind)
+
+    def test_open_after_consecutive_failures(self):
+        self._fail(2)
+        self.circuit_breaker.record_success()
+        self._fail(2)
+        self.assertEqual(self.circuit_breaker.state, health.CLOSED)
+        self.assertTrue(self.circuit_breaker.allow_request())
+        self._fail(1)
+        self.assertEqual(self.circuit_breaker.state, health.OPEN)
+        self.assertFalse(self.circuit_breaker.allow_request())
+        self.assertEqual(self.circuit_breaker.trips, 1)
+
+    def test_not_found_is_not_a_fault(self):
+        self._fail(2)
+        self._fail(5, health.FAILURE_NOT_FOUND)
+        self._fail(2)
+        self.assertEqual(self.circuit_breaker.state, health.CLOSED)
+        self.assertEqual(self.circuit_breaker.failures,
+                         {health.FAILURE_NOT_FOUND: 5,
+                          health.FAILURE_AUTHENTICATION: 0,
+                          health.FAILURE_TIMEOUT: 4,
+                          health.FAILURE_ERROR: 0})
+
+    def test_authentication_failure_opens_at_once(self):
+        self._fail(1, health.FAILURE_AUTHENTICATION)
+        self.assertEqual(self.circuit_breaker.state, health.OPEN)
+
+    def test_probe_after_backoff(self):
+        self._fail(3)
+        self.clock.now += 9
+        self.assertFalse(self.circuit_breaker.allow_request())
+        self.clock.now += 1
+        self.assertTrue(self.circuit_breaker.allow_request())
+        self.assertEqual(self.circuit_breaker.state, health.HALF_OPEN)
+        # Only one probe at a time.
+        self.assertFalse(self.circuit_breaker.allow_request())
+        self.circuit_breaker.record_success()
+        self.assertEqual(self.circuit_breaker.state, health.CLOSED)
+        self.assertTrue(self.circuit_breaker.allow_request())
+
+    def test_failed_probe_doubles_backoff(self):
+        self._fail(3)
+        for backoff in (10, 20, 25, 25):
+            self.clock.now += backoff - 1
+            self.assertFalse(self.circuit_breaker.allow_request())
+            self.clock.now += 1
+            self.assertTrue(self.circuit_breaker.allow_request())
+            self._fail(1)
+            self.assertEqual(self.circuit_breaker.state, health.OPEN)
+        self.assertEqual(self.circuit_breaker.trips, 5)
+        # Backoff starts again once locator recovers.
+        self.clock.now += 25
+        self.circuit_breaker.allow_request()
+        self.circuit_breaker.record_success()
+        self._fail(3)
+        self.clock.now += 10
+        self.assertTrue(self.circuit_breaker.allow_request())
+
+
+class TestLatencyTracker(unittest.TestCase):
+
+    def test_latency_tracker(self):
+        tracker = health.LatencyTracker(window=20)
+        self.assertIsNone(tracker.p95)
+        self.assertIsNone(tracker.success_rate)
+        for latency in range(1, 41):
+            tracker.record(latency / 100, latency % 4 != 0)
+        # Only latest lookups are kept.
+        self.assertEqual(tracker.samples, 20)
+        self.assertEqual(tracker.recorded, 40)
+        self.assertEqual(tracker.p95, 0.39)
+        self.assertEqual(tracker.percentile(0.5), 0.30)
+        self.assertEqual(tracker.success_rate, 0.75)
+        tracker.clear()
+        self.assertEqual(tracker.samples, 0)
+
+
+class TestAdaptiveOrder(unittest.TestCase):
+
+    PREFERENCE = ["geoip2_webservice", "geoip2_local"]
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.decisions = []
+        self.adaptive_order = health.AdaptiveOrder(
+            max_latency=0.3, min_success_rate=0.9, review_interval=60,
+            clock=self.clock, log=self.decisions.append)
+
+    def _record(self, times, latency, success=True):
+        for _ in range(times):
+            self.adaptive_order.record("geoip2_webservice", latency, success)
+
+    def test_order_kept_while_locators_behave(self):
+        self._record(health.MIN_LATENCY_SAMPLES * 5, 0.1)
+        self.assertEqual(self.adaptive_order.order(self.PREFERENCE),
+                         self.PREFERENCE)
+        self.assertEqual(self.decisions, [])
+
+    def test_slow_locator_demoted(self):
+        # Not judged before having enough lookups.
+        self._record(health.MIN_LATENCY_SAMPLES - 1, 0.5)
+        self.assertEqual(self.adaptive_order.order(self.PREFERENCE),
+                         self.PREFERENCE)
+        self._record(1, 0.5)
+        self.assertEqual(self.adaptive_order.order(self.PREFERENCE),
+                         ["geoip2_local", "geoip2_webservice"])
+        self.assertEqual(self.adaptive_order.demoted, {"geoip2_webservice"})
+        decision, = self.adaptive_order.decisions
+        self.assertEqual(decision.locator_id, "geoip2_webservice")
+        self.assertEqual(decision.action, health.DEMOTED)
+        self.assertIn("latency", decision.reason)
+        self.assertEqual(self.decisions, [decision])
+
+    def test_failing_locator_demoted(self):
+        self._record(health.MIN_LATENCY_SAMPLES - 2, 0.1)
+        self._record(2, 0.1, success=False)
+        # Exactly at minimum success rate is still fine.
+        self.assertEqual(self.adaptive_order.demoted, set())
+        self._record(health.EVALUATION_INTERVAL, 0.1, success=False)
+        decision, = self.adaptive_order.decisions
+        self.assertIn("success rate 60%", decision.reason)
+        self.assertEqual(self.adaptive_order.demoted, {"geoip2_webservice"})
+
+    def test_demoted_locator_restored(self):
+        self._record(health.MIN_LATENCY_SAMPLES, 0.5)
+        self.clock.now += 59
+        self.assertEqual(self.adaptive_order.order(self.PREFERENCE)[0],
+                         "geoip2_local")
+        self.clock.now += 1
+        self.assertEqual(self.adaptive_order.order(self.PREFERENCE),
+                         self.PREFERENCE)
+        self.assertEqual(self.decisions[-1].action, health.RESTORED)
+        # It is judged only from lookups after being restored.
+        self.assertEqual(
+            self.adaptive_order.get_tracker("geoip2_webservice").samples, 0)
+        self._record(health.MIN_LATENCY_SAMPLES - 1, 0.5)
+        self.assertEqual(self.adaptive_order.demoted, set())
+
+    def test_decisions_bounded(self):
+        adaptive_order = health.AdaptiveOrder(
+            max_latency=0.3, min_success_rate=0.9, review_interval=60,
+            clock=self.clock, max_decisions=3)
+        for _ in range(3):
+            for _ in range(health.MIN_LATENCY_SAMPLES):
+                adaptive_order.record("geoip2_webservice", 0.5, True)
+            self.clock.now += 60
+            adaptive_order.order(self.PREFERENCE)
+        decisions = adaptive_order.decisions
+        self.assertIsInstance(decisions, list)
+        self.assertEqual([decision.action for decision in decisions],
+                         [health.RESTORED, health.DEMOTED, health.RESTORED])
+
+
+class TestClassifyFailure(unittest.TestCase):
+
+    def test_classify_failure(self):
+        cases = [(errors.AddressNotFoundError("1.1.1.1"),
+                  health.FAILURE_NOT_FOUND),
+                 (exceptions.IPNotFound("1.1.1.1"), health.FAILURE_NOT_FOUND),
+                 (ValueError("not an address"), health.FAILURE_NOT_FOUND),
+                 (errors.AuthenticationError("wrong key"),
+                  health.FAILURE_AUTHENTICATION),
+                 (errors.OutOfQueriesError("no credit"),
+                  health.FAILURE_AUTHENTICATION),
+                 (socket.timeout(), health.FAILURE_TIMEOUT),
+                 (requests.exceptions.ReadTimeout(), health.FAILURE_TIMEOUT),
+                 (requests.exceptions.ConnectionError(),
+                  health.FAILURE_ERROR),
+                 (errors.HTTPError("server error", 500), health.FAILURE_ERROR)]
+        for error, kind in cases:
+            with self.subTest(error=error):
+                self.assertEqual(health.classify_failure(error), kind)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+ test_networks.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import unittest
+
+import geolocate.classes.networks as networks
+
+
+class TestNetworks(unittest.TestCase):
+
+    def test_network_table(self):
+        table = networks.NetworkTable(["10.0.0.0/8", "11.0.0.0/8",
+                                       "10.1.0.0/16", "2001:db8::/32"])
+        self.assertIn("10.0.0.0", table)
+        self.assertIn("10.255.255.255", table)
+        self.assertIn("11.1.2.3", table)
+        self.assertNotIn("9.255.255.255", table)
+        self.assertNotIn("12.0.0.0", table)
+        self.assertIn("2001:db8::1", table)
+        self.assertNotIn("2001:db9::1", table)
+        self.assertNotIn("::1", table)
+
+    def test_merge_ranges(self):
+        ranges = [(10, 20), (0, 5), (6, 8), (15, 30), (40, 50)]
+        merged_ranges = networks._merge_ranges(ranges)
+        self.assertEqual(merged_ranges, [(0, 8), (10, 30), (40, 50)])
+
+    def test_is_non_routable(self):
+        non_routable_addresses = ["10.1.2.3", "172.16.0.1", "192.168.1.1",
+                                  "127.0.0.1", "100.64.0.1", "169.254.1.1",
+                                  "192.0.2.1", "198.51.100.1", "203.0.113.1",
+                                  "255.255.255.255", "::1", "fe80::1",
+                                  "fd00::1", "2001:db8::1", "::ffff:a00:1"]
+        routable_addresses = ["8.8.8.8", "80.58.67.90", "172.32.0.1",
+                              "2001:4860:4860::8888", "::ffff:808:808"]
+        for address in non_routable_addresses:
+            self.assertTrue(networks.is_non_routable(address),
+                            msg="{0} not detected".format(address))
+        for address in routable_addresses:
+            self.assertFalse(networks.is_non_routable(address),
+                             msg="{0} wrongly detected".format(address))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+ test_parallel.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import concurrent.futures
+import io
+import subprocess
+import sys
+import unittest
+
+import geolocate.classes.config as config
+import geolocate.classes.parallel as parallel
+import geolocate.classes.parser as parser
+import geolocate.tests.testing_tools as testing_tools
+
+NOT_FOUND_ADDRESS = "5.5.5.5"
+# Writes a line and waits to be told to write the rest of its output.
+STREAMING_WRITER = ("import sys\n"
+                    "sys.stdout.buffer.write(b'from 80.58.0.1\\n')\n"
+                    "sys.stdout.flush()\n"
+                    "sys.stdin.readline()\n"
+                    "sys.stdout.buffer.write(b'and 5.5.5.5')\n")
+
+
+def load_stub_database(configuration):
+    # Workers get their database loader pickled, so it must be a module
+    # level function.
+    return testing_tools.StubGeoIPDatabase(not_found={NOT_FOUND_ADDRESS})
+
+
+class TestParallelParser(unittest.TestCase):
+
+    def setUp(self):
+        self.configuration = config.Configuration()
+        lines = ["line {0} 80.58.{1}.{2} \xf1 {3}\n".format(
+                    number, number // 256, number % 256, NOT_FOUND_ADDRESS)
+                 for number in range(3000)]
+        lines.append("last line without addresses nor line end")
+        self.text = "".join(lines)
+
+    def _parse_in_parallel(self, jobs):
+        input_stream = io.BytesIO(parser.encode(self.text))
+        parallel_parser = parallel.ParallelParser(
+            jobs, 1, self.configuration, input_stream, chunk_size=4096,
+            database_loader=load_stub_database)
+        return parallel_parser, b"".join(parallel_parser)
+
+    def test_ParallelParser(self):
+        """Check parallel output is the same and in the same order as
+        sequential one."""
+        sequential_parser = parser.GeolocateInputParser(
+            1, testing_tools.StubGeoIPDatabase(not_found={NOT_FOUND_ADDRESS}))
+        expected_output = parser.encode(
+            sequential_parser.include_locations(self.text))
+        _, output = self._parse_in_parallel(2)
+        self.assertEqual(output, expected_output)
+        self.assertIn(b"80.58.0.1 [Europe | Spain] \xc3\xb1 "
+                      b"5.5.5.5 [IP not found]", output)
+
+    def test_ParallelParser_statistics(self):
+        """Check every line is accounted to a worker."""
+        parallel_parser, _ = self._parse_in_parallel(2)
+        statistics = parallel_parser.statistics
+        self.assertEqual(statistics["jobs"], 2)
+        lines_parsed = sum(value for name, value in statistics.items()
+                           if name.endswith("_lines"))
+        self.assertEqual(lines_parsed, 3000)
+
+    def test_ParallelParser_streaming(self):
+        """Check lines are annotated as they arrive, without waiting for a
+        whole chunk or end of input."""
+        # Workers are forked with every open descriptor, so input is written
+        # by another process to let it end when that process exits.
+        writer = subprocess.Popen(
+            [sys.executable, "-c", STREAMING_WRITER],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        with concurrent.futures.ThreadPoolExecutor(1) as reader, writer:
+            try:
+                parallel_parser = parallel.ParallelParser(
+                    2, 1, self.configuration, writer.stdout,
+                    database_loader=load_stub_database, streaming=True)
+                annotated_chunks = iter(parallel_parser)
+                first_chunk = reader.submit(next, annotated_chunks)
+                self.assertEqual(first_chunk.result(timeout=60),
+                                 b"from 80.58.0.1 [Europe | Spain]\n")
+                writer.stdin.write(b"go on\n")
+                writer.stdin.flush()
+                rest = reader.submit(list, annotated_chunks)
+                self.assertEqual(rest.result(timeout=60),
+                                 [b"and 5.5.5.5 [IP not found]"])
+            finally:
+                # Ends input if parser got stuck, so test fails instead of
+                # hanging.
+                writer.kill()
+
+if __name__ == '__main__':
+    unittest.main()
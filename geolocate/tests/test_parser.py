@@ -6,13 +6,18 @@
  email: dante.signal31@gmail.com
 """
 
+import gzip
 import io
+import os
 import sys
+import tempfile
 import unittest
 import unittest.mock
 from collections import namedtuple
 
+import geolocate.classes.compression as compression
 import geolocate.classes.config as config
+import geolocate.classes.exceptions as exceptions
 import geolocate.classes.geowrapper as geoip
 import geolocate.classes.parser as parser
 import geolocate.tests.test_geowrapper as test_geowrapper
@@ -130,7 +135,7 @@ MOCKED_RESULTS_VERBOSITY_0 = {"173.194.45.51": 'North America',
 
 CORRECT_RESULT_TEXT = """TRACEROUTE OUTPUT
 traceroute to www.google.com (173.194.45.51 [North America]), 30 hops max, 60 byte packets
- 1  192.168.1.1 [IP not found] (192.168.1.1 [IP not found])  2.923 ms  4.180 ms  4.092 ms
+ 1  192.168.1.1 [private] (192.168.1.1 [private])  2.923 ms  4.180 ms  4.092 ms
  2  90.Red-80-58-67.staticIP.rima-tde.net (80.58.67.90 [Europe])  7.713 ms  7.657 ms  7.601 ms
  3  57.Red-80-58-76.staticIP.rima-tde.net (80.58.76.57 [Europe])  11.990 ms  11.948 ms  13.062 ms
  4  145.Red-80-58-86.staticIP.rima-tde.net (80.58.86.145 [Europe])  9.630 ms  14.929 ms  14.872 ms
@@ -188,7 +193,7 @@ class TestParser(unittest.TestCase):
                                                          CORRECT_RESULT_TEXT))
 
     @staticmethod
-    def _mocked_locate_results(ip_address):
+    def _mocked_locate_results(ip_address, detail=None):
         if MOCKED_RESULTS_VERBOSITY_0[ip_address] == IP_NOT_FOUND_MESSAGE:
             raise geoip.IPNotFound(ip_address)
         else:
@@ -210,10 +215,113 @@ class TestParser(unittest.TestCase):
                 # ## TODO: Remove Mock when _geoip_database.locate is implemented.
                 # input_parser._geoip_database.locate = unittest.mock.MagicMock(
                 #                                         return_value=MOCKED_LOCATE_RESPONSE)
-                location_string = input_parser._locate(ip_to_find)
+                location_string = parser._join_ip_to_location(
+                    ip_to_find, input_parser._locate(ip_to_find))
                 self.assertEqual(location_string,
                                  TEST_IP_LOCATION_STRINGS[TEST_IP][verbosity])
 
+    def test_GeolocateInputParser_get_location_string_cached(self):
+        """Check location strings are formatted only once per address."""
+        geoip_database = unittest.mock.MagicMock()
+        geoip_database.locate.return_value = MOCKED_LOCATE_RESPONSE
+        input_parser = parser.GeolocateInputParser(1, geoip_database)
+        for _ in range(3):
+            location_string = input_parser._get_location_string(TEST_IP)
+            self.assertEqual(location_string,
+                             TEST_IP_LOCATION_STRINGS[TEST_IP][1])
+        geoip_database.locate.assert_called_once_with(TEST_IP, 1)
+        self.assertEqual(input_parser.statistics["location_strings_hits"], 2)
+
+    def test_GeolocateInputParser_location_strings_shared(self):
+        """Check addresses in the same place share one cached location
+        string."""
+        geoip_database = unittest.mock.MagicMock()
+        geoip_database.locate.side_effect = \
+            lambda ip, verbosity: MOCKED_LOCATE_RESPONSE
+        input_parser = parser.GeolocateInputParser(1, geoip_database)
+        self.assertEqual(input_parser._get_location_string("8.8.8.8"),
+                         "8.8.8.8 [North America | United States]")
+        input_parser._get_location_string("8.8.4.4")
+        self.assertIs(
+            input_parser._location_strings.get(("8.8.8.8", 1)),
+            input_parser._location_strings.get(("8.8.4.4", 1)))
+
+    def test_GeolocateInputParser_database_check(self):
+        """Check location strings are forgotten when database reloads
+        changed data, and database is not checked before interval."""
+        geoip_database = unittest.mock.MagicMock()
+        geoip_database.locate.return_value = MOCKED_LOCATE_RESPONSE
+        geoip_database.reload_if_changed.return_value = True
+        text = "{0}\n{0}\n".format(TEST_IP)
+        with unittest.mock.patch.object(parser.time, "monotonic",
+                                        return_value=100.0) as monotonic:
+            input_parser = parser.GeolocateInputParser(
+                1, geoip_database, text, database_check_interval=10)
+            self.assertEqual(next(input_parser),
+                             TEST_IP_LOCATION_STRINGS[TEST_IP][1])
+            geoip_database.reload_if_changed.assert_not_called()
+            monotonic.return_value = 110.0
+            next(input_parser)
+        geoip_database.reload_if_changed.assert_called_once_with()
+        self.assertEqual(geoip_database.locate.call_count, 2)
+
+    def test_GeolocateInputParser_prefetch(self):
+        """Check addresses of lines already read are given to database at
+        once before locating them, but for non routable ones."""
+        geoip_database = unittest.mock.MagicMock()
+        geoip_database.prefetching = True
+        geoip_database.locate.return_value = MOCKED_LOCATE_RESPONSE
+        text = "{0} 192.168.1.1\n{0}\n80.58.67.90\n".format(TEST_IP)
+        input_parser = parser.GeolocateInputParser(1, geoip_database, text)
+        next(input_parser)
+        geoip_database.prefetch.assert_called_once()
+        addresses, verbosity = geoip_database.prefetch.call_args[0]
+        self.assertEqual(sorted(addresses), sorted(["80.58.67.90", TEST_IP]))
+        self.assertEqual(verbosity, 1)
+        self.assertEqual(geoip_database.locate.call_count, 1)
+        # Lines keep their order.
+        self.assertEqual(list(input_parser),
+                         [TEST_IP_LOCATION_STRINGS[TEST_IP][1],
+                          "80.58.67.90 [North America | United States]", ""])
+        # Addresses with cached location strings are not prefetched again.
+        geoip_database.prefetch.reset_mock()
+        input_parser.include_locations("{0}\n5.5.5.5\n".format(TEST_IP))
+        geoip_database.prefetch.assert_called_once_with(["5.5.5.5"], 1)
+
+    def test_GeolocateInputParser_get_location_string_not_found(self):
+        """Check not found addresses get a not found message."""
+        geoip_database = unittest.mock.MagicMock()
+        geoip_database.locate.side_effect = exceptions.IPNotFound("5.5.5.5")
+        input_parser = parser.GeolocateInputParser(0, geoip_database)
+        location_string = input_parser._get_location_string("5.5.5.5")
+        self.assertEqual(location_string, "5.5.5.5 [IP not found]")
+
+    def test_GeolocateInputParser_include_locations_in_line(self):
+        """Check an address being a substring of another one doesn't mess
+        up line rewriting."""
+        geoip_database = unittest.mock.MagicMock()
+        geoip_database.locate.return_value = MOCKED_LOCATE_RESPONSE
+        input_parser = parser.GeolocateInputParser(0, geoip_database)
+        line = "from 1.2.3.4 to 11.2.3.45 and back to 1.2.3.4"
+        correct_line = ("from 1.2.3.4 [North America] to 11.2.3.45 "
+                        "[North America] and back to 1.2.3.4 [North America]")
+        returned_line = input_parser._include_locations_in_line(line)
+        self.assertEqual(returned_line, correct_line)
+        self.assertEqual(geoip_database.locate.call_count, 2)
+
+    def test_GeolocateInputParser_non_routable_addresses(self):
+        """Check private and reserved addresses are tagged without querying
+        database."""
+        geoip_database = unittest.mock.MagicMock()
+        input_parser = parser.GeolocateInputParser(0, geoip_database,
+                                                   non_routable_tag="[lan]")
+        line = "from 192.168.1.1 to fe80::1%eth0 through 100.64.0.1"
+        correct_line = ("from 192.168.1.1 [lan] to fe80::1%eth0 [lan] "
+                        "through 100.64.0.1 [lan]")
+        returned_line = input_parser._include_locations_in_line(line)
+        self.assertEqual(returned_line, correct_line)
+        geoip_database.locate.assert_not_called()
+
     def test_GeolocateInputParser_format_location_string(self):
         """Check format_location_string() returns an string correctly formatted
         for every verbosity level.
@@ -226,6 +334,17 @@ class TestParser(unittest.TestCase):
             self.assertEqual(location_string,
                              TEST_IP_GEOLOCATION_STRINGS[TEST_IP][verbosity])
 
+    def test_GeolocateInputParser_format_country_model(self):
+        """Check country models, got when city data is not needed, are
+        formatted too.
+        """
+        country_model = geoip._build_model(
+            {"continent": {"names": {"en": "Europe"}},
+             "country": {"names": {"en": "Spain"}}}, geoip.WEBSERVICE_COUNTRY)
+        input_parser = parser.GeolocateInputParser(1, None)
+        self.assertEqual(input_parser._format_location_string(country_model),
+                         "[Europe | Spain]")
+
     def test_find_ips_in_text(self):
         """Check all embedded IP addresses are found."""
         returned_IP_addresses = set()
@@ -236,16 +355,60 @@ class TestParser(unittest.TestCase):
             returned_IP_addresses.update(line_IP_addresses)
         self.assertEqual(returned_IP_addresses, test_ip_addresses)
 
-    def test_include_location_in_line(self):
+    def test_find_ips_in_text_impossible_addresses(self):
+        """Check strings looking like addresses but not being them are
+        discarded."""
+        text = ("version 1.2.3.4.5 from 999.10.20.300 or 01.2.3.4 or "
+                "256.1.1.1 at 10.20.30 or v1.2.3.4, a1.2.3.4, 1.2.3.4a, "
+                "x_1.2.3.4 but 8.8.8.8. and 255.255.255.255 ok")
+        found_addresses = parser._find_ips_in_text(text)
+        self.assertEqual(found_addresses, {"8.8.8.8", "255.255.255.255"})
+
+    def test_find_ipv6_addresses(self):
+        """Check IPv6 addresses are found in any of their forms and returned
+        in canonical form."""
+        text = ("full 2001:0db8:0000:0000:0000:0000:0000:0001, compressed "
+                "2001:DB8::2, embedded ::ffff:80.58.67.90, zoned fe80::1%eth0 "
+                "but not time 13:55:36, mac 00:1a:2b:3c:4d:5e, std::abs or "
+                "1:2:3:4:5:6:7::8, nor x2001:db8::3 or 2001:db8::4_x")
+        found_addresses = parser._find_ipv6_addresses(text)
+        self.assertEqual(found_addresses, {"2001:db8::1", "2001:db8::2",
+                                           "::ffff:503a:435a", "fe80::1"})
+
+    def test_GeolocateInputParser_include_ipv6_locations_in_line(self):
+        """Check IPv6 addresses keep their spelling in line but are located
+        in canonical form."""
+        geoip_database = unittest.mock.MagicMock()
+        geoip_database.locate.return_value = MOCKED_LOCATE_RESPONSE
+        input_parser = parser.GeolocateInputParser(0, geoip_database)
+        line = "[2001:4860::1]:443 and 2001:4860:0:0:0:0:0:1 from 1.2.3.4"
+        correct_line = ("[2001:4860::1 [North America]]:443 and "
+                        "2001:4860:0:0:0:0:0:1 [North America] from 1.2.3.4 "
+                        "[North America]")
+        returned_line = input_parser._include_locations_in_line(line)
+        self.assertEqual(returned_line, correct_line)
+        located_addresses = [call[0][0] for call in
+                             geoip_database.locate.call_args_list]
+        self.assertEqual(located_addresses,
+                         ["2001:4860::1", "2001:4860::1", "1.2.3.4"])
+
+    def test_may_have_addresses(self):
+        """Check lines without enough dots are discarded."""
+        self.assertFalse(parser._may_have_addresses("GET /index.html 200"))
+        self.assertFalse(parser._may_have_addresses("10.20.30"))
+        self.assertTrue(parser._may_have_addresses("from 10.20.30.40"))
+
+    def test_include_locations_in_line(self):
         """Check IP addresses are properly replaced with geodata string."""
         line = ("traceroute to www.google.com (173.194.45.51), 30 hops max, "
                 "60 byte packets")
-        ip = "173.194.45.51"
-        location = "173.194.45.51 [North America | United States]"
         correct_line = ("traceroute to www.google.com (173.194.45.51 "
                         "[North America | United States]), 30 hops max, "
                         "60 byte packets")
-        returned_line = parser._include_location_in_line(line, ip, location)
+        geoip_database = unittest.mock.MagicMock()
+        geoip_database.locate.return_value = MOCKED_LOCATE_RESPONSE
+        input_parser = parser.GeolocateInputParser(1, geoip_database)
+        returned_line = input_parser._include_locations_in_line(line)
         self.assertEqual(returned_line,
                          correct_line,
                          msg="Rebuilt text and test string doesn't match.\n"
@@ -319,6 +482,147 @@ class TestInputReader(unittest.TestCase):
                              "Test string:\n {1}".format(rebuilt_text,
                                                          TEST_STRING))
 
+    def test_InputReader_binary_stream(self):
+        """Check lines split between blocks are rebuilt and non UTF-8 bytes
+        are kept."""
+        data = "Locate this: 128.101.101.101\nMadrid \u00f1 \n".encode("utf-8")
+        data += b"latin1 \xf1 195.113.3.45\nno line ending"
+        input_reader = parser.InputReader(io.BytesIO(data), block_size=7)
+        lines = list(input_reader)
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(all(line.endswith("\n") for line in lines[:3]))
+        rebuilt_data = b"".join(parser.encode(line) for line in lines)
+        self.assertEqual(rebuilt_data, data)
+
+    def test_InputReader_batches(self):
+        """Check lines are grouped as they are read."""
+        data = b"1.1.1.1\n2.2.2.2\n3.3.3.3\nno line ending"
+        input_reader = parser.InputReader(io.BytesIO(data), block_size=17)
+        batches = list(input_reader.batches())
+        self.assertEqual(batches, [["1.1.1.1\n", "2.2.2.2\n"],
+                                   ["3.3.3.3\n"], ["no line ending"]])
+
+    def test_InputReader_long_line(self):
+        """Check a line longer than many blocks is read whole."""
+        data = b"1.1.1.1 " * 1000 + b"\n2.2.2.2\nno line ending"
+        blocks = list(parser._read_line_blocks(io.BytesIO(data).read, 16))
+        self.assertEqual(b"".join(blocks), data)
+        self.assertTrue(blocks[0].startswith(b"1.1.1.1 " * 1000 + b"\n"))
+        self.assertTrue(all(block.endswith(b"\n") for block in blocks[:-1]))
+        self.assertEqual(blocks[-1], b"no line ending")
+        input_reader = parser.InputReader(io.BytesIO(data), block_size=16)
+        self.assertEqual(len(list(input_reader)), 3)
+
+
+class TestMappedFileParser(unittest.TestCase):
+
+    def setUp(self):
+        geoip_database = unittest.mock.Mock()
+        geoip_database.locate.side_effect = exceptions.IPNotFound("")
+        self.input_parser = parser.GeolocateInputParser(0, geoip_database, "")
+        self.temporary_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def _parse_file(self, data):
+        path = os.path.join(self.temporary_directory.name, "input.log")
+        with open(path, "wb") as input_file:
+            input_file.write(data)
+        output = io.BytesIO()
+        output_writer = parser.OutputWriter(output, line_buffered=False)
+        for chunk in parser.MappedFileParser(self.input_parser, path):
+            output_writer.write_bytes(chunk)
+        output_writer.flush()
+        return output.getvalue()
+
+    def test_MappedFileParser(self):
+        """Check file parsing gives the same result as text parsing and
+        non UTF-8 bytes are kept."""
+        data = b"latin1 \xf1 195.113.3.45\n" + parser.encode(TEST_STRING) + \
+               b"fe80::1%eth0 without line ending"
+        expected_output = parser.encode(
+            self.input_parser.include_locations(parser.decode(data)))
+        self.assertEqual(self._parse_file(data), expected_output)
+
+    def test_MappedFileParser_without_addresses(self):
+        """Check files without addresses are written untouched."""
+        data = b"no addresses\nversion 1.2.3.4.5\n"
+        self.assertEqual(self._parse_file(data), data)
+
+    def test_MappedFileParser_empty_file(self):
+        self.assertEqual(self._parse_file(b""), b"")
+
+
+class TestBlockParser(unittest.TestCase):
+
+    def test_BlockParser(self):
+        """Check block parsing gives the same result as text parsing."""
+        geoip_database = unittest.mock.Mock()
+        geoip_database.locate.side_effect = exceptions.IPNotFound("")
+        input_parser = parser.GeolocateInputParser(0, geoip_database, "")
+        data = parser.encode(TEST_STRING) + b"latin1 \xf1 195.113.3.45"
+        expected_output = parser.encode(
+            input_parser.include_locations(parser.decode(data)))
+        block_parser = parser.BlockParser(input_parser, io.BytesIO(data),
+                                          block_size=100)
+        self.assertEqual(b"".join(block_parser), expected_output)
+
+    def test_read_chunks(self):
+        """Check chunks are made of whole lines."""
+        data = parser.encode(TEST_STRING)
+        chunks = list(parser.read_chunks(io.BytesIO(data), 100))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(chunk.endswith(b"\n") for chunk in chunks))
+        self.assertEqual(b"".join(chunks), data)
+
+
+class TestOutputWriter(unittest.TestCase):
+
+    def test_OutputWriter(self):
+        """Check written text gets to binary output with non UTF-8 bytes
+        restored, but only when flushed if not line buffered."""
+        data = b"latin1 \xf1 195.113.3.45 [Europe]\n"
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            path = os.path.join(temporary_directory, "output.txt")
+            with open(path, "w") as output:
+                output_writer = parser.OutputWriter(output,
+                                                    line_buffered=False)
+                output_writer.write(parser.decode(data))
+                self.assertEqual(os.path.getsize(path), 0)
+                output_writer.flush()
+                with open(path, "rb") as written_file:
+                    self.assertEqual(written_file.read(), data)
+
+    def test_OutputWriter_text_stream(self):
+        """Check text only streams are supported."""
+        output = io.StringIO()
+        output_writer = parser.OutputWriter(output)
+        output_writer.write("Madrid \u00f1\n")
+        output_writer.flush()
+        self.assertEqual(output.getvalue(), "Madrid \u00f1\n")
+
+    def test_OutputWriter_write_bytes(self):
+        """Check encoded data is written as is."""
+        data = b"latin1 \xf1 195.113.3.45 [Europe]\n"
+        output = io.BytesIO()
+        output_writer = parser.OutputWriter(output, line_buffered=True)
+        output_writer.write_bytes(data)
+        self.assertEqual(output.getvalue(), data)
+
+    def test_OutputWriter_compressed(self):
+        """Check output is compressed and finished when closed, leaving
+        stream open."""
+        output = io.BytesIO()
+        output_writer = parser.OutputWriter(
+            output, line_buffered=False,
+            compression_format=compression.GZIP)
+        output_writer.write("Madrid \u00f1\n")
+        output_writer.close()
+        self.assertFalse(output.closed)
+        self.assertEqual(gzip.decompress(output.getvalue()),
+                         "Madrid \u00f1\n".encode("utf-8"))
+
 
 def _read_stdin(input_reader):
     lines_read = (line for line in input_reader)
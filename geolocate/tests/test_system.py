@@ -0,0 +1,47 @@
+"""
+ test_system.py
+
+ Programmed by: Dante Signal31
+
+ email: dante.signal31@gmail.com
+"""
+import os
+import tempfile
+import time
+import unittest
+
+import geolocate.classes.system as system
+
+
+class TestFileLock(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.lock_path = os.path.join(self.temporary_directory.name,
+                                      "test.lock")
+
+    def tearDown(self):
+        self.temporary_directory.cleanup()
+
+    def test_file_lock(self):
+        lock = system.FileLock(self.lock_path)
+        other_lock = system.FileLock(self.lock_path)
+        with lock:
+            self.assertTrue(lock.locked)
+            self.assertFalse(other_lock.acquire(timeout=0))
+            self.assertFalse(other_lock.locked)
+        self.assertFalse(lock.locked)
+        self.assertTrue(other_lock.acquire(timeout=0))
+        other_lock.release()
+
+    def test_file_lock_timeout(self):
+        lock = system.FileLock(self.lock_path)
+        other_lock = system.FileLock(self.lock_path)
+        with lock:
+            start = time.monotonic()
+            self.assertFalse(other_lock.acquire(timeout=0.3))
+            self.assertGreaterEqual(time.monotonic() - start, 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
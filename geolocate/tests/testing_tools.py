@@ -10,6 +10,40 @@ import ntpath
 import os
 import shutil
 import tempfile
+from collections import namedtuple
+
+import geolocate.classes.exceptions as exceptions
+
+
+location_record = namedtuple("location_record", "continent country city "
+                                                "location")
+name_record = namedtuple("name_record", "name")
+coordinates_record = namedtuple("coordinates_record", "latitude longitude")
+
+STUB_LOCATION = location_record(name_record("Europe"),
+                                name_record("Spain"),
+                                name_record("Madrid"),
+                                coordinates_record(40.4165, -3.70256))
+
+
+class StubGeoIPDatabase(object):
+    """ Answers every query with the same location, so tests and
+    benchmarks don't depend on locators.
+    """
+
+    def __init__(self, not_found=()):
+        """
+        :param not_found: Addresses to be reported as not found.
+        :type not_found: set
+        """
+        self._not_found = set(not_found)
+        self.queries = 0
+
+    def locate(self, ip, detail=None):
+        self.queries += 1
+        if ip in self._not_found:
+            raise exceptions.IPNotFound(ip)
+        return STUB_LOCATION
 
 
 class OriginalFileSaved(object):
@@ -37,9 +37,10 @@ setup(name="glocate",
                    'Programming Language :: Python :: 3',
                    'Programming Language :: Python :: 3.4'],
       keywords="geolocation ip addresses",
-      install_requires=["geoip2>=2.1.0", "maxminddb>=1.1.1", "requests>=2.22.0",
-                        "wget>=2.2", "wheel>=0.24.0", "keyring>=10.4.0",
+      install_requires=["geoip2>=2.1.0", "maxminddb>=1.5.0", "requests>=2.22.0",
+                        "wheel>=0.24.0", "keyring>=10.4.0",
                         "dbus-python>=1.2.4"],
+      extras_require={"zstd": ["zstandard>=0.15.0"]},
       zip_safe=False,
       # TODO: This exclude is not working when building wheels, tests package
       # is still included in packages. It's a bug in pip: